@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the per-bin result assembly of AcuFile
+
+Computes rms, peak and sel (AcuFile._apply_multiple) and the psd (AcuFile._spectrum) on files with an increasing
+number of bins (up to 100k) and prints the time per bin. The time per bin should stay constant (linear scaling) as
+the outputs are written in preallocated buffers.
+"""
+
+import operator
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+import pyhydrophone as pyhy
+import soundfile as sf
+
+import pypam
+
+fs = 8000
+binsize = 0.1
+n_bins_list = [100, 1000, 10000, 100000]
+hydrophone = pyhy.amar.AmarG3('AMAR', 'G3', 1, -166.6, 0, 2)
+methods = {
+    'rms, peak, sel': operator.methodcaller('_apply_multiple', ['rms', 'peak', 'sel'], binsize=binsize),
+    'psd': operator.methodcaller('psd', binsize=binsize, nfft=256),
+}
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as folder:
+        for n_bins in n_bins_list:
+            wav_path = pathlib.Path(folder).joinpath('AMAR.20210610T033655Z.wav')
+            data = np.random.default_rng(0).standard_normal(int(n_bins * binsize * fs)) * 0.1
+            sf.write(wav_path, data, fs, subtype='PCM_16')
+            acu_file = pypam.AcuFile(wav_path, hydrophone, 1.0)
+            for name, f in methods.items():
+                start = time.perf_counter()
+                ds = f(acu_file)
+                elapsed = time.perf_counter() - start
+                if n_bins == n_bins_list[0]:
+                    # The first run includes the numba compilation
+                    continue
+                print('%-15s %7d bins: %7.2f s, %6.1f us per bin' % (name, ds.dims['id'], elapsed,
+                                                                    elapsed / ds.dims['id'] * 1e6))
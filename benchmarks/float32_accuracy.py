@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Accuracy and memory report of the float32 processing mode
+
+Computes the main outputs of AcuFile on the files of the test corpus (tests/test_data) in float64 and in float32 and
+prints, for each output, the maximum and the mean absolute difference (in dB) between both modes, the size of the
+output and the ratio of the computation times.
+"""
+
+import pathlib
+import time
+
+import numpy as np
+import pyhydrophone as pyhy
+
+import pypam
+
+test_data = pathlib.Path(__file__).parent.parent.joinpath('tests', 'test_data')
+files = sorted(test_data.glob('**/*.wav')) + sorted(test_data.glob('**/*.flac'))
+soundtrap = pyhy.soundtrap.SoundTrap('SoundTrap', 'ST300HF', 67416073, sensitivity=-172.8, gain_type='High')
+outputs = {
+    'rms, peak, sel': lambda acu_file: acu_file._apply_multiple(['rms', 'peak', 'sel'], binsize=10.0,
+                                                               band_list=[[10, 1000]]),
+    'psd': lambda acu_file: acu_file.psd(binsize=10.0, nfft=4096, percentiles=[10, 50, 90]),
+    'psd (band)': lambda acu_file: acu_file.psd(binsize=10.0, nfft=4096, band=[10, 4000]),
+    'spectrogram': lambda acu_file: acu_file.spectrogram(binsize=10.0, nfft=4096),
+    'third octaves': lambda acu_file: acu_file.third_octaves_levels(binsize=10.0),
+}
+
+if __name__ == '__main__':
+    print('%-15s %-30s %12s %12s %8s %8s %8s' % ('output', 'file', 'max diff dB', 'mean diff dB', 'MB f64', 'MB f32',
+                                                't32/t64'))
+    for file_path in files:
+        for name, f in outputs.items():
+            times = []
+            results = []
+            for dtype in ['float64', 'float32']:
+                acu_file = pypam.AcuFile(file_path, soundtrap, 1.0, dtype=dtype)
+                start = time.perf_counter()
+                results.append(f(acu_file))
+                times.append(time.perf_counter() - start)
+            ds64, ds32 = results
+            diff = np.concatenate([np.abs(ds64[var].values - ds32[var].values).ravel() for var in ds64.data_vars])
+            print('%-15s %-30s %12.2e %12.2e %8.2f %8.2f %8.2f' % (name, file_path.name, np.nanmax(diff),
+                                                                 np.nanmean(diff), ds64.nbytes / 1e6,
+                                                                 ds32.nbytes / 1e6, times[1] / times[0]))
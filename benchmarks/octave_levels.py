@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Speed and accuracy report of the octave and third-octave band levels
+
+Computes the band levels of 1-second bins of white noise with the previous implementation (one sosfilt call per
+band and per bin), with the batched filterbank (signal.octave_bank_levels, method 'filter') and with the fft bands
+(method 'fft'), and prints the computation time of each one and the maximum difference (in dB) with the previous
+implementation.
+"""
+
+import time
+
+import numpy as np
+import scipy.signal
+
+from pypam import signal as sig
+from pypam import utils
+
+fs = 48000
+n_bins = 120
+noise = np.random.default_rng(0).standard_normal((n_bins, fs))
+
+
+def per_bin_levels(blocks, fraction):
+    """
+    Previous implementation: decimation chain and one sosfilt call per band, for each bin
+    """
+    bands, f = utils.oct_fbands(min_freq=sig.MIN_FREQ, max_freq=fs / 2, fraction=fraction)
+    filterbank, _, d = utils.octbankdsgn(fs, bands, fraction, 2)
+    levels = np.zeros((blocks.shape[0], len(d)))
+    for j, block in enumerate(blocks):
+        decimated = {0: block}
+        for i in range(1, int(d.max())):
+            decimated[i] = scipy.signal.decimate(decimated[i - 1], 2)
+        for i in range(len(d)):
+            y = scipy.signal.sosfilt(filterbank[i], decimated[d[i] - 1])
+            levels[j, i] = 10 * np.log10(np.sum(y ** 2) / len(y))
+    return levels
+
+
+def timed(f, *args, **kwargs):
+    start = time.perf_counter()
+    output = f(*args, **kwargs)
+    return output, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    # Compile the numba kernel before timing
+    sig.octave_bank_levels(noise[:1], fs)
+    print('%-10s %-10s %10s %14s' % ('bands', 'method', 'time (s)', 'max diff dB'))
+    for fraction, name in [(1, 'octave'), (3, '1/3-octave')]:
+        reference, t_reference = timed(per_bin_levels, noise, fraction)
+        print('%-10s %-10s %10.3f %14s' % (name, 'per bin', t_reference, '-'))
+        for method in ['filter', 'fft']:
+            (fbands, levels), t = timed(sig.octave_bank_levels, noise, fs, fraction=fraction, method=method)
+            # The fft bands below 200 Hz have too few bins to be compared
+            resolved = fbands > 200
+            diff = np.abs(levels[:, resolved] - reference[:, resolved]).max()
+            print('%-10s %-10s %10.3f %14.2e' % (name, method, t, diff))
@@ -0,0 +1,294 @@
+__author__ = "Clea Parcerisas"
+__version__ = "0.1"
+__credits__ = "Clea Parcerisas"
+__email__ = "clea.parcerisas@vliz.be"
+__status__ = "Development"
+
+import functools
+
+import numpy as np
+import scipy.sparse
+import xarray
+
+# Maximum number of band aggregations kept in the cache
+CACHE_MAXSIZE = 32
+
+
+class BandAggregation:
+    def __init__(self, freq, bands_limits, bands_c, fft_bin_width):
+        """
+        Conversion of spectra with the frequency axis freq to the bands defined by bands_limits, as a sparse matrix
+        of weights (n_freq x n_bands). Each fft bin contributes to the band which contains it, and the fft bins
+        which contain a band limit are divided in proportion to each of the adjacent bands. The weights are divided
+        by the bandwidth of each band, so the output is a density. See utils.spectra_ds_to_bands
+
+        Parameters
+        ----------
+        freq : np.array
+            Frequency axis of the spectra
+        bands_limits : list or array
+            Limits of the bands (n_bands + 1)
+        bands_c : list or array
+            Centre of the bands
+        fft_bin_width : float
+            fft bin width in Hz
+        """
+        freq = np.asarray(freq, dtype=float)
+        bands_limits = np.asarray(bands_limits, dtype=float)
+        self.freq = freq
+        self.bands_c = np.asarray(bands_c)
+        self.lower_frequency = bands_limits[:-1]
+        self.upper_frequency = bands_limits[1:]
+        n_freq = freq.size
+        n_bands = bands_limits.size - 1
+
+        # fft bin of each limit (relative to the first frequency of the spectra)
+        fft_freq_indices = (np.floor((bands_limits + (fft_bin_width / 2)) / fft_bin_width)).astype(int)
+        fft_freq_indices -= int(freq[0] / fft_bin_width)
+        if fft_freq_indices[-1] > (n_freq - 1):
+            fft_freq_indices[-1] = n_freq - 1
+        lower_indices = fft_freq_indices[:-1]
+        upper_indices = fft_freq_indices[1:]
+        lower_factor = lower_indices * fft_bin_width + fft_bin_width / 2 - self.lower_frequency + freq[0]
+        upper_factor = self.upper_frequency - (upper_indices * fft_bin_width - fft_bin_width / 2) - freq[0]
+
+        # The bins which do not contain any limit are added to the band which contains their frequency
+        inner = np.delete(np.arange(n_freq), fft_freq_indices)
+        inner_band = np.searchsorted(bands_limits, freq[inner], side='right') - 1
+        in_bands = (inner_band >= 0) & (inner_band < n_bands)
+        inner = inner[in_bands]
+        inner_band = inner_band[in_bands]
+
+        bands = np.arange(n_bands)
+        rows = np.concatenate([inner, lower_indices % n_freq, upper_indices % n_freq])
+        cols = np.concatenate([inner_band, bands, bands])
+        weights = np.concatenate([np.ones(inner.size), lower_factor / fft_bin_width, upper_factor / fft_bin_width])
+        weights = weights / (self.upper_frequency - self.lower_frequency)[cols]
+        # Repeated (row, col) pairs are added
+        self.weights = scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(n_freq, n_bands))
+
+    def apply(self, values, axis=-1):
+        """
+        Convert the spectra in values (linear units) to the bands
+
+        Parameters
+        ----------
+        values : np.array
+            Spectra, with the frequency along axis
+        axis : int
+            Frequency axis
+
+        Returns
+        -------
+        np.array with the bands along axis instead of the frequency
+        """
+        values = np.moveaxis(np.asarray(values), axis, -1)
+        shape = values.shape
+        bands = (self.weights.T @ values.reshape(-1, shape[-1]).T).T
+        return np.moveaxis(bands.reshape(shape[:-1] + (self.weights.shape[1],)), -1, axis)
+
+    def apply_da(self, psd, freq_coord='frequency'):
+        """
+        Convert the spectra of the DataArray psd (linear units) to the bands. The frequency dimension is replaced by
+        freq_coord + '_bins', with the coordinates lower_frequency and upper_frequency. If psd is backed by dask,
+        the output is computed lazily, chunk by chunk
+
+        Parameters
+        ----------
+        psd : xarray DataArray
+            Spectra, with the dimension freq_coord
+        freq_coord : str
+            Name of the frequency coordinate
+        """
+        new_coord_name = freq_coord + '_bins'
+        dims = [new_coord_name if dim == freq_coord else dim for dim in psd.dims]
+        if psd.chunks is not None:
+            # All the frequencies of a spectrum are needed at once
+            psd = psd.chunk({freq_coord: -1})
+        bands = xarray.apply_ufunc(self.apply, psd, input_core_dims=[[freq_coord]],
+                                   output_core_dims=[[new_coord_name]], dask='parallelized',
+                                   output_dtypes=[float],
+                                   dask_gufunc_kwargs={'output_sizes': {new_coord_name: self.bands_c.size}})
+        bands = bands.transpose(*dims)
+        bands = bands.assign_coords({new_coord_name: self.bands_c,
+                                     'lower_frequency': (new_coord_name, self.lower_frequency),
+                                     'upper_frequency': (new_coord_name, self.upper_frequency)})
+        bands.attrs = psd.attrs
+        return bands
+
+
+class HmbAggregation(BandAggregation):
+    def __init__(self, hmb_c, hmb_lower, hmb_upper, bands_limits, bands_c, changing_frequency, fft_bin_width=1.0):
+        """
+        Conversion of hybrid millidecade band (HMB) spectra to wider logarithmic bands (i.e. decidecade bands), as a
+        sparse matrix of weights (n_hmb x n_bands). Below the changing frequency the HMB are the fft bins, and they
+        are divided among the bands as in BandAggregation. Above it, the power of each HMB (density times its
+        bandwidth) is added to the band which contains its centre. As in BandAggregation, the weights are divided by
+        the bandwidth of each band. See utils.hmb_to_decidecade
+
+        Parameters
+        ----------
+        hmb_c : np.array
+            Centre frequencies of the HMB
+        hmb_lower : np.array
+            Lower limits of the HMB
+        hmb_upper : np.array
+            Upper limits of the HMB
+        bands_limits : list or array
+            Limits of the output bands (n_bands + 1)
+        bands_c : list or array
+            Centre of the output bands
+        changing_frequency : float
+            Frequency where the HMB change from linear to logarithmic. The bands are split at the last band limit
+            below it
+        fft_bin_width : float
+            Width of the linear HMB in Hz
+        """
+        hmb_c = np.asarray(hmb_c, dtype=float)
+        hmb_bandwidth = np.asarray(hmb_upper, dtype=float) - np.asarray(hmb_lower, dtype=float)
+        bands_limits = np.asarray(bands_limits, dtype=float)
+        self.freq = hmb_c
+        self.bands_c = np.asarray(bands_c)
+        self.lower_frequency = bands_limits[:-1]
+        self.upper_frequency = bands_limits[1:]
+        n_bands = bands_limits.size - 1
+        changing_band = np.where(bands_limits < changing_frequency)[0][-1]
+
+        # Linear part: the HMB are fft bins
+        low = np.where(np.asarray(hmb_upper) <= bands_limits[changing_band])[0]
+        low_weights = BandAggregation(hmb_c[low], bands_limits[:changing_band + 1], self.bands_c[:changing_band],
+                                      fft_bin_width).weights.tocoo()
+
+        # Logarithmic part: each HMB goes to the band (lower, upper] which contains its centre
+        high_band = np.searchsorted(bands_limits, hmb_c, side='left') - 1
+        high = np.where((high_band >= changing_band) & (high_band < n_bands))[0]
+        high_band = high_band[high]
+        high_weights = hmb_bandwidth[high] / (self.upper_frequency - self.lower_frequency)[high_band]
+
+        rows = np.concatenate([low[low_weights.row], high])
+        cols = np.concatenate([low_weights.col, high_band])
+        weights = np.concatenate([low_weights.data, high_weights])
+        self.weights = scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(hmb_c.size, n_bands))
+
+
+class BandIntegration(BandAggregation):
+    def __init__(self, freq_step, n_freq, bands_limits, bands_c):
+        """
+        Integral of spectra with a linear frequency axis (freq_step * k, for k in [0, n_freq)) over bands, with
+        the trapezoidal rule over the frequencies strictly inside each band (as np.trapz), as a sparse matrix of
+        weights (n_freq x n_bands). The output is the integral, not a density. The bands with less than two
+        frequencies inside are 0
+
+        Parameters
+        ----------
+        freq_step : float
+            Frequency resolution of the spectra
+        n_freq : int
+            Number of frequencies of the spectra
+        bands_limits : list of 2 arrays
+            Lower and upper limits of the bands
+        bands_c : list or array
+            Centre of the bands
+        """
+        self.freq = np.arange(n_freq) * freq_step
+        self.bands_c = np.asarray(bands_c)
+        self.lower_frequency = np.asarray(bands_limits[0], dtype=float)
+        self.upper_frequency = np.asarray(bands_limits[1], dtype=float)
+        # First and last frequency strictly inside each band
+        first = np.searchsorted(self.freq, self.lower_frequency, side='right')
+        last = np.searchsorted(self.freq, self.upper_frequency, side='left') - 1
+        rows, cols, weights = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)], [np.zeros(0)]
+        for j in np.where(last > first)[0]:
+            band_weights = np.full(last[j] - first[j] + 1, float(freq_step))
+            # The ends of the band only count half
+            band_weights[[0, -1]] = freq_step / 2
+            rows.append(np.arange(first[j], last[j] + 1))
+            cols.append(np.full(band_weights.size, j))
+            weights.append(band_weights)
+        rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+        self.weights = scipy.sparse.csr_matrix((weights, (rows, cols)), shape=(n_freq, self.bands_c.size))
+
+
+@functools.lru_cache(maxsize=CACHE_MAXSIZE)
+def _cached_band_aggregation(freq, bands_limits, bands_c, fft_bin_width):
+    return BandAggregation(np.frombuffer(freq), np.frombuffer(bands_limits), np.frombuffer(bands_c), fft_bin_width)
+
+
+def band_aggregation(freq, bands_limits, bands_c, fft_bin_width):
+    """
+    Return the BandAggregation of the parameters. It is only built once for each set of parameters (the last
+    CACHE_MAXSIZE are kept), so it is shared by all the files and calls with the same frequency axis and bands
+
+    Parameters
+    ----------
+    freq : np.array
+        Frequency axis of the spectra
+    bands_limits : list or array
+        Limits of the bands
+    bands_c : list or array
+        Centre of the bands
+    fft_bin_width : float
+        fft bin width in Hz
+    """
+    return _cached_band_aggregation(np.asarray(freq, dtype=float).tobytes(),
+                                    np.asarray(bands_limits, dtype=float).tobytes(),
+                                    np.asarray(bands_c, dtype=float).tobytes(), float(fft_bin_width))
+
+
+@functools.lru_cache(maxsize=CACHE_MAXSIZE)
+def _cached_hmb_aggregation(hmb_c, hmb_lower, hmb_upper, bands_limits, bands_c, changing_frequency, fft_bin_width):
+    return HmbAggregation(np.frombuffer(hmb_c), np.frombuffer(hmb_lower), np.frombuffer(hmb_upper),
+                          np.frombuffer(bands_limits), np.frombuffer(bands_c), changing_frequency, fft_bin_width)
+
+
+def hmb_aggregation(hmb_c, hmb_lower, hmb_upper, bands_limits, bands_c, changing_frequency, fft_bin_width=1.0):
+    """
+    Return the HmbAggregation of the parameters. As band_aggregation, it is only built once for each HMB frequency
+    axis and output bands
+
+    Parameters
+    ----------
+    hmb_c : np.array
+        Centre frequencies of the HMB
+    hmb_lower : np.array
+        Lower limits of the HMB
+    hmb_upper : np.array
+        Upper limits of the HMB
+    bands_limits : list or array
+        Limits of the output bands
+    bands_c : list or array
+        Centre of the output bands
+    changing_frequency : float
+        Frequency where the HMB change from linear to logarithmic
+    fft_bin_width : float
+        Width of the linear HMB in Hz
+    """
+    return _cached_hmb_aggregation(*[np.asarray(a, dtype=float).tobytes()
+                                     for a in [hmb_c, hmb_lower, hmb_upper, bands_limits, bands_c]],
+                                   float(changing_frequency), float(fft_bin_width))
+
+
+@functools.lru_cache(maxsize=CACHE_MAXSIZE)
+def _cached_band_integration(freq_step, n_freq, lower, upper, bands_c):
+    return BandIntegration(freq_step, n_freq, [np.frombuffer(lower), np.frombuffer(upper)], np.frombuffer(bands_c))
+
+
+def band_integration(freq_step, n_freq, bands_limits, bands_c):
+    """
+    Return the BandIntegration of the parameters. As band_aggregation, it is only built once for each frequency
+    axis and bands
+
+    Parameters
+    ----------
+    freq_step : float
+        Frequency resolution of the spectra
+    n_freq : int
+        Number of frequencies of the spectra
+    bands_limits : list of 2 arrays
+        Lower and upper limits of the bands
+    bands_c : list or array
+        Centre of the bands
+    """
+    return _cached_band_integration(float(freq_step), int(n_freq),
+                                    *[np.asarray(a, dtype=float).tobytes() for a in [bands_limits[0], bands_limits[1],
+                                                                                      bands_c]])
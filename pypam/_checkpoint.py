@@ -0,0 +1,117 @@
+__author__ = "Clea Parcerisas"
+__version__ = "0.1"
+__credits__ = "Clea Parcerisas"
+__email__ = "clea.parcerisas@vliz.be"
+__status__ = "Development"
+
+import hashlib
+import json
+import os
+import pathlib
+
+import xarray
+
+try:
+    import dask
+except ModuleNotFoundError:
+    dask = None
+
+ATTRS_KEY = 'pypam_attrs'
+
+
+def shard_key(wav_file, params):
+    """
+    Return the key which identifies the output of wav_file processed with params (the name of its shard, without
+    extension). It depends on the path, the size and the modification time of the file and on the processing
+    parameters, so if any of them changes the key changes too
+
+    Parameters
+    ----------
+    wav_file : str or Path
+        Sound file
+    params : dict
+        Processing parameters. They have to be representable as a string
+
+    Returns
+    -------
+    str
+    """
+    wav_file = pathlib.Path(wav_file)
+    stat = os.stat(wav_file)
+    key = json.dumps({'file_path': str(wav_file.resolve()), 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                      'params': params}, sort_keys=True, default=str)
+    file_hash = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return '%s_%s' % (wav_file.stem, file_hash)
+
+
+def shard_path(checkpoint_dir, wav_file, params):
+    """
+    Return the path of the shard (netCDF file) where the output of wav_file is stored (see shard_key), so if the
+    file or the processing parameters change the file is processed again
+
+    Parameters
+    ----------
+    checkpoint_dir : str or Path
+        Folder where all the shards are stored
+    wav_file : str or Path
+        Sound file
+    params : dict
+        Processing parameters. They have to be representable as a string
+
+    Returns
+    -------
+    Path of the shard
+    """
+    return pathlib.Path(checkpoint_dir).joinpath('%s.nc' % shard_key(wav_file, params))
+
+
+def save_shard(ds, path):
+    """
+    Save the dataset ds in path. The global attributes are stored as json, so their types (i.e. bool) are kept even
+    if netCDF does not support them. The file is first written with a temporary name and then renamed, so an
+    interrupted run never leaves a half-written shard.
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Output of one file
+    path : Path
+        Output of shard_path
+    """
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    ds_to_save = ds.copy()
+    ds_to_save.attrs = {ATTRS_KEY: json.dumps(ds.attrs, default=_to_json)}
+    tmp_path = path.with_suffix('.tmp')
+    ds_to_save.to_netcdf(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_shard(path):
+    """
+    Open a shard saved with save_shard. If dask is installed the data is not loaded in memory until it is needed
+
+    Parameters
+    ----------
+    path : Path
+        Output of shard_path
+
+    Returns
+    -------
+    xarray Dataset with the original attributes
+    """
+    if dask is None:
+        ds = xarray.open_dataset(path)
+    else:
+        ds = xarray.open_dataset(path, chunks={})
+    ds.attrs = json.loads(ds.attrs[ATTRS_KEY])
+    return ds
+
+
+def _to_json(value):
+    """
+    Convert numpy scalars and other objects to json serializable values
+    """
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
@@ -0,0 +1,197 @@
+__author__ = "Clea Parcerisas"
+__version__ = "0.1"
+__credits__ = "Clea Parcerisas"
+__email__ = "clea.parcerisas@vliz.be"
+__status__ = "Development"
+
+import numpy as np
+import xarray
+
+
+class BinCollector:
+    def __init__(self, n_bins, dtype=np.float64):
+        """
+        Preallocated storage of the per-bin outputs of a sound file. Instead of concatenating one xarray object per
+        bin (which copies the whole growing result at every bin) the values are written in numpy buffers and the
+        xarray objects are built only once, when all the bins have been processed.
+
+        Parameters
+        ----------
+        n_bins : int
+            Expected number of bins. If more bins are added, the buffers are grown (doubling their size) so the
+            total cost stays linear in the number of bins
+        dtype : numpy dtype
+            Default type of the buffers of the variables
+        """
+        self._capacity = max(int(n_bins), 1)
+        self.dtype = np.dtype(dtype)
+        self.n = 0
+        self.ids = np.zeros(self._capacity, dtype=np.int64)
+        self.datetimes = np.empty(self._capacity, dtype='datetime64[ns]')
+        self.start_samples = np.zeros(self._capacity, dtype=np.int64)
+        self.end_samples = np.zeros(self._capacity, dtype=np.int64)
+        self._data = {}
+
+    def __getitem__(self, name):
+        """
+        Return the buffer of the variable name (only the filled bins)
+        """
+        return self._data[name][:self.n]
+
+    def add_variable(self, name, shape=(), dtype=None, fill_value=np.nan):
+        """
+        Declare a new variable to collect
+
+        Parameters
+        ----------
+        name : str
+            Name of the variable
+        shape : tuple
+            Shape of the output of one bin (without the bin dimension)
+        dtype : numpy dtype or None
+            Type of the buffer. If None, the dtype of the collector
+        fill_value : scalar
+            Value of the bins which are not set (i.e. when the method fails)
+        """
+        if dtype is None:
+            dtype = self.dtype
+        self._data[name] = np.full((self._capacity,) + tuple(shape), fill_value, dtype=dtype)
+
+    def _grow(self):
+        """
+        Double the capacity of all the buffers
+        """
+        new_capacity = self._capacity * 2
+        self.ids = np.resize(self.ids, new_capacity)
+        self.datetimes = np.resize(self.datetimes, new_capacity)
+        self.start_samples = np.resize(self.start_samples, new_capacity)
+        self.end_samples = np.resize(self.end_samples, new_capacity)
+        for name, buffer in self._data.items():
+            new_buffer = np.full((new_capacity,) + buffer.shape[1:], np.nan if buffer.dtype.kind in 'fc' else 0,
+                                 dtype=buffer.dtype)
+            new_buffer[:self._capacity] = buffer
+            self._data[name] = new_buffer
+        self._capacity = new_capacity
+
+    def new_bin(self, i, time_bin, start_sample, end_sample):
+        """
+        Register a new bin and return the row where its values have to be stored
+
+        Parameters
+        ----------
+        i : int
+            Index of the bin
+        time_bin : datetime
+            Datetime of the beginning of the bin
+        start_sample : int
+            First sample of the bin
+        end_sample : int
+            Last sample of the bin
+        """
+        if self.n == self._capacity:
+            self._grow()
+        row = self.n
+        self.ids[row] = i
+        self.datetimes[row] = np.datetime64(time_bin, 'ns')
+        self.start_samples[row] = start_sample
+        self.end_samples[row] = end_sample
+        self.n += 1
+        return row
+
+    def new_bins(self, ids, time_bins, start_samples, end_samples):
+        """
+        Register a batch of consecutive bins and return the slice of rows where their values have to be stored
+
+        Parameters
+        ----------
+        ids : np.array
+            Indices of the bins
+        time_bins : array of datetime
+            Datetime of the beginning of each bin
+        start_samples : np.array
+            First sample of each bin
+        end_samples : np.array
+            Last sample of each bin
+        """
+        n_new = len(ids)
+        while self.n + n_new > self._capacity:
+            self._grow()
+        rows = slice(self.n, self.n + n_new)
+        self.ids[rows] = ids
+        self.datetimes[rows] = np.asarray(time_bins, dtype='datetime64[ns]')
+        self.start_samples[rows] = start_samples
+        self.end_samples[rows] = end_samples
+        self.n += n_new
+        return rows
+
+    def set(self, name, row, value):
+        """
+        Store the value of the variable name in the row. If value is None, the fill value is kept.
+        If the variable was not declared, it is created with the shape of the value (complex values keep their type)
+
+        Parameters
+        ----------
+        name : str
+            Name of the variable
+        row : int or tuple
+            Row returned by new_bin (followed by the indices of the other dimensions, if any)
+        value : scalar or array
+            Output of the bin
+        """
+        if value is not None:
+            if name not in self._data:
+                value = np.asarray(value)
+                dtype = value.dtype if value.dtype.kind == 'c' else None
+                self.add_variable(name, shape=value.shape, dtype=dtype)
+            self._data[name][row] = value
+
+    def set_bins(self, name, rows, values):
+        """
+        Store the values of a batch of bins (one per row of values). If values is None, the fill value is kept.
+        If the variable was not declared, it is created with the shape of the values of one bin (complex values keep
+        their type)
+
+        Parameters
+        ----------
+        name : str
+            Name of the variable
+        rows : slice
+            Rows returned by new_bins
+        values : array
+            Output of the bins, with the bins in the first dimension
+        """
+        if values is not None:
+            if name not in self._data:
+                values = np.asarray(values)
+                dtype = values.dtype if values.dtype.kind == 'c' else None
+                self.add_variable(name, shape=values.shape[1:], dtype=dtype)
+            self._data[name][rows] = values
+
+    def coords(self):
+        """
+        Return the coordinates depending on the bin (id, datetime, start_sample and end_sample)
+        """
+        return {'id': self.ids[:self.n],
+                'datetime': ('id', self.datetimes[:self.n]),
+                'start_sample': ('id', self.start_samples[:self.n]),
+                'end_sample': ('id', self.end_samples[:self.n])}
+
+    def to_dataarray(self, name, dims, coords=None, attrs=None):
+        """
+        Build the DataArray of the variable name with the id dimension first
+
+        Parameters
+        ----------
+        name : str
+            Name of the variable
+        dims : list of str
+            Dimensions of the output, excluding 'id'
+        coords : dict
+            Extra coordinates for the other dimensions
+        attrs : dict
+            Attributes of the DataArray
+        """
+        all_coords = self.coords()
+        if coords is not None:
+            all_coords.update(coords)
+        return xarray.DataArray(self[name], coords=all_coords, dims=['id'] + list(dims), attrs=attrs)
@@ -0,0 +1,203 @@
+__author__ = "Clea Parcerisas"
+__version__ = "0.1"
+__credits__ = "Clea Parcerisas"
+__email__ = "clea.parcerisas@vliz.be"
+__status__ = "Development"
+
+import numpy as np
+import scipy.signal as sig
+
+# Default maximum duration of an event in seconds (it also bounds the memory used by the detector)
+MAX_EVENT_DURATION = 10.0
+# Status of the candidate peaks
+UNDECIDED = -1
+REMOVED = 0
+KEPT = 1
+
+
+class StrikeDetector:
+    def __init__(self, fs, threshold, min_separation=1.0, buffer=0.2, max_duration=MAX_EVENT_DURATION,
+                 trigger='peak'):
+        """
+        Streaming detector of impulsive events (i.e. pile driving strikes). The signal is given in consecutive
+        chunks of any size, and the detector returns the events which are complete after each chunk, with the
+        samples needed to analyze them. Only the samples of the events which are not complete yet, the last
+        min_separation (where the peaks are not decided yet) and a context of twice the minimum separation (or the
+        buffer, if longer) before it are kept, so the memory does not depend on the length of the recording.
+
+        The strikes are the peaks of the trigger signal higher than threshold and separated at least min_separation
+        seconds, as scipy.signal.find_peaks with height and distance: the peaks are taken from the highest to the
+        lowest, and each one removes the lower ones closer than min_separation. With trigger='peak' the output is
+        the same as find_peaks on the whole signal, for any chunk size (peaks of exactly the same height are taken
+        from the last one, as find_peaks does for small arrays).
+        The candidate peaks (local maxima above threshold) are searched on each chunk with the context of the previous
+        one. A candidate is only decided (kept or removed) when no future peak can change it: when it is removed by a
+        kept higher peak, or when it is further than min_separation from the samples not received yet and all the
+        higher candidates closer than min_separation are decided. So a chain of increasing peaks closer than
+        min_separation keeps its candidates (and its samples) until the highest one is decided.
+        The peaks are accepted in order, so the events are not split between chunks. Each event starts buffer
+        seconds before its peak and ends where the next one starts, or after max_duration seconds.
+
+        Parameters
+        ----------
+        fs : int
+            Sample rate, in Hz
+        threshold : float
+            Minimum height of the peaks, in the units of the signal
+        min_separation : float
+            Minimum time between the peaks of two events, in seconds
+        buffer : float
+            Time before the peak where the event starts, in seconds
+        max_duration : float or None
+            Maximum duration of an event, in seconds. If None, the events last until the next one starts (and all
+            the samples between two events are kept in memory)
+        trigger : str
+            'peak' to detect on the signal, or 'envelope' to detect on its envelope (absolute value of the analytic
+            signal)
+        """
+        if trigger not in ['peak', 'envelope']:
+            raise ValueError('Trigger %s is not supported, it has to be peak or envelope' % trigger)
+        self.fs = fs
+        self.threshold = threshold
+        self.trigger = trigger
+        self.distance = max(1, int(round(min_separation * fs)))
+        self.buffer_samples = int(buffer * fs)
+        self.max_samples = None if max_duration is None else int(max_duration * fs)
+        # Samples kept before the last decided one, to find the peaks near it and the start of the next event
+        self._context = max(2 * self.distance, self.buffer_samples)
+        # Samples kept, and position of the first one in the whole signal
+        self._signal = np.zeros(0)
+        self._offset = 0
+        # Number of samples received, samples where the candidate peaks are already searched and start of the event
+        # waiting for its end
+        self.n = 0
+        self._searched = 0
+        self._pending = None
+        # Candidate peaks which are not decided or accepted yet, or which can still remove a future candidate:
+        # position in the whole signal, height, status and if they are done (accepted and returned, or removed)
+        self._positions = np.zeros(0, dtype=np.int64)
+        self._heights = np.zeros(0)
+        self._status = np.zeros(0, dtype=np.int8)
+        self._done = np.zeros(0, dtype=bool)
+
+    def _trigger_values(self, signal):
+        if self.trigger == 'envelope':
+            return np.abs(sig.hilbert(signal))
+        return signal
+
+    def _new_peaks(self, final):
+        """
+        Return the peaks (positions in the whole signal) accepted with the samples received
+        """
+        limit = self.n if final else self.n - self.distance
+        if limit > self._searched:
+            context_start = max(self._offset, self._searched - self._context)
+            values = self._trigger_values(self._signal[context_start - self._offset:])
+            peaks, properties = sig.find_peaks(values, height=self.threshold)
+            peaks = peaks + context_start
+            new = (peaks >= self._searched) & (peaks < limit)
+            self._positions = np.concatenate([self._positions, peaks[new]])
+            self._heights = np.concatenate([self._heights, properties['peak_heights'][new]])
+            self._status = np.concatenate([self._status, np.full(new.sum(), UNDECIDED, dtype=np.int8)])
+            self._done = np.concatenate([self._done, np.zeros(new.sum(), dtype=bool)])
+            self._searched = limit
+        self._decide(None if final else limit)
+
+        # Accept the kept peaks in order, up to the first undecided candidate
+        undecided = self._positions[self._status == UNDECIDED]
+        first_undecided = undecided[0] if undecided.size > 0 else self._searched
+        accept = (self._status == KEPT) & (~self._done) & (self._positions < first_undecided)
+        self._done |= accept | ((self._status == REMOVED) & (self._positions < first_undecided))
+        accepted = list(self._positions[accept])
+
+        # Forget the candidates which can not remove any undecided or future candidate
+        keep = (~self._done) | (self._positions > min(first_undecided, self._searched) - self.distance)
+        self._positions, self._heights = self._positions[keep], self._heights[keep]
+        self._status, self._done = self._status[keep], self._done[keep]
+        return accepted
+
+    def _decide(self, limit):
+        """
+        Decide the candidates which can not change anymore, going from the highest to the lowest as find_peaks does.
+        limit is the first sample where new candidates can appear (None if the signal is finished)
+        """
+        # Descending height, and the last peak first for equal heights
+        order = np.lexsort((self._positions, self._heights))[::-1]
+        rank = np.empty(order.size, dtype=np.int64)
+        rank[order] = np.arange(order.size)
+        lows = np.searchsorted(self._positions, self._positions - self.distance, side='right')
+        highs = np.searchsorted(self._positions, self._positions + self.distance, side='left')
+        for j in order:
+            if self._status[j] != UNDECIDED:
+                continue
+            window = slice(lows[j], highs[j])
+            higher = self._status[window][rank[window] < rank[j]]
+            if np.any(higher == KEPT):
+                self._status[j] = REMOVED
+            elif np.any(higher == UNDECIDED):
+                continue
+            elif limit is None or self._positions[j] <= limit - self.distance:
+                # No future candidate can be closer than min_separation
+                self._status[j] = KEPT
+
+    def _close_events(self, peaks, final):
+        """
+        Return the starts and ends of the events completed by the new peaks
+        """
+        starts, ends = [], []
+        for peak in peaks:
+            start = max(peak - self.buffer_samples, self._offset)
+            if self._pending is not None:
+                starts.append(self._pending)
+                ends.append(start if self.max_samples is None else min(start, self._pending + self.max_samples))
+            self._pending = start
+        if self._pending is not None:
+            end = None
+            if self.max_samples is not None and self._pending + self.max_samples <= self.n:
+                end = self._pending + self.max_samples
+            elif final:
+                end = self.n
+            if end is not None:
+                starts.append(self._pending)
+                ends.append(end)
+                self._pending = None
+        return np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+    def process(self, chunk, final=False):
+        """
+        Add the next chunk of the signal and return the events completed
+
+        Parameters
+        ----------
+        chunk : 1D numpy array
+            Next samples of the signal
+        final : bool
+            Set to True if it is the last chunk, to close the last event (at the end of the signal)
+
+        Returns
+        -------
+        starts, ends, signal, offset. starts and ends are the first and last (excluded) sample of each event in the
+        whole signal, and signal the samples kept from sample offset, which contain all the events
+        """
+        self._signal = np.concatenate([self._signal, chunk])
+        self.n += len(chunk)
+        peaks = self._new_peaks(final)
+        starts, ends = self._close_events(peaks, final)
+        signal, offset = self._signal, self._offset
+
+        # Forget the samples which are not needed anymore
+        keep_from = self._searched - self._context
+        if self._pending is not None:
+            keep_from = min(keep_from, self._pending)
+        if not self._done.all():
+            keep_from = min(keep_from, self._positions[~self._done][0] - self.buffer_samples)
+        keep_from = min(max(keep_from, self._offset), self.n)
+        self._signal = self._signal[keep_from - self._offset:]
+        self._offset = keep_from
+        return starts, ends, signal, offset
+
+    def finish(self):
+        """
+        Decide the last peaks and close the last event. Returns the same as process
+        """
+        return self.process(np.zeros(0), final=True)
@@ -4,12 +4,18 @@ __credits__ = "Clea Parcerisas"
 __email__ = "clea.parcerisas@vliz.be"
 __status__ = "Development"
 
-from pypam.signal import Signal
+import numba as nb
 import numpy as np
+import xarray
+
+from pypam import signal as sig
+from pypam.signal import Signal
+from pypam import utils
+from pypam import units as output_units
 
 
 class Event(Signal):
-    def __init__(self, total_signal, fs, start=None, end=None):
+    def __init__(self, total_signal, fs, start=None, end=None, energy_index=None):
         """
         Definition of an acoustic event
 
@@ -20,13 +26,20 @@ class Event(Signal):
         start :
         fs : int
             Sample rate, in Hz
+        energy_index : utils.EnergyIndex or None
+            Energy index of total_signal. If given, the energy windows, rms and SEL of the event are computed from it
+            (see utils.EnergyIndex), which is faster when many events of the same signal are analyzed
         """
         signal = total_signal[start:end]
         self._total_signal = total_signal
         self.start = start
         self.end = end
+        self.energy_index = energy_index
         super().__init__(signal, fs)
 
+    def _energy_offset(self):
+        return 0 if self.start is None else self.start
+
     def cut(self, start=0, end=None):
         """
         Cut the signal
@@ -58,9 +71,12 @@ class Event(Signal):
 
         if impulsive:
             windowStr = str(int(energy_window*100))
-            rms = self.rms(energy_window=energy_window)
-            sel = super(Event, self).sel()
-            tau = self.pulse_width(energy_window)
+            rms = self.rms(energy_window=energy_window, energy_index=self.energy_index)
+            if self.energy_index is None:
+                sel = super(Event, self).sel()
+            else:
+                sel = utils.to_db(self.energy_index.sel(self.start, self.end, self.fs), square=False)
+            tau = self.pulse_width(energy_window, energy_index=self.energy_index)
 
         else:
             windowStr = ''
@@ -98,11 +114,9 @@ class Event(Signal):
 
         # Compute the cut level
         cut_level = peak / (10 ** (diff_db / 10))
-        cut_end = np.argwhere(self._total_signal[cut_start+self.start::] < cut_level)
-        if len(cut_end) == 0:
-            cut_end = self.end
-        else:
-            cut_end = cut_end[0][0] + self.start + cut_start
+        cut_end = _first_below(self._total_signal, cut_start + self.start, cut_level, self.end)
+        if self.energy_index is not None:
+            return utils.to_db(self.energy_index.sel(cut_start + self.start, cut_end, self.fs), square=False)
         # Reasign signal to the new part and compute SEL
         self.signal = self._total_signal[cut_start+self.start:cut_end]
         sel = super(Event, self).sel()
@@ -110,3 +124,152 @@ class Event(Signal):
         # Go back to the previous signal
         self.signal = self._total_signal[self.start:self.end]
         return sel
+
+
+def analyze_events(total_signal, fs, starts, ends, impulsive=False, energy_window=0.9, energy_index=None):
+    """
+    Perform the calculations of Event.analyze for many events of the same signal at once, without creating one
+    Event per event. The energy of all the events (sel, rms and pulse width) is computed from one energy index of
+    the signal (see utils.EnergyIndex), where the energy windows are found with a binary search. The peak and the
+    kurtosis are computed in one pass over the samples of each event
+
+    Parameters
+    ----------
+    total_signal : 1D numpy array
+        Signal containing the events, in upa
+    fs : int
+        Sample rate, in Hz
+    starts : array of int
+        First sample of each event
+    ends : array of int
+        End (excluded) of each event
+    impulsive : bool
+        whether or not the analysis should perform impulsive metrics
+    energy_window: float
+        If impulsive, calculate relevant metrics over the given energy window (e.g. RMS_90 for energy_window= .9).
+    energy_index : utils.EnergyIndex or None
+        Energy index of total_signal. If None, it is computed
+
+    Returns
+    -------
+    dictionary of arrays (one value per event) with the keys of Event.analyze: startTime, peak, rms, sel, tau,
+    kurtosis
+    """
+    total_signal = np.asarray(total_signal)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    if energy_index is None:
+        energy_index = utils.EnergyIndex(total_signal)
+    peak, kurtosis = utils.events_peak_kurtosis(total_signal, starts, ends)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if impulsive:
+            window_str = str(int(energy_window * 100))
+            windows = energy_index.windows(starts, ends, energy_window) + starts[:, np.newaxis]
+            rms = np.sqrt(energy_index.energy(windows[:, 0], windows[:, 1]) / (windows[:, 1] - windows[:, 0]))
+            sel = energy_index.sel(starts, ends, fs)
+            tau = (windows[:, 1] - windows[:, 0]) / fs
+        else:
+            window_str = ''
+            rms = np.sqrt(energy_index.energy(starts, ends) / (ends - starts))
+            if energy_index.block_size == 1:
+                sel = _peak_cut_sel(total_signal, energy_index.cumulative, fs, starts, ends)
+            else:
+                cut_starts, cut_ends = _peak_cuts(total_signal, starts, ends)
+                sel = energy_index.sel(cut_starts, cut_ends, fs)
+            tau = (ends - starts) / fs
+
+        return {'startTime': starts / fs,
+                'peak': utils.to_db(peak, square=True),
+                f'rms{window_str}': utils.to_db(rms, ref=1.0, square=True),
+                'sel': utils.to_db(sel, square=False),
+                'tau': tau,
+                'kurtosis': kurtosis}
+
+
+def decidecade_sel_events(total_signal, fs, starts, ends, nfft=None, min_freq=None, max_freq=None,
+                          datetimes=None, p_ref=1.0):
+    """
+    Compute the decidecade band SEL spectra of many events of the same signal at once, as Signal.decidecade_sel of
+    each event, with batched ffts (see signal.events_decidecade_sel)
+
+    Parameters
+    ----------
+    total_signal : 1D numpy array
+        Signal containing the events, in upa
+    fs : int
+        Sample rate, in Hz
+    starts : array of int
+        First sample of each event
+    ends : array of int
+        End (excluded) of each event
+    nfft : int or None
+        Length of the fft of all the events (at least the length of the longest). If None, each event is padded
+        to the next power of 2 of its length
+    min_freq : float or None
+        Minimum frequency of the bands. If None, the frequency resolution of the longest event
+    max_freq : float or None
+        Maximum frequency of the bands. If None, the nyquist frequency
+    datetimes : array of datetime or None
+        Datetime of each event, added as coordinate
+    p_ref : float
+        Reference pressure in upa
+
+    Returns
+    -------
+    DataArray (id x frequency) with the SEL of each event and band in db
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    (centers, lows, highs), sel = sig.events_decidecade_sel(total_signal, fs, starts, ends, nfft=nfft,
+                                                            min_freq=min_freq, max_freq=max_freq)
+    coords = {'id': np.arange(starts.size),
+              'frequency': centers,
+              'lower_frequency': ('frequency', lows),
+              'upper_frequency': ('frequency', highs),
+              'start_sample': ('id', starts),
+              'end_sample': ('id', ends)}
+    if datetimes is not None:
+        coords['datetime'] = ('id', np.asarray(datetimes))
+    return xarray.DataArray(sel, coords=coords, dims=['id', 'frequency'],
+                            attrs=output_units.get_units_attrs(method_name='sel', log=True, p_ref=p_ref))
+
+
+@nb.njit
+def _first_below(total_signal, start, level, default):
+    """
+    First sample from start where the signal is lower than level (default if there is none)
+    """
+    for k in range(start, total_signal.size):
+        if total_signal[k] < level:
+            return k
+    return default
+
+
+def _peak_cut_sel(total_signal, cumulative, fs, starts, ends, diff_db=10):
+    """
+    SEL of each event as Event.sel: from its maximum until the signal drops diff_db below it (or the end of the event
+    if it does not), from the prefix sums of the squared signal (see utils.cumulative_energy)
+    """
+    cut_starts, cut_ends = _peak_cuts(total_signal, starts, ends, diff_db)
+    sel = (cumulative[cut_ends] - cumulative[cut_starts]) / fs
+    sel[ends <= starts] = np.nan
+    return sel
+
+
+@nb.njit
+def _peak_cuts(total_signal, starts, ends, diff_db=10):
+    """
+    Interval of each event used by Event.sel: from its maximum until the signal drops diff_db below it (or the end
+    of the event if it does not)
+    """
+    cut_starts = np.zeros(starts.size, dtype=np.int64)
+    cut_ends = np.zeros(starts.size, dtype=np.int64)
+    for i in range(starts.size):
+        if ends[i] <= starts[i]:
+            cut_starts[i] = starts[i]
+            cut_ends[i] = starts[i]
+            continue
+        cut_starts[i] = starts[i] + np.argmax(total_signal[starts[i]:ends[i]])
+        cut_level = total_signal[cut_starts[i]] / (10 ** (diff_db / 10))
+        cut_ends[i] = _first_below(total_signal, cut_starts[i], cut_level, ends[i])
+    return cut_starts, cut_ends
@@ -0,0 +1,523 @@
+__author__ = "Clea Parcerisas"
+__version__ = "0.1"
+__credits__ = "Clea Parcerisas"
+__email__ = "clea.parcerisas@vliz.be"
+__status__ = "Development"
+
+import numpy as np
+import pandas as pd
+import xarray
+
+from pypam import _checkpoint
+from pypam import _sketch
+
+# Default time resolution of the accumulated energy. The windows of SELcum are multiples of it
+RESOLUTION = '1min'
+# Label of the strikes which are not assigned to a pile
+DEFAULT_PILE = 'unknown'
+
+
+class ExposureAccumulator:
+    def __init__(self, resolution=RESOLUTION, k=_sketch.SKETCH_K, seed=None):
+        """
+        Streaming accumulator of the exposure to impulsive sounds (i.e. the strikes of a piling campaign). The SEL and
+        peak of each strike are added as they are computed, and only the energy, the number of strikes and the
+        maximum peak of each pile and time bin of length resolution are kept (plus the energy of each decidecade
+        band, if given). From them the cumulative SEL (SELcum) of any calendar or rolling window multiple of the
+        resolution and of each pile can be computed. The distribution of the single strike levels of each pile is
+        kept in a quantile sketch (see _sketch.QuantileSketch), to compute their percentiles.
+        The memory used depends on the number of time bins with strikes, not on the number of strikes. Accumulators
+        of different files (i.e. computed in parallel) can be merged, and the state can be saved and loaded to
+        resume a campaign (see save and load). The strikes can be added with the id of their source (i.e. the
+        shard key of the file they come from, see _checkpoint.shard_key): the ids are kept in sources, and the
+        strikes of a source which was already added are skipped, so resuming a campaign does not count them twice.
+
+        Parameters
+        ----------
+        resolution : str or pd.Timedelta
+            Length of the time bins where the energy is accumulated
+        k : int
+            Size of the quantile sketches
+        seed : int or None
+            Seed of the quantile sketches
+        """
+        self.resolution = pd.Timedelta(resolution)
+        self._step = self.resolution.value
+        self.k = k
+        self.seed = seed
+        self.piles = []
+        self.frequency = None
+        self.lower_frequency = None
+        self.upper_frequency = None
+        # Attributes (units) of the sel, peak and band_sel of the strikes
+        self.attrs = {}
+        # Row of each (pile index, time bin), and per row: pile index, start of the time bin (in ns), energy, number
+        # of strikes, maximum peak and energy of each band
+        self._rows = {}
+        self.n_rows = 0
+        self._pile = np.zeros(0, dtype=np.int64)
+        self._time = np.zeros(0, dtype=np.int64)
+        self._energy = np.zeros(0)
+        self._strikes = np.zeros(0, dtype=np.int64)
+        self._peak = np.zeros(0)
+        self._band_energy = np.zeros((0, 0))
+        # Sketch of the sel, the peak and the sel of each band of the strikes of each pile
+        self.sketches = {}
+        # Ids of the sources (i.e. files) already added
+        self.sources = set()
+
+    @property
+    def n_bands(self):
+        return 0 if self.frequency is None else self.frequency.size
+
+    def _pile_index(self, pile):
+        pile = str(pile)
+        if pile not in self.piles:
+            self.piles.append(pile)
+            self.sketches[pile] = _sketch.QuantileSketch(k=self.k, seed=self.seed)
+        return self.piles.index(pile)
+
+    def _set_bands(self, frequency, lower_frequency, upper_frequency):
+        """
+        Set the decidecade bands of the band sel (all the strikes need the same ones)
+        """
+        frequency = np.asarray(frequency, dtype=float)
+        if self.frequency is None:
+            if self.n_rows > 0:
+                raise ValueError('The band sel has to be given since the first strikes')
+            self.frequency = frequency
+            self.lower_frequency = None if lower_frequency is None else np.asarray(lower_frequency, dtype=float)
+            self.upper_frequency = None if upper_frequency is None else np.asarray(upper_frequency, dtype=float)
+            self._band_energy = np.zeros((self._energy.size, frequency.size))
+        elif not np.array_equal(frequency, self.frequency):
+            raise ValueError('All the band sel added need the same frequencies')
+
+    def _grow(self, n_rows):
+        """
+        Grow the buffers of the rows (doubling their size) to fit n_rows
+        """
+        capacity = self._energy.size
+        if n_rows <= capacity:
+            return
+        new_capacity = max(n_rows, 2 * capacity, 16)
+        extra = new_capacity - capacity
+        self._pile = np.concatenate([self._pile, np.zeros(extra, dtype=np.int64)])
+        self._time = np.concatenate([self._time, np.zeros(extra, dtype=np.int64)])
+        self._energy = np.concatenate([self._energy, np.zeros(extra)])
+        self._strikes = np.concatenate([self._strikes, np.zeros(extra, dtype=np.int64)])
+        self._peak = np.concatenate([self._peak, np.full(extra, -np.inf)])
+        self._band_energy = np.concatenate([self._band_energy, np.zeros((extra, self.n_bands))])
+
+    def _row_indices(self, piles, times):
+        """
+        Return the row of each (pile index, time bin), adding the new ones
+        """
+        rows = np.zeros(times.size, dtype=np.int64)
+        for i, key in enumerate(zip(piles.tolist(), times.tolist())):
+            row = self._rows.get(key)
+            if row is None:
+                row = self.n_rows
+                self._rows[key] = row
+                self.n_rows += 1
+            rows[i] = row
+        self._grow(self.n_rows)
+        self._pile[rows] = piles
+        self._time[rows] = times
+        return rows
+
+    def _add_rows(self, piles, times, energy, strikes, peak, band_energy):
+        """
+        Add the energy, strikes, maximum peak and band energy of some (pile index, time bin)
+        """
+        keys, inverse = np.unique(np.stack([piles, times]), axis=1, return_inverse=True)
+        inverse = inverse.ravel()
+        rows = self._row_indices(keys[0], keys[1])
+        self._energy[rows] += np.bincount(inverse, weights=energy, minlength=rows.size)
+        self._strikes[rows] += np.bincount(inverse, weights=strikes, minlength=rows.size).astype(np.int64)
+        np.maximum.at(self._peak, rows[inverse], peak)
+        for band in range(self.n_bands):
+            self._band_energy[rows, band] += np.bincount(inverse, weights=band_energy[:, band], minlength=rows.size)
+
+    def add(self, datetimes, sel, peak, pile=DEFAULT_PILE, band_sel=None, frequency=None, lower_frequency=None,
+            upper_frequency=None, source=None):
+        """
+        Add some strikes
+
+        Parameters
+        ----------
+        datetimes : array of datetime
+            Time of each strike (naive, in UTC)
+        sel : array of float
+            SEL of each strike, in db
+        peak : array of float
+            Peak level of each strike, in db
+        pile : str
+            Pile of the strikes
+        band_sel : 2D array or None
+            SEL of each strike (rows) in each decidecade band, in db (i.e. output of signal.events_decidecade_sel).
+            If the accumulator has bands, it is needed
+        frequency : array or None
+            Centre frequency of the bands of band_sel
+        lower_frequency : array or None
+            Lower limit of the bands
+        upper_frequency : array or None
+            Upper limit of the bands
+        source : str or None
+            Id of the source of the strikes (i.e. the file). If it was already added, the strikes are skipped
+        """
+        if source is not None and source in self.sources:
+            print('The strikes of %s were already added, skipping them' % source)
+            return self
+        times = pd.to_datetime(np.asarray(datetimes)).values.astype('datetime64[ns]').astype(np.int64)
+        sel = np.asarray(sel, dtype=float).ravel()
+        peak = np.asarray(peak, dtype=float).ravel()
+        if not (times.size == sel.size == peak.size):
+            raise ValueError('datetimes, sel and peak need the same number of strikes')
+        if band_sel is not None:
+            if frequency is None:
+                raise ValueError('The frequencies of the band sel are needed')
+            self._set_bands(frequency, lower_frequency, upper_frequency)
+            band_sel = np.asarray(band_sel, dtype=float).reshape(sel.size, self.n_bands)
+        elif self.n_bands > 0:
+            raise ValueError('This accumulator has band sel, so they are needed for all the strikes')
+        else:
+            band_sel = np.zeros((sel.size, 0))
+        if source is not None:
+            self.sources.add(source)
+        if sel.size == 0:
+            return self
+
+        pile_index = self._pile_index(pile)
+        self.sketches[str(pile)].add(np.column_stack([sel, peak, band_sel]), axis=0)
+        # Strikes without a valid sel are counted but they do not add energy
+        energy = np.nan_to_num(10 ** (sel / 10), nan=0.0)
+        band_energy = np.nan_to_num(10 ** (band_sel / 10), nan=0.0)
+        bins = np.floor_divide(times, self._step) * self._step
+        self._add_rows(np.full(sel.size, pile_index), bins, energy, np.ones(sel.size), np.nan_to_num(peak, nan=-np.inf),
+                       band_energy)
+        return self
+
+    def add_events(self, events, pile=DEFAULT_PILE, band_sel='band_sel', source=None):
+        """
+        Add the strikes of an events Dataset (output of AcuFile.impulsive_events)
+
+        Parameters
+        ----------
+        events : xarray Dataset
+            Events with the variables sel and peak (in db) and the coordinate datetime, along id
+        pile : str
+            Pile of the strikes
+        band_sel : str
+            Name of the variable with the decidecade band sel (id, frequency), if there is one
+        source : str or None
+            Id of the source of the events (see add)
+        """
+        for name in ['sel', 'peak', band_sel]:
+            if name in events.data_vars and name not in self.attrs:
+                self.attrs[name] = dict(events[name].attrs)
+        kwargs = {}
+        if band_sel in events.data_vars:
+            bands = events[band_sel].transpose('id', 'frequency')
+            kwargs = {'band_sel': bands.to_numpy(), 'frequency': bands['frequency'].values}
+            for limit in ['lower_frequency', 'upper_frequency']:
+                if limit in bands.coords:
+                    kwargs[limit] = bands[limit].values
+        return self.add(events['datetime'].values, events['sel'].values, events['peak'].values, pile=pile,
+                        source=source, **kwargs)
+
+    def merge(self, other):
+        """
+        Add all the strikes of another accumulator (i.e. computed in another process) to this one. If all the
+        sources of other were already added to this one, it is skipped. The strikes are not kept per source, so
+        accumulators which share only some of their sources can not be merged
+
+        Parameters
+        ----------
+        other : ExposureAccumulator
+            Accumulator with the same resolution (and bands, if any)
+        """
+        if other.resolution != self.resolution:
+            raise ValueError('Only accumulators with the same resolution can be merged (%s and %s)' %
+                             (self.resolution, other.resolution))
+        shared = other.sources & self.sources
+        if len(shared) > 0:
+            if shared == other.sources:
+                print('All the sources of the accumulator were already added, skipping it')
+                return self
+            raise ValueError('The accumulators share some of their sources (%s), so they can not be merged' %
+                             ', '.join(sorted(shared)))
+        if other.n_rows == 0:
+            self.sources.update(other.sources)
+            return self
+        if other.frequency is not None:
+            self._set_bands(other.frequency, other.lower_frequency, other.upper_frequency)
+        elif self.n_bands > 0:
+            raise ValueError('Only accumulators with the same bands can be merged')
+        for name, attrs in other.attrs.items():
+            self.attrs.setdefault(name, dict(attrs))
+        pile_map = np.array([self._pile_index(pile) for pile in other.piles], dtype=np.int64)
+        for pile in other.piles:
+            self.sketches[pile].merge(other.sketches[pile])
+        self.sources.update(other.sources)
+        n = other.n_rows
+        self._add_rows(pile_map[other._pile[:n]], other._time[:n], other._energy[:n], other._strikes[:n],
+                       other._peak[:n], other._band_energy[:n])
+        return self
+
+    def _select(self, pile):
+        """
+        Return the filled rows of pile (all the piles if None)
+        """
+        rows = np.arange(self.n_rows)
+        if pile is not None:
+            if str(pile) not in self.piles:
+                raise ValueError('There are no strikes of pile %s' % pile)
+            rows = rows[self._pile[rows] == self.piles.index(str(pile))]
+        return rows
+
+    def _window_steps(self, window):
+        window = pd.Timedelta(window)
+        if window.value % self._step != 0:
+            raise ValueError('The window %s has to be a multiple of the resolution %s' % (window, self.resolution))
+        return window.value // self._step
+
+    def _to_dataset(self, dim, coord, energy, strikes, peak, band_energy, coords=None):
+        """
+        Build the output Dataset from the accumulated values (energy to db)
+        """
+        with np.errstate(divide='ignore'):
+            selcum = np.where(energy > 0, 10 * np.log10(energy), np.nan)
+            band_selcum = np.where(band_energy > 0, 10 * np.log10(band_energy), np.nan)
+        ds = xarray.Dataset(coords={dim: coord})
+        if coords is not None:
+            ds = ds.assign_coords(coords)
+        ds['selcum'] = (dim, selcum, self.attrs.get('sel', {}))
+        ds['strikes'] = (dim, strikes)
+        ds['peak'] = (dim, np.where(np.isfinite(peak), peak, np.nan), self.attrs.get('peak', {}))
+        if self.n_bands > 0:
+            ds = ds.assign_coords(frequency=self.frequency)
+            if self.lower_frequency is not None:
+                ds = ds.assign_coords(lower_frequency=('frequency', self.lower_frequency),
+                                      upper_frequency=('frequency', self.upper_frequency))
+            ds['band_selcum'] = ((dim, 'frequency'), band_selcum, self.attrs.get('band_sel', {}))
+        ds.attrs['resolution'] = str(self.resolution)
+        return ds
+
+    def _group(self, rows, groups, n_groups):
+        """
+        Add the values of the rows in each group
+        """
+        energy = np.bincount(groups, weights=self._energy[rows], minlength=n_groups)
+        strikes = np.bincount(groups, weights=self._strikes[rows], minlength=n_groups).astype(np.int64)
+        peak = np.full(n_groups, -np.inf)
+        np.maximum.at(peak, groups, self._peak[rows])
+        band_energy = np.zeros((n_groups, self.n_bands))
+        for band in range(self.n_bands):
+            band_energy[:, band] = np.bincount(groups, weights=self._band_energy[rows, band], minlength=n_groups)
+        return energy, strikes, peak, band_energy
+
+    def selcum(self, window='24h', rolling=False, pile=None):
+        """
+        Cumulative SEL (and number of strikes, maximum peak and band SELcum) over time windows.
+        With calendar windows (rolling=False) the strikes are grouped in consecutive windows starting at the epoch
+        (i.e. UTC days for 24h), and the output has one value per window with strikes, at its start.
+        With rolling windows the output has one value per time bin with strikes, for the window which ends at the
+        end of the bin, so the maximum over datetime is the worst window of the campaign (with the precision of the
+        resolution)
+
+        Parameters
+        ----------
+        window : str or pd.Timedelta
+            Length of the windows. It has to be a multiple of the resolution
+        rolling : bool
+            Set to True for rolling windows, False for calendar windows
+        pile : str or None
+            Pile to compute the SELcum of. If None, all the strikes
+
+        Returns
+        -------
+        xarray Dataset with the variables selcum, strikes, peak and band_selcum (if there are bands) along datetime
+        """
+        steps = self._window_steps(window)
+        rows = self._select(pile)
+        bins, groups = np.unique(self._time[rows], return_inverse=True)
+        energy, strikes, peak, band_energy = self._group(rows, groups.ravel(), bins.size)
+        if rolling:
+            # Windows (end - window, end], with end the end of each time bin with strikes
+            cumulative = [np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)])
+                          for values in [energy, strikes, band_energy]]
+            first = np.searchsorted(bins, bins + self._step * (1 - steps))
+            last = np.arange(1, bins.size + 1)
+            energy, strikes, band_energy = [c[last] - c[first] for c in cumulative]
+            strikes = np.rint(strikes).astype(np.int64)
+            peak = np.array([peak[i:j].max() if j > i else -np.inf for i, j in zip(first, last)])
+            datetimes = bins + self._step
+        else:
+            windows, groups = np.unique(np.floor_divide(bins, steps * self._step), return_inverse=True)
+            groups = groups.ravel()
+            n_windows = windows.size
+            strikes_w = np.bincount(groups, weights=strikes, minlength=n_windows).astype(np.int64)
+            peak_w = np.full(n_windows, -np.inf)
+            np.maximum.at(peak_w, groups, peak)
+            band_w = np.zeros((n_windows, self.n_bands))
+            for band in range(self.n_bands):
+                band_w[:, band] = np.bincount(groups, weights=band_energy[:, band], minlength=n_windows)
+            energy = np.bincount(groups, weights=energy, minlength=n_windows)
+            strikes, peak, band_energy = strikes_w, peak_w, band_w
+            datetimes = windows * steps * self._step
+        ds = self._to_dataset('datetime', datetimes.astype('datetime64[ns]'), energy, strikes, peak, band_energy)
+        ds.attrs.update({'window': str(pd.Timedelta(window)), 'rolling': int(rolling)})
+        return ds
+
+    def pile_totals(self):
+        """
+        Cumulative SEL, number of strikes, maximum peak and band SELcum of each pile, with the time of its first and
+        last strike (with the precision of the resolution)
+
+        Returns
+        -------
+        xarray Dataset along pile
+        """
+        rows = self._select(None)
+        groups = self._pile[rows]
+        n_piles = len(self.piles)
+        energy, strikes, peak, band_energy = self._group(rows, groups, n_piles)
+        start = np.full(n_piles, np.iinfo(np.int64).max)
+        end = np.full(n_piles, np.iinfo(np.int64).min)
+        np.minimum.at(start, groups, self._time[rows])
+        np.maximum.at(end, groups, self._time[rows] + self._step)
+        coords = {'start': ('pile', start.astype('datetime64[ns]')), 'end': ('pile', end.astype('datetime64[ns]'))}
+        return self._to_dataset('pile', self.piles, energy, strikes, peak, band_energy, coords=coords)
+
+    def percentiles(self, percentiles, per_pile=False):
+        """
+        Percentiles of the single strike levels (sel, peak and band sel), from the quantile sketches. The bound of
+        the rank error (see _sketch.QuantileSketch.rank_error) is stored in the attributes
+
+        Parameters
+        ----------
+        percentiles : list
+            Percentiles to compute (in 100 per cent)
+        per_pile : bool
+            Set to True to compute them for each pile, False for all the strikes
+
+        Returns
+        -------
+        xarray Dataset with sel_percentiles, peak_percentiles and band_sel_percentiles (if there are bands)
+        """
+        if per_pile:
+            sketches = [self.sketches[pile] for pile in self.piles]
+        else:
+            sketch = _sketch.QuantileSketch(k=self.k, seed=self.seed)
+            for pile in self.piles:
+                sketch.merge(self.sketches[pile])
+            sketches = [sketch]
+        if any(sketch.shape is None for sketch in sketches):
+            raise ValueError('No strikes have been added to the accumulator')
+        values = np.stack([sketch.percentiles(percentiles) for sketch in sketches])
+        ds = xarray.Dataset(coords={'pile': self.piles if per_pile else ['all'], 'percentiles': percentiles})
+        ds['sel_percentiles'] = (('pile', 'percentiles'), values[:, 0], self.attrs.get('sel', {}))
+        ds['peak_percentiles'] = (('pile', 'percentiles'), values[:, 1], self.attrs.get('peak', {}))
+        if self.n_bands > 0:
+            ds = ds.assign_coords(frequency=self.frequency)
+            ds['band_sel_percentiles'] = (('pile', 'frequency', 'percentiles'), values[:, 2:],
+                                          self.attrs.get('band_sel', {}))
+        if not per_pile:
+            ds = ds.squeeze('pile', drop=True)
+        ds.attrs['rank_error'] = max(sketch.rank_error() for sketch in sketches)
+        return ds
+
+    def to_state(self):
+        """
+        Return the whole state of the accumulator as a Dataset, which can be stored in a netCDF file (see save) and
+        restored with from_state
+
+        Returns
+        -------
+        xarray Dataset
+        """
+        n = self.n_rows
+        state = xarray.Dataset(
+            {'pile_index': ('row', self._pile[:n]), 'time': ('row', self._time[:n]),
+             'energy': ('row', self._energy[:n]), 'strikes': ('row', self._strikes[:n]),
+             'peak': ('row', self._peak[:n]), 'band_energy': (('row', 'frequency'), self._band_energy[:n])},
+            coords={'pile': self.piles})
+        if self.frequency is not None:
+            state = state.assign_coords(frequency=self.frequency)
+            if self.lower_frequency is not None:
+                state['lower_frequency'] = ('frequency', self.lower_frequency)
+                state['upper_frequency'] = ('frequency', self.upper_frequency)
+        # The compactors of all the sketches, one item per column
+        items, item_pile, item_level = [np.zeros((0, 2 + self.n_bands))], [], []
+        for i, pile in enumerate(self.piles):
+            for level, level_items in enumerate(self.sketches[pile].levels):
+                items.append(level_items.T)
+                item_pile.append(np.full(level_items.shape[1], i))
+                item_level.append(np.full(level_items.shape[1], level))
+        state['sketch_items'] = (('item', 'series'), np.concatenate(items))
+        state['sketch_pile'] = ('item', np.concatenate(item_pile + [np.zeros(0, dtype=int)]))
+        state['sketch_level'] = ('item', np.concatenate(item_level + [np.zeros(0, dtype=int)]))
+        state['sketch_levels'] = ('pile', [len(self.sketches[pile].levels) for pile in self.piles])
+        state['sketch_n'] = ('pile', [self.sketches[pile].n for pile in self.piles])
+        state['sketch_compacted_weight'] = ('pile', [self.sketches[pile].compacted_weight for pile in self.piles])
+        state['sources'] = ('source', np.array(sorted(self.sources), dtype=object))
+        state.attrs = {'resolution': str(self.resolution), 'k': self.k, 'seed': self.seed, 'attrs': self.attrs}
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Restore an accumulator from the output of to_state
+
+        Parameters
+        ----------
+        state : xarray Dataset
+            Output of to_state
+        """
+        accumulator = cls(resolution=state.attrs['resolution'], k=state.attrs['k'], seed=state.attrs['seed'])
+        accumulator.attrs = dict(state.attrs['attrs'])
+        if 'sources' in state:
+            accumulator.sources = set(str(source) for source in state['sources'].values)
+        if 'frequency' in state.coords:
+            lower = state['lower_frequency'].values if 'lower_frequency' in state else None
+            upper = state['upper_frequency'].values if 'upper_frequency' in state else None
+            accumulator._set_bands(state['frequency'].values, lower, upper)
+        for i, pile in enumerate(state['pile'].values):
+            accumulator._pile_index(pile)
+            sketch = accumulator.sketches[str(pile)]
+            n_levels = int(state['sketch_levels'].values[i])
+            if n_levels > 0:
+                sketch._start((2 + accumulator.n_bands,))
+                pile_items = state['sketch_pile'].values == i
+                sketch.levels = [state['sketch_items'].values[pile_items & (state['sketch_level'].values == level)].T
+                                 for level in range(n_levels)]
+            sketch.n = int(state['sketch_n'].values[i])
+            sketch.compacted_weight = int(state['sketch_compacted_weight'].values[i])
+        if state.sizes['row'] > 0:
+            accumulator._add_rows(state['pile_index'].values, state['time'].values, state['energy'].values,
+                                  state['strikes'].values, state['peak'].values,
+                                  state['band_energy'].values.reshape(state.sizes['row'], accumulator.n_bands))
+        return accumulator
+
+    def save(self, path):
+        """
+        Save the state of the accumulator in a netCDF file (see _checkpoint.save_shard), i.e. to resume a campaign
+
+        Parameters
+        ----------
+        path : str or Path
+            File to write
+        """
+        _checkpoint.save_shard(self.to_state(), path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an accumulator saved with save
+
+        Parameters
+        ----------
+        path : str or Path
+            File written by save
+        """
+        return cls.from_state(_checkpoint.load_shard(path).load())
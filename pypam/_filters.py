@@ -0,0 +1,352 @@
+__author__ = "Clea Parcerisas"
+__version__ = "0.1"
+__credits__ = "Clea Parcerisas"
+__email__ = "clea.parcerisas@vliz.be"
+__status__ = "Development"
+
+import collections
+import functools
+import threading
+
+import numba as nb
+import numpy as np
+import scipy.signal as sig
+
+# Maximum number of filters kept in the cache
+CACHE_MAXSIZE = 512
+
+
+class FilterCache:
+    def __init__(self, maxsize=CACHE_MAXSIZE):
+        """
+        Least recently used cache of filter designs. The designs only depend on their parameters (sampling frequency,
+        band, fraction, order...), so they are computed once and shared by all the signals and files processed in
+        the same process. The cache can be pickled, so it can be sent to the worker processes.
+        A copy of the design is returned every time, so the cached arrays can not be modified by mistake (the
+        filters are small, and scipy does not accept read-only filters).
+
+        Parameters
+        ----------
+        maxsize : int
+            Maximum number of designs kept. When it is full, the least recently used design is removed
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._designs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._designs)
+
+    def __contains__(self, key):
+        return key in self._designs
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key, design):
+        """
+        Return the design stored under key. If it is not in the cache, design() is called and its output is stored
+
+        Parameters
+        ----------
+        key : hashable
+            Parameters of the design
+        design : callable
+            Function without arguments which computes the design
+        """
+        with self._lock:
+            if key in self._designs:
+                self._designs.move_to_end(key)
+                self.hits += 1
+                return _copy(self._designs[key])
+            self.misses += 1
+        value = design()
+        with self._lock:
+            self._designs[key] = value
+            self._designs.move_to_end(key)
+            while len(self._designs) > self.maxsize:
+                self._designs.popitem(last=False)
+        return _copy(value)
+
+    def update(self, other):
+        """
+        Add all the designs of another cache (i.e. the one of the main process in a worker process)
+
+        Parameters
+        ----------
+        other : FilterCache
+        """
+        with self._lock:
+            for key, value in other._designs.items():
+                self._designs[key] = value
+            while len(self._designs) > self.maxsize:
+                self._designs.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all the designs and reset the counters
+        """
+        with self._lock:
+            self._designs.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Return a dict with the hits, misses, current size and maximum size of the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._designs), 'maxsize': self.maxsize}
+
+
+# Cache shared by all the filter designs of the process
+FILTER_CACHE = FilterCache()
+
+
+def cached(design):
+    """
+    Decorator to store the outputs of the filter design function in FILTER_CACHE. The key is the name of the function
+    and its arguments, so all the arguments have to be numbers, strings, lists/tuples or numpy arrays
+    """
+    name = design.__module__ + '.' + design.__qualname__
+
+    @functools.wraps(design)
+    def cached_design(*args, **kwargs):
+        key = (name, _hashable(args), _hashable(sorted(kwargs.items())))
+        return FILTER_CACHE.get(key, lambda: design(*args, **kwargs))
+
+    return cached_design
+
+
+@cached
+def butter(band, fs, order, output='sos'):
+    """
+    Return the butterworth filter for the specified band. If the lower limit is None or 0, a low-pass filter is
+    designed, if the upper limit is None or the nyquist frequency a high-pass filter. Otherwise, a band-pass filter.
+
+    Parameters
+    ----------
+    band : tuple or list
+        [low_freq, high_freq], band to be filtered
+    fs : float
+        Sampling frequency
+    order : int
+        Order of the filter
+    output : str
+        'sos', 'ba' or 'zpk' (see scipy.signal.butter)
+    """
+    if band[0] is None or band[0] == 0:
+        return sig.butter(N=order, btype='lowpass', Wn=band[1], analog=False, output=output, fs=fs)
+    elif band[1] is None or band[1] == fs / 2:
+        return sig.butter(N=order, btype='highpass', Wn=band[0], analog=False, output=output, fs=fs)
+    else:
+        return sig.butter(N=order, btype='bandpass', Wn=list(band), analog=False, output=output, fs=fs)
+
+
+@cached
+def decimation_sos(q, dtype):
+    """
+    Return the anti-aliasing filter used by scipy.signal.decimate (iir) for the factor q
+
+    Parameters
+    ----------
+    q : int
+        Downsampling factor
+    dtype : str
+        Float type of the signal
+    """
+    return np.asarray(sig.cheby1(8, 0.05, 0.8 / q, output='sos'), dtype=dtype)
+
+
+@cached
+def resampling_fir(up, down, dtype):
+    """
+    Return the low-pass FIR filter used by scipy.signal.resample_poly for the factors up and down
+
+    Parameters
+    ----------
+    up : int
+        Upsampling factor
+    down : int
+        Downsampling factor
+    dtype : str
+        Float type of the signal
+    """
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    return sig.firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0)).astype(dtype)
+
+
+def decimate(x, q=2):
+    """
+    Same as scipy.signal.decimate(x, q) (iir, zero phase) but with the filter taken from the cache
+
+    Parameters
+    ----------
+    x : numpy array
+        Signal. If it has more than one dimension, it is decimated along the last axis
+    q : int
+        Downsampling factor
+    """
+    x = np.asarray(x)
+    dtype = x.dtype if np.issubdtype(x.dtype, np.inexact) and x.dtype != np.float16 else np.dtype(np.float64)
+    y = sig.sosfiltfilt(decimation_sos(q, dtype.name), x)
+    return y[..., ::q]
+
+
+def resample_poly(x, up, down):
+    """
+    Same as scipy.signal.resample_poly(x, up, down) but with the FIR filter taken from the cache
+
+    Parameters
+    ----------
+    x : numpy array
+        Signal
+    up : int
+        Upsampling factor
+    down : int
+        Downsampling factor
+    """
+    x = np.asarray(x)
+    g = np.gcd(up, down)
+    up, down = int(up // g), int(down // g)
+    if up == down == 1:
+        return x.copy()
+    return sig.resample_poly(x, up=up, down=down, window=resampling_fir(up, down, x.dtype.name))
+
+
+class StreamResampler:
+    def __init__(self, up, down, dtype=np.float64):
+        """
+        Polyphase resampler (same filter as scipy.signal.resample_poly) for a signal given in consecutive blocks.
+        The end of each block is kept for the next one, so the output of all the blocks is the same as resampling
+        the continuous signal. The filter is centered, so the last output samples of each block need the first
+        samples of the next block (lookahead)
+
+        Parameters
+        ----------
+        up : int
+            Upsampling factor
+        down : int
+            Downsampling factor
+        dtype : numpy dtype
+            Float type of the signal
+        """
+        g = np.gcd(up, down)
+        self.up, self.down = int(up // g), int(down // g)
+        self.dtype = np.dtype(dtype)
+        self.h = resampling_fir(self.up, self.down, self.dtype.name) * self.up
+        self.half_len = (self.h.size - 1) // 2
+        # Number of input samples before and after each block which contribute to its output
+        self.n_context = self.half_len // self.up + 1
+        self.history = np.zeros(self.n_context, dtype=self.dtype)
+        self.n_samples = 0
+
+    def process(self, block, lookahead=None):
+        """
+        Resample the next block
+
+        Parameters
+        ----------
+        block : np.array
+            Next samples of the signal
+        lookahead : np.array or None
+            Samples after block. Only the first n_context samples are used. If None or shorter, the signal is
+            considered to be 0 after block (as in resample_poly)
+
+        Returns
+        -------
+        Resampled block, with the output samples which fall between the first sample of block (included) and the
+        first sample of the next block
+        """
+        block = np.asarray(block)
+        context = np.zeros(self.n_context, dtype=self.dtype)
+        if lookahead is not None:
+            lookahead = np.asarray(lookahead)[:self.n_context]
+            context[:lookahead.size] = lookahead
+        x = np.concatenate([self.history, block, context])
+        # Global index of the first sample of x and range of the output samples of this block
+        first_sample = self.n_samples - self.n_context
+        first_out = -(-self.n_samples * self.up // self.down)
+        end_out = -(-(self.n_samples + block.size) * self.up // self.down)
+        # Output m is sum_k h[k] * x_up[m * down + half_len - k]. The filter is padded so the first output of
+        # upfirdn is aligned with a multiple of down
+        offset = first_out * self.down + self.half_len - first_sample * self.up
+        n_pad = -offset % self.down
+        h = np.concatenate([np.zeros(n_pad, dtype=self.h.dtype), self.h])
+        y = sig.upfirdn(h, x, self.up, self.down)
+        first = (offset + n_pad) // self.down
+        resampled = y[first:first + end_out - first_out]
+
+        self.history = np.concatenate([self.history, block])[-self.n_context:]
+        self.n_samples += block.size
+        return resampled
+
+
+@nb.njit
+def sosfilt_mean_square(sos_bank, x):
+    """
+    Filter each row of x with each filter of sos_bank and return the mean square of each filtered signal, without
+    storing the filtered signals. The filters are applied as scipy.signal.sosfilt does (transposed direct form II,
+    starting from zero)
+
+    Parameters
+    ----------
+    sos_bank : np.array
+        Filters with shape (n_filters, n_sections, 6). All of them need the same number of sections
+    x : np.array
+        Signals with shape (n_signals, n_samples)
+
+    Returns
+    -------
+    np.array with shape (n_signals, n_filters)
+    """
+    n_filters, n_sections = sos_bank.shape[0], sos_bank.shape[1]
+    n_signals, n_samples = x.shape
+    mean_square = np.zeros((n_signals, n_filters))
+    zi = np.zeros((n_sections, 2))
+    for i in range(n_signals):
+        for j in range(n_filters):
+            zi[:] = 0.0
+            total = 0.0
+            for n in range(n_samples):
+                y = x[i, n]
+                for k in range(n_sections):
+                    x_k = y
+                    y = sos_bank[j, k, 0] * x_k + zi[k, 0]
+                    zi[k, 0] = sos_bank[j, k, 1] * x_k - sos_bank[j, k, 4] * y + zi[k, 1]
+                    zi[k, 1] = sos_bank[j, k, 2] * x_k - sos_bank[j, k, 5] * y
+                total += y * y
+            mean_square[i, j] = total / n_samples
+    return mean_square
+
+
+def _hashable(value):
+    """
+    Convert lists and numpy arrays (also nested) to tuples so they can be used as keys
+    """
+    if isinstance(value, np.ndarray):
+        return tuple(value.tolist())
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _copy(value):
+    """
+    Copy the numpy arrays (also inside tuples and lists)
+    """
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, (list, tuple)):
+        return type(value)(_copy(v) for v in value)
+    return value
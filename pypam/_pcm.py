@@ -0,0 +1,207 @@
+__author__ = "Clea Parcerisas"
+__version__ = "0.1"
+__credits__ = "Clea Parcerisas"
+__email__ = "clea.parcerisas@vliz.be"
+__status__ = "Development"
+
+import pathlib
+import struct
+
+import numpy as np
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Type of the samples for each (format, bits per sample). 24 bits samples are read as 3 bytes
+SAMPLE_DTYPES = {
+    (WAVE_FORMAT_PCM, 16): np.dtype('<i2'),
+    (WAVE_FORMAT_PCM, 24): np.dtype('u1'),
+    (WAVE_FORMAT_PCM, 32): np.dtype('<i4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): np.dtype('<f4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): np.dtype('<f8'),
+}
+
+
+class PCMReader:
+    def __init__(self, path):
+        """
+        Reader of uncompressed wav files which memory-maps the data chunk, so the samples are only read from disk
+        when they are accessed. The samples are converted to float (-1 to 1) the same way as soundfile does.
+        Supports 16, 24 and 32 bits integer PCM and 32 and 64 bits float.
+
+        Parameters
+        ----------
+        path : str or Path
+            Path to the wav file
+        """
+        self.path = pathlib.Path(path)
+        audio_format, self.channels, self.samplerate, self.bits, data_offset, data_size = _parse_header(self.path)
+        if (audio_format, self.bits) not in SAMPLE_DTYPES:
+            raise ValueError('Format %s with %s bits is not supported' % (audio_format, self.bits))
+        self.dtype = SAMPLE_DTYPES[(audio_format, self.bits)]
+        self.is_float = audio_format == WAVE_FORMAT_IEEE_FLOAT
+        bytes_per_frame = self.channels * self.bits // 8
+        self.frames = data_size // bytes_per_frame
+        if self.bits == 24:
+            shape = (self.frames, self.channels, 3)
+        else:
+            shape = (self.frames, self.channels)
+        if self.frames > 0:
+            self._raw = np.memmap(self.path, dtype=self.dtype, mode='r', offset=data_offset, shape=shape)
+        else:
+            self._raw = np.zeros(shape, dtype=self.dtype)
+
+    def raw(self, start=0, stop=None):
+        """
+        Return a view (no copy) of the samples as stored in the file, with shape (frames, channels).
+        24 bits samples have an extra last dimension with the 3 bytes of each sample
+
+        Parameters
+        ----------
+        start : int
+            First frame
+        stop : int or None
+            Last frame (not included). If None, until the end of the file
+        """
+        return self._raw[start:stop]
+
+    def to_float(self, raw, dtype=np.float64):
+        """
+        Convert samples returned by raw (or any slice of them) to float (-1 to 1)
+
+        Parameters
+        ----------
+        raw : np.array
+            Output of raw
+        dtype : numpy dtype
+            Float type of the output
+        """
+        dtype = np.dtype(dtype)
+        if self.is_float:
+            return raw.astype(dtype)
+        if self.bits == 24:
+            raw = raw.astype(np.int32)
+            raw = (raw[..., 0] << 8) | (raw[..., 1] << 16) | (raw[..., 2] << 24)
+            return raw.astype(dtype) / dtype.type(2.0 ** 31)
+        return raw.astype(dtype) / dtype.type(2.0 ** (self.bits - 1))
+
+    def read(self, start=0, stop=None, dtype=np.float64):
+        """
+        Read the frames from start to stop in float (-1 to 1). The output is the same as soundfile.read: 1D for
+        mono files and (frames, channels) otherwise
+
+        Parameters
+        ----------
+        start : int
+            First frame
+        stop : int or None
+            Last frame (not included). If None, until the end of the file
+        dtype : numpy dtype
+            Float type of the output
+        """
+        wav = self.to_float(self.raw(start, stop), dtype=dtype)
+        if self.channels == 1:
+            wav = wav[:, 0]
+        return wav
+
+
+class PCMView:
+    def __init__(self, reader, gain=1.0, dtype=np.float64):
+        """
+        Signal of a memory-mapped file which is converted (to float and multiplied by gain) only when it is sliced.
+        It can be used as a read-only numpy array: slicing it returns a numpy array, and converting it with
+        np.asarray reads the whole file
+
+        Parameters
+        ----------
+        reader : PCMReader
+            Reader of the file
+        gain : float
+            Gain applied to the samples (i.e. to convert them to upa)
+        dtype : numpy dtype
+            Float type of the signal
+        """
+        self.reader = reader
+        self.dtype = np.dtype(dtype)
+        self.gain = self.dtype.type(gain)
+        if reader.channels == 1:
+            self.shape = (reader.frames,)
+        else:
+            self.shape = (reader.frames, reader.channels)
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        raw = self.reader.raw()
+        if self.reader.channels == 1:
+            raw = raw[:, 0]
+        return self.reader.to_float(raw[key], dtype=self.dtype) * self.gain
+
+    def copy(self):
+        """
+        Read the whole signal in a numpy array
+        """
+        return self[:]
+
+    def __array__(self, dtype=None):
+        signal = self[:]
+        if dtype is not None:
+            signal = signal.astype(dtype)
+        return signal
+
+
+def open_pcm(sfile):
+    """
+    Return a PCMReader for sfile if it is an uncompressed wav file in the disk with a supported format, None otherwise
+
+    Parameters
+    ----------
+    sfile : str, Path or file object
+    """
+    if not isinstance(sfile, (str, pathlib.Path)) or pathlib.Path(sfile).suffix.lower() != '.wav':
+        return None
+    try:
+        return PCMReader(sfile)
+    except (ValueError, OSError, struct.error):
+        return None
+
+
+def _parse_header(path):
+    """
+    Read the RIFF header of the wav file and return the format, the number of channels, the sampling rate, the
+    bits per sample, and the offset and the size (in bytes) of the data chunk
+    """
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError('%s is not a RIFF wav file' % path)
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError('%s has no data chunk' % path)
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                chunk = f.read(chunk_size)
+                audio_format, channels, samplerate, _, _, bits = struct.unpack('<HHIIHH', chunk[:16])
+                if audio_format == WAVE_FORMAT_EXTENSIBLE:
+                    # The format is in the first two bytes of the sub format GUID
+                    audio_format = struct.unpack('<H', chunk[24:26])[0]
+                fmt = (audio_format, channels, samplerate, bits)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError('%s has no fmt chunk before the data chunk' % path)
+                data_offset = f.tell()
+                file_size = path.stat().st_size
+                # Some recorders do not update the size of the data chunk
+                data_size = min(chunk_size, file_size - data_offset)
+                return fmt + (data_offset, data_size)
+            else:
+                f.seek(chunk_size, 1)
+            # Chunks are padded to an even number of bytes
+            if chunk_size % 2:
+                f.seek(1, 1)
@@ -0,0 +1,113 @@
+__author__ = "Clea Parcerisas"
+__version__ = "0.1"
+__credits__ = "Clea Parcerisas"
+__email__ = "clea.parcerisas@vliz.be"
+__status__ = "Development"
+
+import pathlib
+
+import numpy as np
+import xarray
+
+from pypam import utils
+
+try:
+    import zarr
+except ModuleNotFoundError:
+    zarr = None
+
+try:
+    import dask
+except ModuleNotFoundError:
+    dask = None
+
+# Number of values of one chunk when the chunks are tuned for plotting long term spectrograms (8 MB of float64)
+LTSA_CHUNK_VALUES = 2 ** 20
+
+
+class ZarrSink:
+    def __init__(self, store_path, attrs_to_vars, attrs=None, chunks=None, overwrite=False):
+        """
+        Output sink which appends the output of each file to a zarr store along the id dimension, so only one file's
+        output is kept in memory. The result is the same as merging all the outputs with utils.merge_ds.
+
+        Parameters
+        ----------
+        store_path : str or Path
+            Path of the zarr store. If it is an existing zarr store, it is overwritten
+        attrs_to_vars : list
+            List of all the attributes of each file to convert to coordinates (see utils.merge_ds)
+        attrs : dict or None
+            Global attributes of the output (i.e. the metadata of the ASA)
+        chunks : dict, 'ltsa' or None
+            Chunk size of each dimension. The dimensions not specified are stored in one single chunk. If set to None,
+            each file is one chunk along id. If set to 'ltsa', the chunks contain the whole frequency axis and as many
+            time bins as fit in 8 MB, which is the access pattern of plots.plot_ltsa (all frequencies for a period)
+        overwrite : bool
+            Set to True to overwrite store_path even if it exists and it is not a zarr store. Otherwise an error is
+            raised instead of deleting it
+        """
+        if zarr is None:
+            raise ModuleNotFoundError('The zarr output requires zarr to be installed.')
+        self.store_path = pathlib.Path(store_path)
+        if self.store_path.exists() and not overwrite and not self.store_path.joinpath('.zgroup').exists():
+            raise FileExistsError('%s exists and it is not a zarr store. Set overwrite to True to replace it.'
+                                  % self.store_path)
+        self.attrs_to_vars = attrs_to_vars
+        self.attrs = {} if attrs is None else attrs.copy()
+        self.chunks = chunks
+        self.n_ids = 0
+
+    def _encoding(self, ds):
+        """
+        Return the zarr encoding (chunks) of all the variables of ds
+        """
+        encoding = {}
+        for name, var in ds.variables.items():
+            if var.ndim == 0:
+                continue
+            var_chunks = []
+            for dim, size in zip(var.dims, var.shape):
+                if self.chunks == 'ltsa':
+                    if dim == 'id':
+                        n_other = int(np.prod(var.shape)) // max(size, 1)
+                        size = max(1, LTSA_CHUNK_VALUES // max(n_other, 1))
+                elif self.chunks is not None and dim in self.chunks:
+                    size = self.chunks[dim]
+                var_chunks.append(max(int(size), 1))
+            encoding[name] = {'chunks': tuple(var_chunks)}
+        return encoding
+
+    def append(self, new_ds):
+        """
+        Append the output of one file to the store
+
+        Parameters
+        ----------
+        new_ds : xarray Dataset
+            Output of one file
+        """
+        new_ds = utils._prepare_ds_to_merge(new_ds, self.n_ids, self.attrs_to_vars)
+        # Store the strings with variable length, so longer paths can be appended later
+        for name, var in new_ds.variables.items():
+            if var.dtype.kind == 'U':
+                new_ds[name] = var.astype(object)
+        self.attrs.update(new_ds.attrs)
+        new_ds.attrs = self.attrs
+        if self.n_ids == 0:
+            new_ds.to_zarr(self.store_path, mode='w', encoding=self._encoding(new_ds))
+        else:
+            new_ds.to_zarr(self.store_path, append_dim='id')
+        self.n_ids += new_ds.dims['id']
+
+    def open(self):
+        """
+        Open the store lazily
+
+        Returns
+        -------
+        xarray Dataset
+        """
+        if dask is None:
+            return xarray.open_zarr(self.store_path, chunks=None)
+        return xarray.open_zarr(self.store_path)
@@ -0,0 +1,233 @@
+__author__ = "Clea Parcerisas"
+__version__ = "0.1"
+__credits__ = "Clea Parcerisas"
+__email__ = "clea.parcerisas@vliz.be"
+__status__ = "Development"
+
+import numpy as np
+import xarray
+
+# Default size of the sketches (the capacity of the top compactor)
+SKETCH_K = 200
+# Number of values along the aggregated dimension loaded at once by sketch_dataarray
+BLOCK_SIZE = 1000
+
+
+class QuantileSketch:
+    def __init__(self, k=SKETCH_K, seed=None):
+        """
+        Mergeable quantile sketch (KLL) of many series at once, i.e. one per frequency. The values of all the series
+        arrive together (one value per series and time bin), so all the series have the same compactors, and they are
+        stored as 2D arrays (n_series x n_items) and compacted at once.
+        Each compactor keeps at most ~k items. When it is full, it is sorted and half of its items (the odd or the even
+        ones, chosen at random) are promoted to the next compactor with double weight. The memory used is about
+        3 * k items per series, whatever the number of values added.
+
+        While less than k values have been added the percentiles are exact (the same as np.nanpercentile). Afterwards,
+        the rank of the returned percentiles (in the sorted values) differs from the exact one by less than
+        rank_error() * n with probability 1 - delta. In practice the rank error is of the order of 1 / k (below 1 %
+        for the default k).
+
+        Parameters
+        ----------
+        k : int
+            Size of the sketch
+        seed : int or None
+            Seed of the random choice of the compacted items
+        """
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.shape = None
+        # Dimensions, coordinates and attributes of the series (set by sketch_dataarray)
+        self.dims = None
+        self.coords = None
+        self.attrs = {}
+        self.n = 0
+        # Sum of the squared weights of all the compactions, for the error bound
+        self.compacted_weight = 0
+        self.levels = []
+
+    def _capacity(self, level):
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - level))))
+
+    def _start(self, shape):
+        """
+        Set the shape of the series of the sketch
+        """
+        self.shape = tuple(shape)
+        self.levels = [np.zeros((int(np.prod(self.shape)), 0))]
+
+    def add(self, values, axis=0):
+        """
+        Add values to the sketch
+
+        Parameters
+        ----------
+        values : np.array
+            Values to add. All the dimensions except axis are the series (they have to be the same every time)
+        axis : int
+            Axis of the values of each series (i.e. time)
+        """
+        values = np.moveaxis(np.asarray(values, dtype=float), axis, -1)
+        if self.shape is None:
+            self._start(values.shape[:-1])
+        elif values.shape[:-1] != self.shape:
+            raise ValueError('The values have shape %s but the sketch was started with %s' %
+                             (values.shape[:-1], self.shape))
+        self.levels[0] = np.concatenate([self.levels[0], values.reshape(-1, values.shape[-1])], axis=1)
+        self.n += values.shape[-1]
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """
+        Add all the values of another sketch (i.e. computed in another process) to this one
+
+        Parameters
+        ----------
+        other : QuantileSketch
+            Sketch of the same series
+        """
+        if other.shape is None:
+            return self
+        if self.shape is None:
+            self._start(other.shape)
+            self.dims, self.coords, self.attrs = other.dims, other.coords, other.attrs
+        elif other.shape != self.shape:
+            raise ValueError('Only sketches of the same series can be merged (%s and %s)' % (self.shape, other.shape))
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(items.copy())
+            else:
+                self.levels[level] = np.concatenate([self.levels[level], items], axis=1)
+        self.n += other.n
+        self.compacted_weight += other.compacted_weight
+        self._compress()
+        return self
+
+    def _compress(self):
+        """
+        Compact the full compactors, starting from the lowest one
+        """
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if items.shape[1] < self._capacity(level):
+                level += 1
+                continue
+            if level + 1 == len(self.levels):
+                self.levels.append(np.zeros((items.shape[0], 0)))
+            # nan are sorted at the end, so they are also compacted with their weight
+            items = np.sort(items, axis=1)
+            n_pairs = items.shape[1] // 2
+            offsets = self.rng.integers(0, 2, size=(items.shape[0], 1))
+            promoted = np.take_along_axis(items, offsets + 2 * np.arange(n_pairs), axis=1)
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted], axis=1)
+            self.levels[level] = items[:, 2 * n_pairs:]
+            self.compacted_weight += 4 ** level
+            # The capacities of the lower compactors change when a compactor is added
+            level = 0
+
+    def rank_error(self, delta=0.01):
+        """
+        Bound of the rank error of the percentiles, as a fraction of the number of values. Each compaction changes
+        the rank of a value by 0 or +-weight with the same probability, so the total error is bounded with
+        Hoeffding's inequality
+
+        Parameters
+        ----------
+        delta : float
+            Probability that the error is bigger than the bound
+
+        Returns
+        -------
+        float (0 if the percentiles are exact)
+        """
+        if self.n == 0:
+            return 0.0
+        return np.sqrt(2 * self.compacted_weight * np.log(2 / delta)) / self.n
+
+    def percentiles(self, percentiles):
+        """
+        Percentiles of the values of each series, ignoring the nan (as np.nanpercentile, linear interpolation)
+
+        Parameters
+        ----------
+        percentiles : list
+            Percentiles to compute (in 100 per cent)
+
+        Returns
+        -------
+        np.array with the shape of the series plus one dimension for the percentiles
+        """
+        percentiles = np.asarray(percentiles, dtype=float)
+        if self.shape is None:
+            raise ValueError('No values have been added to the sketch')
+        values = np.concatenate(self.levels, axis=1)
+        weights = np.concatenate([np.full(items.shape[1], 2 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(values, axis=1)
+        values = np.take_along_axis(values, order, axis=1)
+        weights = np.where(np.isnan(values), 0, weights[order])
+        cumulative = np.cumsum(weights, axis=1)
+        # Each item represents weight values, placed in the middle of the ranks it covers
+        ranks = cumulative - (weights + 1) / 2
+        p = np.full((values.shape[0], percentiles.size), np.nan)
+        for i in range(values.shape[0]):
+            valid = weights[i] > 0
+            if valid.any():
+                p[i] = np.interp(percentiles / 100 * (cumulative[i, -1] - 1), ranks[i, valid], values[i, valid])
+        return p.reshape(self.shape + (percentiles.size,))
+
+
+def sketch_dataarray(da, dim, k=SKETCH_K, sketch=None, block_size=BLOCK_SIZE):
+    """
+    Add the values of the DataArray da along dim to a QuantileSketch. da is read in blocks of block_size values
+    along dim, so if it is opened lazily (i.e. from a netCDF file, or with dask) it does not need to fit in memory
+
+    Parameters
+    ----------
+    da : xarray DataArray
+        Data to add
+    dim : str
+        Dimension to aggregate (i.e. time). The sketch has one series per value of the other dimensions
+    k : int
+        Size of the sketch (only used if sketch is None)
+    sketch : QuantileSketch or None
+        Sketch to add the values to. If None, a new one is created
+    block_size : int
+        Number of values along dim loaded at once
+
+    Returns
+    -------
+    QuantileSketch
+    """
+    if sketch is None:
+        sketch = QuantileSketch(k=k)
+    if sketch.dims is None:
+        sketch.dims = [d for d in da.dims if d != dim]
+        sketch.coords = {name: coord for name, coord in da.coords.items() if dim not in coord.dims}
+        sketch.attrs = dict(da.attrs)
+    axis = da.dims.index(dim)
+    for start in range(0, da.sizes[dim], block_size):
+        sketch.add(da.isel({dim: slice(start, start + block_size)}).to_numpy(), axis=axis)
+    return sketch
+
+
+def percentiles_dataarray(sketch, percentiles):
+    """
+    Return the percentiles of a sketch filled with sketch_dataarray as a DataArray, with the dimensions of the
+    series plus percentiles. The bound of the rank error (see QuantileSketch.rank_error) is stored in the attributes
+
+    Parameters
+    ----------
+    sketch : QuantileSketch
+        Sketch with the values
+    percentiles : list
+        Percentiles to compute (in 100 per cent)
+    """
+    coords = dict(sketch.coords)
+    coords['percentiles'] = percentiles
+    attrs = dict(sketch.attrs)
+    attrs['rank_error'] = sketch.rank_error()
+    return xarray.DataArray(sketch.percentiles(percentiles), coords=coords, dims=sketch.dims + ['percentiles'],
+                            attrs=attrs)
@@ -18,8 +18,14 @@ import soundfile as sf
 import xarray
 from tqdm.auto import tqdm
 
+from pypam import _detector
+from pypam import _event
+from pypam import _exposure
+from pypam import _pcm
+from pypam import _sketch
 from pypam import plots
 from pypam import signal as sig
+from pypam._collector import BinCollector
 from pypam import utils
 from pypam import units as output_units
 
@@ -29,6 +35,11 @@ plt.rcParams.update({'pcolor.shading': 'auto'})
 # Apply the default theme
 sns.set_theme()
 
+# Maximum number of samples read at once when the bins are processed in batches
+BATCH_SAMPLES = 2 ** 18
+# Parameters which the broadband metrics accept and ignore (ASA passes the fft parameters to all the methods)
+BROADBAND_KWARGS = ('db', 'nfft', 'fft_overlap')
+
 
 class AcuFile:
     """
@@ -50,9 +61,13 @@ class AcuFile:
         the function calibrate from the hydrophone is performed, and the first samples ignored (and hydrophone updated)
     dc_subtract: bool
         Set to True to subtract the dc noise (root mean squared value
+    dtype: str or numpy dtype
+        Float type used to read and process the signal and to store the outputs. Set to 'float32' to halve the memory
+        used (with less precision)
     """
 
-    def __init__(self, sfile, hydrophone, p_ref, timezone='UTC', channel=0, calibration=None, dc_subtract=False):
+    def __init__(self, sfile, hydrophone, p_ref, timezone='UTC', channel=0, calibration=None, dc_subtract=False,
+                 dtype='float64'):
         # Save hydrophone model
         self.hydrophone = hydrophone
 
@@ -77,6 +92,8 @@ class AcuFile:
         self.file_path = sfile
         self.file = sf.SoundFile(self.file_path, 'r')
         self.fs = self.file.samplerate
+        # Memory-mapped reader for uncompressed wav files (None for other files)
+        self._pcm_reader = _pcm.open_pcm(sfile)
 
         # Reference pressure in upa
         self.p_ref = p_ref
@@ -106,6 +123,7 @@ class AcuFile:
         self.calibration = calibration
 
         self.dc_subtract = dc_subtract
+        self.dtype = np.dtype(dtype)
 
     def __getattr__(self, name):
         """
@@ -121,7 +139,7 @@ class AcuFile:
         else:
             return self.__dict__[name]
 
-    def _bins(self, binsize=None, bin_overlap=0):
+    def _bins(self, binsize=None, bin_overlap=0, continuous=False):
         """
         Yields the bins each binsize
         Parameters
@@ -130,6 +148,10 @@ class AcuFile:
             Number of seconds per bin to yield. If set to None, a single bin is yield for the entire file
         bin_overlap : float [0 to 1]
             Percentage to overlap the bin windows
+        continuous : bool
+            Set to True to filter and resample the bands of all the bins as one continuous signal: the filters of
+            each bin start from the state left by the previous bin, so there are no transients at the beginning of
+            the bins (see Signal). The bins are read one ahead. Requires bin_overlap to be 0
 
         Returns
         -------
@@ -137,35 +159,174 @@ class AcuFile:
         Where i is the index, time_bin is the datetime of the beginning of the block and signal is the signal object
         of the bin
         """
-        if bin_overlap>1:
-            raise ValueError(f'bin_overlap must be fractional.')
-        if binsize is None:
-            blocksize = self.file.frames - self._start_frame
-        else:
-            blocksize = self.samples(binsize)
-        noverlap = int(bin_overlap * blocksize)
+        if continuous and bin_overlap != 0:
+            raise ValueError('The continuous filtering of the bins requires bin_overlap to be 0')
+        blocksize, noverlap = self._blocksize(binsize, bin_overlap=bin_overlap)
         n_blocks = self._n_blocks(blocksize, noverlap=noverlap)
         time_array, _, _ = self._time_array(binsize, bin_overlap=bin_overlap)
-        for i, block in tqdm(enumerate(sf.blocks(self.file_path, blocksize=blocksize, start=self._start_frame,
-                                                 overlap=noverlap, always_2d=True, fill_value=0.0)),
-                             total=n_blocks, leave=False, position=0):
-            # Select the desired channel
-            block = block[:, self.channel]
+        step = blocksize - noverlap
+        if self._pcm_reader is None:
+            blocks = (block[:, self.channel] for block in sf.blocks(self.file_path, blocksize=blocksize,
+                                                                    start=self._start_frame, overlap=noverlap,
+                                                                    dtype=self.dtype.name, always_2d=True,
+                                                                    fill_value=0.0))
+        else:
+            blocks = (self._read_frames(i * step + self._start_frame, blocksize)
+                      for i in range(self._n_read_blocks(blocksize, step)))
+        if continuous:
+            filter_states = {}
+            blocks = _with_next(self.wav2upa(wav=block) for block in blocks)
+        else:
+            filter_states = None
+            blocks = ((self.wav2upa(wav=block), None) for block in blocks)
+        for i, (signal_upa, next_upa) in tqdm(enumerate(blocks), total=n_blocks, leave=False, position=0):
             time_bin = time_array[i]
-            # Read the signal and prepare it for analysis
-            signal_upa = self.wav2upa(wav=block)
-            signal = sig.Signal(signal=signal_upa, fs=self.fs, channel=self.channel)
+            # Prepare the signal for analysis
+            if self.dc_subtract and next_upa is not None:
+                next_upa = next_upa - np.mean(next_upa)
+            signal = sig.Signal(signal=signal_upa, fs=self.fs, channel=self.channel, filter_states=filter_states,
+                                lookahead=next_upa)
             if self.dc_subtract:
                 signal.remove_dc()
-            step = blocksize - noverlap
             start_sample = i * step + self._start_frame
             end_sample = start_sample + blocksize
             yield i, time_bin, signal, start_sample, end_sample
         self.file.seek(0)
 
+    def _bin_batches(self, binsize=None, bin_overlap=0, dc_subtract=False, max_samples=BATCH_SAMPLES):
+        """
+        Yields the bins in batches, reading the file in large chunks. The bins are the same as the ones of _bins (the
+        last one is filled with zeros), but they are given as the rows of a 2D array, so they can be processed
+        at once. The dc is not removed unless dc_subtract is True, see _batch_dc_subtract
+
+        Parameters
+        ----------
+        binsize: float or None
+            Number of seconds per bin to yield. If set to None, a single bin is yield for the entire file
+        bin_overlap : float [0 to 1]
+            Percentage to overlap the bin windows
+        dc_subtract : bool
+            Set to True to subtract the mean of each bin
+        max_samples : int
+            Maximum number of samples of each batch (at least one bin per batch)
+
+        Returns
+        -------
+        Iterates through all the batches, yields ids, time_bins, blocks, start_samples, end_samples
+        Where ids are the indices of the bins, time_bins the datetime of the beginning of each bin and blocks the
+        signal in upa of each bin (one row per bin)
+        """
+        blocksize, noverlap = self._blocksize(binsize, bin_overlap=bin_overlap)
+        step = blocksize - noverlap
+        n_bins = self._n_read_blocks(blocksize, step)
+        time_array, _, _ = self._time_array(binsize, bin_overlap=bin_overlap)
+        batch_bins = max(1, max_samples // blocksize)
+        for first_bin in tqdm(range(0, n_bins, batch_bins), leave=False, position=0):
+            ids = np.arange(first_bin, min(first_bin + batch_bins, n_bins))
+            start_samples = ids * step + self._start_frame
+            wav = self._read_frames(start_samples[0], (len(ids) - 1) * step + blocksize)
+            blocks = np.lib.stride_tricks.sliding_window_view(wav, blocksize)[::step]
+            blocks = self.wav2upa(wav=blocks)
+            if dc_subtract:
+                blocks = blocks - blocks.mean(axis=1, keepdims=True)
+            yield ids, time_array[ids], blocks, start_samples, start_samples + blocksize
+        self.file.seek(0)
+
+    def _batch_dc_subtract(self, band):
+        """
+        Return True if the bins of _bin_batches have to be dc-subtracted to analyze them in the broadband band as
+        the bins of _bins. _bins removes the dc of the signal of each bin, but Signal.set_band goes back to the
+        original signal (with dc) for any broadband band which is not the initial one ([0, fs/2])
+
+        Parameters
+        ----------
+        band : list or tuple
+            Broadband band the bins are analyzed in
+        """
+        return self.dc_subtract and band == [0, self.fs / 2]
+
+    def _signal_chunks(self, chunksize=BATCH_SAMPLES):
+        """
+        Yields the signal in upa in consecutive chunks of chunksize samples (the last one can be shorter), from the
+        start frame to the end of the file. Used to stream the signal without loading the whole file
+
+        Parameters
+        ----------
+        chunksize : int
+            Number of samples of each chunk
+        """
+        if self._pcm_reader is None:
+            for block in sf.blocks(self.file_path, blocksize=chunksize, start=self._start_frame,
+                                   dtype=self.dtype.name, always_2d=True):
+                yield self.wav2upa(wav=block[:, self.channel])
+            self.file.seek(0)
+        else:
+            for start in range(self._start_frame, self._pcm_reader.frames, chunksize):
+                raw = self._pcm_reader.raw(start, start + chunksize)[:, self.channel]
+                yield self.wav2upa(wav=self._pcm_reader.to_float(raw, dtype=self.dtype))
+
+    def _read_frames(self, start, frames):
+        """
+        Read frames samples of the selected channel from start, in wav units. If the end of the file is reached, the
+        signal is filled with zeros. Uncompressed wav files are read from the memory-mapped data
+
+        Parameters
+        ----------
+        start : int
+            First sample to read
+        frames : int
+            Number of samples to read
+        """
+        if self._pcm_reader is None:
+            self.file.seek(start)
+            return self.file.read(frames=frames, dtype=self.dtype.name, always_2d=True,
+                                  fill_value=0.0)[:, self.channel]
+        raw = self._pcm_reader.raw(start, start + frames)[:, self.channel]
+        wav = self._pcm_reader.to_float(raw, dtype=self.dtype)
+        if wav.shape[0] < frames:
+            wav = np.concatenate([wav, np.zeros(frames - wav.shape[0], dtype=self.dtype)])
+        return wav
+
+    def _n_read_blocks(self, blocksize, step):
+        """
+        Return the number of blocks of blocksize samples (every step samples) read from the start frame until the end
+        of the file, the last one filled with zeros (same number of blocks as soundfile.blocks)
+        """
+        total_frames = self.file.frames - self._start_frame
+        if total_frames <= 0:
+            return 0
+        return 1 + int(np.ceil(max(0, total_frames - blocksize) / step))
+
+    def _blocksize(self, binsize=None, bin_overlap=0):
+        """
+        Return the number of samples of each bin and the number of samples overlapping between bins
+
+        Parameters
+        ----------
+        binsize: float or None
+            Number of seconds per bin. If set to None, a single bin is considered for the entire file
+        bin_overlap : float [0 to 1]
+            Percentage to overlap the bin windows
+        """
+        if bin_overlap > 1:
+            raise ValueError(f'bin_overlap must be fractional.')
+        if binsize is None:
+            blocksize = self.file.frames - self._start_frame
+        else:
+            blocksize = self.samples(binsize)
+        noverlap = int(bin_overlap * blocksize)
+        return blocksize, noverlap
+
     def _n_blocks(self, blocksize, noverlap):
         return int(np.floor(self.file.frames - self._start_frame) / (blocksize - noverlap))
 
+    def _bin_collector(self, binsize=None, bin_overlap=0):
+        """
+        Return an empty BinCollector sized for the number of bins of the file
+        """
+        blocksize, noverlap = self._blocksize(binsize, bin_overlap=bin_overlap)
+        return BinCollector(n_bins=self._n_blocks(blocksize, noverlap=noverlap), dtype=self.dtype)
+
     def samples(self, bintime):
         """
         Return the samples according to the fs
@@ -293,7 +454,7 @@ class AcuFile:
         """
         # First time, read the file and store it to not read it over and over
         if self.wav is None:
-            self.wav = self.file.read()
+            self.wav = self.file.read(dtype=self.dtype.name)
             self.file.seek(0)
         if units == 'wav':
             signal = self.wav
@@ -310,6 +471,26 @@ class AcuFile:
 
         return signal
 
+    def signal_view(self, units='upa'):
+        """
+        Returns the signal in the specified units without reading the whole file. For uncompressed wav files it is a
+        memory-mapped view of the signal (see _pcm.PCMView): slicing it returns a numpy array with only the selected
+        samples. For other files it is the same as signal
+
+        Parameters
+        ----------
+        units : string
+            Units in which to return the signal. Can be 'upa' or 'Pa'
+        """
+        if units not in ['upa', 'Pa']:
+            raise ValueError('The view of the signal can only be in upa or Pa, not in %s' % units)
+        if self._pcm_reader is None:
+            return self.signal(units)
+        gain = self._upa_gain()
+        if units == 'Pa':
+            gain = gain / 1e6
+        return _pcm.PCMView(self._pcm_reader, gain=gain, dtype=self.dtype)
+
     def _time_array(self, binsize=None, bin_overlap=0):
         """
         Return a time array for each point of the signal
@@ -347,12 +528,20 @@ class AcuFile:
         # Read if no signal is passed
         if wav is None:
             wav = self.signal('wav')
+        gain = self._upa_gain()
+        if wav.dtype == np.float32:
+            # Keep the signal in single precision
+            gain = np.float32(gain)
+        return utils.set_gain(wave=wav, gain=gain)
+
+    def _upa_gain(self):
+        """
+        Return the gain to convert the wav signal to upa
+        """
         # First convert it to Volts and then to Pascals according to sensitivity
         mv = 10 ** (self.hydrophone.sensitivity / 20.0) * self.p_ref
         ma = 10 ** (self.hydrophone.preamp_gain / 20.0) * self.p_ref
-        gain_upa = (self.hydrophone.Vpp / 2.0) / (mv * ma)
-
-        return utils.set_gain(wave=wav, gain=gain_upa)
+        return (self.hydrophone.Vpp / 2.0) / (mv * ma)
 
     def wav2db(self, wav=None):
         """
@@ -442,7 +631,8 @@ class AcuFile:
 
         return metadata_attrs
 
-    def _apply_multiple(self, method_list, binsize=None, band_list=None, bin_overlap=0, **kwargs):
+    def _apply_multiple(self, method_list, binsize=None, band_list=None, bin_overlap=0, continuous=False,
+                        multirate=False, **kwargs):
         """
         Apply multiple methods per bin to save computational time
 
@@ -458,14 +648,20 @@ class AcuFile:
             Length in seconds of the bins to analyze
         bin_overlap : float [0 to 1]
             Percentage to overlap the bin windows
+        continuous : bool
+            Set to True to filter the bands of all the bins as one continuous signal, so the filter transients do
+            not affect the beginning of each bin and short bins can be used. Requires bin_overlap to be 0
+        multirate : bool
+            Set to True to downsample the bands of each bin from its decimation pyramid (see Signal.set_band)
+            instead of filtering them at the original fs. All the bands of a bin then share the same decimations
         kwargs: any parameters that have to be passed to the methods
 
         Returns
         -------
         DataFrame with time as index and a multiindex column with band, method as levels.
         """
-        # TODO decide if it is downsampled or not
-        downsample = False
+        # The bands are only downsampled when they are taken from the decimation pyramid
+        downsample = multirate
 
         # Bands selected to study
         if band_list is None:
@@ -485,48 +681,52 @@ class AcuFile:
         if 'db' in kwargs.keys():
             if not kwargs['db']:
                 log = False
-        # Define an empty dataset
+        # Preallocate one (bin, band) buffer per method. Failed computations are kept as nan
+        collector = self._bin_collector(binsize, bin_overlap=bin_overlap)
+        for method_name in method_list:
+            collector.add_variable(method_name, shape=(len(sorted_bands),))
+        fused = set(method_list) <= set(utils.BROADBAND_METRICS) and set(kwargs.keys()) <= set(BROADBAND_KWARGS)
+        if fused and not continuous and not downsample:
+            # Only broadband time-domain metrics: compute all of them in one pass, for all the bins of each batch
+            # As in _bins, the bands start from the dc-subtracted bins, and the broadband bands go back to the bins
+            # with dc (see _batch_dc_subtract)
+            for ids, time_bins, blocks, start_samples, end_samples in self._bin_batches(binsize,
+                                                                                         bin_overlap=bin_overlap):
+                rows = collector.new_bins(ids, time_bins, start_samples, end_samples)
+                initial = blocks - blocks.mean(axis=1, keepdims=True) if self.dc_subtract else blocks
+                output = sig.blocks_broadband_metrics(initial, self.fs, sorted_bands, method_list, db=log,
+                                                      original=blocks)
+                for k, method_name in enumerate(method_list):
+                    collector.set_bins(method_name, rows, output[..., k])
+        else:
+            for i, time_bin, signal, start_sample, end_sample in self._bins(binsize, bin_overlap=bin_overlap,
+                                                                            continuous=continuous):
+                row = collector.new_bin(i, time_bin, start_sample, end_sample)
+                for j, band in enumerate(sorted_bands):
+                    signal.set_band(band, downsample=downsample, multirate=multirate)
+                    for method_name in method_list:
+                        f = operator.methodcaller(method_name, **kwargs)
+                        try:
+                            output = f(signal)
+                        except Exception as e:
+                            print('There was an error in band %s, feature %s. Setting to None. '
+                                  'Error: %s' % (band, method_name, e))
+                            output = None
+                        collector.set(method_name, (row, j), output)
+
+        # Build the dataset only once all the bins are computed
+        bands_coords = {'band': np.arange(len(sorted_bands)),
+                        'low_freq': ('band', [band[0] for band in sorted_bands]),
+                        'high_freq': ('band', [band[1] for band in sorted_bands])}
         ds = xarray.Dataset()
-        for i, time_bin, signal, start_sample, end_sample in self._bins(binsize, bin_overlap=bin_overlap):
-            ds_bands = xarray.Dataset()
-            for j, band in enumerate(sorted_bands):
-                signal.set_band(band, downsample=downsample)
-                methods_output = xarray.Dataset()
-                for method_name in method_list:
-                    f = operator.methodcaller(method_name, **kwargs)
-                    try:
-                        output = f(signal)
-                    except Exception as e:
-                        print('There was an error in band %s, feature %s. Setting to None. '
-                              'Error: %s' % (band, method_name, e))
-                        output = None
-
-                    units_attrs = output_units.get_units_attrs(method_name=method_name, log=log,
-                                                               p_ref=self.p_ref, **kwargs)
-                    methods_output[method_name] = xarray.DataArray([[output]], coords={'id': [i],
-                                                                                       'datetime': ('id', [time_bin]),
-                                                                                       'start_sample': ('id',
-                                                                                                        [start_sample]),
-                                                                                       'end_sample': (
-                                                                                       'id', [end_sample]),
-                                                                                       'band': [j],
-                                                                                       'low_freq': ('band', [band[0]]),
-                                                                                       'high_freq': (
-                                                                                           'band', [band[1]])},
-                                                                   dims=['id', 'band'],
-                                                                   attrs=units_attrs)
-                if j == 0:
-                    ds_bands = methods_output
-                else:
-                    ds_bands = xarray.concat((ds_bands, methods_output), 'band')
-            if i == 0:
-                ds = ds_bands
-            else:
-                ds = xarray.concat((ds, ds_bands), 'id')
+        for method_name in method_list:
+            units_attrs = output_units.get_units_attrs(method_name=method_name, log=log, p_ref=self.p_ref, **kwargs)
+            ds[method_name] = collector.to_dataarray(method_name, dims=['band'], coords=bands_coords,
+                                                     attrs=units_attrs)
         ds.attrs = self._get_metadata_attrs()
         return ds
 
-    def _apply(self, method_name, binsize=None, db=True, band_list=None, bin_overlap=0, **kwargs):
+    def _apply(self, method_name, binsize=None, db=True, band_list=None, bin_overlap=0, multirate=False, **kwargs):
         """
         Apply one single method
 
@@ -540,9 +740,11 @@ class AcuFile:
             Percentage to overlap the bin windows
         db : bool
             If set to True the result will be given in db, otherwise in upa
+        multirate : bool
+            Set to True to downsample the bands from the decimation pyramid of each bin (see _apply_multiple)
         """
         return self._apply_multiple(method_list=[method_name], binsize=binsize, bin_overlap=bin_overlap,
-                                    db=db, band_list=band_list, **kwargs)
+                                    db=db, band_list=band_list, multirate=multirate, **kwargs)
 
     def rms(self, binsize=None, bin_overlap=0, db=True):
         """
@@ -634,7 +836,151 @@ class AcuFile:
         cumdr['cumsum_dr'] = cumdr.dr.cumsum()
         return cumdr
 
-    def octaves_levels(self, binsize=None, bin_overlap=0, db=True, band=None, **kwargs):
+    def impulsive_events(self, threshold, min_separation=1.0, buffer=0.2,
+                         max_duration=_detector.MAX_EVENT_DURATION, trigger='peak', units='upa', impulsive=True,
+                         energy_window=0.9, decidecade_band=None, chunksize=BATCH_SAMPLES):
+        """
+        Detect the impulsive events of the file (i.e. pile driving strikes) and compute their metrics (peak, rms,
+        sel, pulse width and kurtosis, as _event.Event.analyze). The file is read in chunks and the events are
+        detected with a streaming detector (see _detector.StrikeDetector), which keeps enough samples between chunks
+        so the events are not split. The metrics of the events are computed as soon as they are complete (see
+        _event.analyze_events), so the memory used does not depend on the duration of the file
+
+        Parameters
+        ----------
+        threshold : float
+            Minimum peak pressure of an event, in units
+        min_separation : float
+            Minimum time between the peaks of two events, in seconds
+        buffer : float
+            Time before the peak where the event starts, in seconds
+        max_duration : float or None
+            Maximum duration of an event, in seconds. If None, the events last until the next one starts
+        trigger : str
+            'peak' to detect the peaks of the signal, or 'envelope' to detect the peaks of its envelope
+        units : str
+            Units of the threshold, 'upa' or 'Pa'
+        impulsive : bool
+            Set to True to compute the rms and the pulse width over the energy window, see _event.Event.analyze
+        energy_window : float
+            Percentage of the energy of the event (in 1) used for the impulsive metrics
+        decidecade_band : tuple or None
+            (min_freq, max_freq) of the decidecade bands to compute the band sel of each event (see
+            signal.events_decidecade_sel). If None, the band sel is not computed
+        chunksize : int
+            Number of samples read at once
+
+        Returns
+        -------
+        Dataset with one value per event (dimension id), with the datetime (UTC) and the start and end sample (in
+        the file) of each event as coordinates. If decidecade_band is not None, the band sel is in band_sel
+        (dimensions id and frequency)
+        """
+        if units == 'Pa':
+            threshold = threshold * 1e6
+        elif units != 'upa':
+            raise ValueError('Units %s are not supported, they have to be upa or Pa' % units)
+        detector = _detector.StrikeDetector(self.fs, threshold, min_separation=min_separation, buffer=buffer,
+                                            max_duration=max_duration, trigger=trigger)
+        results = []
+
+        def analyze(starts, ends, signal, offset):
+            if starts.size > 0:
+                metrics = _event.analyze_events(signal, self.fs, starts - offset, ends - offset,
+                                                impulsive=impulsive, energy_window=energy_window)
+                metrics['start_sample'] = starts + self._start_frame
+                metrics['end_sample'] = ends + self._start_frame
+                if decidecade_band is not None:
+                    _, metrics['band_sel'] = sig.events_decidecade_sel(signal, self.fs, starts - offset, ends - offset,
+                                                                       min_freq=decidecade_band[0],
+                                                                       max_freq=decidecade_band[1])
+                results.append(metrics)
+
+        for chunk in self._signal_chunks(chunksize=chunksize):
+            analyze(*detector.process(chunk))
+        analyze(*detector.finish())
+
+        def collect(key, dtype=float):
+            if len(results) == 0:
+                return np.zeros(0, dtype=dtype)
+            return np.concatenate([metrics[key] for metrics in results])
+
+        start_samples = collect('start_sample', dtype=int)
+        datetimes = self.date + pd.to_timedelta(start_samples / self.fs, unit='seconds')
+        if self.timezone != 'UTC':
+            datetimes = pd.to_datetime(datetimes).tz_localize(self.timezone).tz_convert('UTC').tz_convert(None)
+        rms_str = 'rms%s' % int(energy_window * 100) if impulsive else 'rms'
+        ds = xarray.Dataset(coords={'id': np.arange(start_samples.size),
+                                    'datetime': ('id', np.asarray(datetimes, dtype='datetime64[ns]')),
+                                    'start_sample': ('id', start_samples),
+                                    'end_sample': ('id', collect('end_sample', dtype=int))},
+                            attrs=self._get_metadata_attrs())
+        for name, method_name in [('peak', 'peak'), (rms_str, 'rms'), ('sel', 'sel'), ('kurtosis', 'kurtosis')]:
+            ds[name] = ('id', collect(name),
+                        output_units.get_units_attrs(method_name=method_name, log=method_name != 'kurtosis',
+                                                     p_ref=self.p_ref))
+        ds['tau'] = ('id', collect('tau'), {'units': 's', 'standard_name': 'pulse_width'})
+        if decidecade_band is not None:
+            centers, highs, lows = utils.decidecade_bands(decidecade_band[0], decidecade_band[1], bounded=True)
+            band_sel = np.zeros((0, centers.size))
+            if len(results) > 0:
+                band_sel = collect('band_sel')
+            ds = ds.assign_coords(frequency=centers, lower_frequency=('frequency', lows),
+                                  upper_frequency=('frequency', highs))
+            ds['band_sel'] = (('id', 'frequency'), band_sel,
+                              output_units.get_units_attrs(method_name='sel', log=True, p_ref=self.p_ref))
+        return ds
+
+    def strike_exposure(self, threshold, min_separation=1.0, buffer=0.2, max_duration=_detector.MAX_EVENT_DURATION,
+                        trigger='peak', units='upa', decidecade_band=None, pile=_exposure.DEFAULT_PILE,
+                        resolution=_exposure.RESOLUTION, k=_sketch.SKETCH_K, accumulator=None,
+                        chunksize=BATCH_SAMPLES):
+        """
+        Detect the impulsive events of the file (see impulsive_events) and add their sel and peak to an exposure
+        accumulator (see _exposure.ExposureAccumulator), to compute the cumulative SEL, the number of strikes and the
+        percentiles of the single strike levels of a piling campaign without keeping all the events. The
+        accumulators of several files can be merged
+
+        Parameters
+        ----------
+        threshold : float
+            Minimum peak pressure of an event, in units
+        min_separation : float
+            Minimum time between the peaks of two events, in seconds
+        buffer : float
+            Time before the peak where the event starts, in seconds
+        max_duration : float or None
+            Maximum duration of an event, in seconds. If None, the events last until the next one starts
+        trigger : str
+            'peak' to detect the peaks of the signal, or 'envelope' to detect the peaks of its envelope
+        units : str
+            Units of the threshold, 'upa' or 'Pa'
+        decidecade_band : tuple or None
+            (min_freq, max_freq) of the decidecade bands to accumulate the band sel. If None, only broadband
+        pile : str
+            Pile of the strikes of the file
+        resolution : str or pd.Timedelta
+            Time resolution of the accumulated energy (only used if accumulator is None)
+        k : int
+            Size of the quantile sketches (only used if accumulator is None)
+        accumulator : _exposure.ExposureAccumulator or None
+            Accumulator to add the strikes to. If None, a new one is created
+        chunksize : int
+            Number of samples read at once
+
+        Returns
+        -------
+        _exposure.ExposureAccumulator
+        """
+        if accumulator is None:
+            accumulator = _exposure.ExposureAccumulator(resolution=resolution, k=k)
+        events = self.impulsive_events(threshold, min_separation=min_separation, buffer=buffer,
+                                       max_duration=max_duration, trigger=trigger, units=units,
+                                       decidecade_band=decidecade_band, chunksize=chunksize)
+        return accumulator.add_events(events, pile=pile)
+
+    def octaves_levels(self, binsize=None, bin_overlap=0, db=True, band=None, method='filter', multirate=False,
+                       **kwargs):
         """
         Return the octave levels
         Parameters
@@ -647,15 +993,22 @@ class AcuFile:
             Set to True if the result should be in decibels
         band: list or tuple
             List or tuple of [low_frequency, high_frequency]
+        method : str
+            'filter' to use the octave filterbank, or 'fft' to add the power of the fft bins of each band (faster,
+            but not compliant with the filter standards)
+        multirate : bool
+            Set to True to downsample the band from the decimation pyramid of each bin (see Signal.set_band)
 
         Returns
         -------
         DataFrame with multiindex columns with levels method and band. The method is '3-oct'
 
         """
-        return self._octaves_levels(fraction=1, binsize=binsize, bin_overlap=bin_overlap, db=db, band=band)
+        return self._octaves_levels(fraction=1, binsize=binsize, bin_overlap=bin_overlap, db=db, band=band,
+                                    method=method, multirate=multirate)
 
-    def third_octaves_levels(self, binsize=None, bin_overlap=0, db=True, band=None, **kwargs):
+    def third_octaves_levels(self, binsize=None, bin_overlap=0, db=True, band=None, method='filter', multirate=False,
+                             **kwargs):
         """
         Return the octave levels
         Parameters
@@ -668,15 +1021,22 @@ class AcuFile:
             Set to True if the result should be in decibels
         band: list or tuple
             List or tuple of [low_frequency, high_frequency]
+        method : str
+            'filter' to use the 1/3-octave filterbank, or 'fft' to add the power of the fft bins of each band
+            (faster, but not compliant with the filter standards)
+        multirate : bool
+            Set to True to downsample the band from the decimation pyramid of each bin (see Signal.set_band)
 
         Returns
         -------
         DataFrame with multiindex columns with levels method and band. The method is '3-oct'
 
         """
-        return self._octaves_levels(fraction=3, binsize=binsize, bin_overlap=bin_overlap, db=db, band=band)
+        return self._octaves_levels(fraction=3, binsize=binsize, bin_overlap=bin_overlap, db=db, band=band,
+                                    method=method, multirate=multirate)
 
-    def _octaves_levels(self, fraction=1, binsize=None, bin_overlap=0, db=True, band=None):
+    def _octaves_levels(self, fraction=1, binsize=None, bin_overlap=0, db=True, band=None, method='filter',
+                        multirate=False):
         """
         Return the octave levels
         Parameters
@@ -689,6 +1049,12 @@ class AcuFile:
             Percentage to overlap the bin windows
         db: boolean
             Set to True if the result should be in decibels
+        band: list or tuple
+            List or tuple of [low_frequency, high_frequency]
+        method : str
+            'filter' or 'fft' (see signal.octave_bank_levels)
+        multirate : bool
+            Set to True to downsample the band from the decimation pyramid of each bin (see Signal.set_band)
 
         Returns
         -------
@@ -701,23 +1067,24 @@ class AcuFile:
             band = [None, self.fs / 2]
         oct_str = 'oct%s' % fraction
 
-        # Create an empty dataset
-        da = xarray.DataArray()
         units_attrs = output_units.get_units_attrs(method_name='octave_levels', p_ref=self.p_ref, log=db)
-        for i, time_bin, signal, start_sample, end_sample in self._bins(binsize, bin_overlap=bin_overlap):
-            signal.set_band(band, downsample=downsample)
-            fbands, levels = signal.octave_levels(db, fraction)
-            da_levels = xarray.DataArray(data=[levels],
-                                         coords={'id': [i], 'start_sample': ('id', [start_sample]),
-                                                 'end_sample': ('id', [end_sample]), 'datetime': ('id', [time_bin]),
-                                                 'frequency': fbands},
-                                         dims=['id', 'frequency']
-                                         )
-            if i == 0:
-                da = da_levels
-            else:
-                da = xarray.concat((da, da_levels), 'id')
-        da.attrs.update(units_attrs)
+        collector = self._bin_collector(binsize, bin_overlap=bin_overlap)
+        fbands = None
+        is_broadband = band[0] in [0, None] and band[1] in [self.fs / 2, None]
+        if is_broadband:
+            # No filtering needed: compute the levels of all the bins of each batch at once
+            for ids, time_bins, blocks, start_samples, end_samples in \
+                    self._bin_batches(binsize, bin_overlap=bin_overlap, dc_subtract=self._batch_dc_subtract(band)):
+                rows = collector.new_bins(ids, time_bins, start_samples, end_samples)
+                fbands, levels = sig.octave_bank_levels(blocks, self.fs, fraction=fraction, db=db, method=method)
+                collector.set_bins(oct_str, rows, levels)
+        else:
+            for i, time_bin, signal, start_sample, end_sample in self._bins(binsize, bin_overlap=bin_overlap):
+                row = collector.new_bin(i, time_bin, start_sample, end_sample)
+                signal.set_band(band, downsample=downsample, multirate=multirate)
+                fbands, levels = signal.octave_levels(db, fraction, method=method)
+                collector.set(oct_str, row, levels)
+        da = collector.to_dataarray(oct_str, dims=['frequency'], coords={'frequency': fbands}, attrs=units_attrs)
         ds = xarray.Dataset(data_vars={oct_str: da}, attrs=self._get_metadata_attrs())
         return ds
 
@@ -801,22 +1168,16 @@ class AcuFile:
         if band is None:
             band = [None, self.fs / 2]
 
-        da = xarray.DataArray()
+        collector = self._bin_collector(binsize, bin_overlap=bin_overlap)
+        freq, t = None, None
         for i, time_bin, signal, start_sample, end_sample in self._bins(binsize, bin_overlap=bin_overlap):
+            row = collector.new_bin(i, time_bin, start_sample, end_sample)
             signal.set_band(band, downsample=downsample)
             freq, t, sxx = signal.spectrogram(nfft=nfft, overlap=fft_overlap, scaling=scaling, db=db)
-            da_sxx = xarray.DataArray([sxx], coords={'id': [i],
-                                                     'start_sample': ('id', [start_sample]),
-                                                     'end_sample': ('id', [end_sample]),
-                                                     'datetime': ('id', [time_bin]),
-                                                     'frequency': freq, 'time': t},
-                                      dims=['id', 'frequency', 'time'])
-            if i == 0:
-                da = da_sxx
-            else:
-                da = xarray.concat((da, da_sxx), 'id')
+            collector.set('spectrogram', row, sxx)
         units_attrs = output_units.get_units_attrs(method_name='spectrogram_' + scaling, p_ref=self.p_ref, log=db)
-        da.attrs.update(units_attrs)
+        da = collector.to_dataarray('spectrogram', dims=['frequency', 'time'], coords={'frequency': freq, 'time': t},
+                                    attrs=units_attrs)
         ds = xarray.Dataset(data_vars={'spectrogram': da}, attrs=self._get_metadata_attrs())
         return ds
 
@@ -855,35 +1216,38 @@ class AcuFile:
             band = [None, self.fs / 2]
 
         spectrum_str = 'band_' + scaling
-        ds = xarray.DataArray()
-        for i, time_bin, signal, start_sample, end_sample in self._bins(binsize, bin_overlap=bin_overlap):
-            signal.set_band(band, downsample=downsample)
-            fbands, spectra, percentiles_val = signal.spectrum(scaling=scaling, nfft=nfft, db=db,
-                                                               percentiles=percentiles, overlap=fft_overlap)
-
-            spectra_da = xarray.DataArray([spectra],
-                                          coords={'id': [i],
-                                                  'datetime': ('id', [time_bin]),
-                                                  'frequency': fbands,
-                                                  'start_sample': ('id',
-                                                                   [start_sample]),
-                                                  'end_sample': ('id', [end_sample]),
-                                                  },
-                                          dims=['id', 'frequency'])
-            percentiles_da = xarray.DataArray([percentiles_val],
-                                              coords={'id': [i], 'datetime': ('id', [time_bin]),
-                                                      'percentiles': percentiles},
-                                              dims=['id', 'percentiles'])
-
-            ds_bin = xarray.Dataset({spectrum_str: spectra_da, 'value_percentiles': percentiles_da})
-            if i == 0:
-                ds = ds_bin
-            else:
-                ds = xarray.concat((ds, ds_bin), 'id')
+        collector = self._bin_collector(binsize, bin_overlap=bin_overlap)
+        collector.add_variable('value_percentiles', shape=(len(percentiles),))
+        fbands = None
+        blocksize, _ = self._blocksize(binsize, bin_overlap=bin_overlap)
+        is_broadband = band[0] in [0, None] and band[1] in [self.fs / 2, None]
+        if is_broadband and nfft <= blocksize:
+            # No filtering needed: compute the spectra of all the bins of each batch at once
+            for ids, time_bins, blocks, start_samples, end_samples in \
+                    self._bin_batches(binsize, bin_overlap=bin_overlap, dc_subtract=self._batch_dc_subtract(band)):
+                rows = collector.new_bins(ids, time_bins, start_samples, end_samples)
+                fbands, spectra, percentiles_val = sig.blocks_spectrum(blocks, fs=self.fs, scaling=scaling,
+                                                                       nfft=nfft, db=db, overlap=fft_overlap,
+                                                                       percentiles=percentiles)
+                collector.set_bins(spectrum_str, rows, spectra)
+                collector.set_bins('value_percentiles', rows, percentiles_val)
+        else:
+            for i, time_bin, signal, start_sample, end_sample in self._bins(binsize, bin_overlap=bin_overlap):
+                row = collector.new_bin(i, time_bin, start_sample, end_sample)
+                signal.set_band(band, downsample=downsample)
+                fbands, spectra, percentiles_val = signal.spectrum(scaling=scaling, nfft=nfft, db=db,
+                                                                   percentiles=percentiles, overlap=fft_overlap)
+                collector.set(spectrum_str, row, spectra)
+                collector.set('value_percentiles', row, percentiles_val)
+
         units_attrs = output_units.get_units_attrs(method_name='spectrum_' + scaling, log=db, p_ref=self.p_ref)
-        ds[spectrum_str].attrs.update(units_attrs)
-        ds['value_percentiles'].attrs.update({'units': '%', 'standard_name': 'percentiles'})
-        ds.attrs = self._get_metadata_attrs()
+        spectra_da = collector.to_dataarray(spectrum_str, dims=['frequency'], coords={'frequency': fbands},
+                                            attrs=units_attrs)
+        percentiles_da = collector.to_dataarray('value_percentiles', dims=['percentiles'],
+                                                coords={'percentiles': percentiles},
+                                                attrs={'units': '%', 'standard_name': 'percentiles'})
+        ds = xarray.Dataset({spectrum_str: spectra_da, 'value_percentiles': percentiles_da},
+                            attrs=self._get_metadata_attrs())
         return ds
 
     def psd(self, binsize=None, bin_overlap=0, nfft=512, fft_overlap=0.5, db=True, percentiles=None, band=None):
@@ -997,6 +1361,84 @@ class AcuFile:
                                  bin_overlap=bin_overlap, band=band)
         return utils.compute_spd(psd_evolution, h=h, percentiles=percentiles, max_val=max_val, min_val=min_val)
 
+    def spd_histogram(self, binsize=None, bin_overlap=0, h=0.1, nfft=512, fft_overlap=0.5,
+                      db=True, min_val=None, max_val=None, band=None, accumulator=None):
+        """
+        Add the psd of all the bins of the file to a streaming spectral probability density (see
+        utils.SpdAccumulator). The accumulators of several files can be merged, so the spd of a long survey can be
+        computed without keeping all the psd in memory
+
+        Parameters
+        ----------
+        binsize : float, in sec
+            Time window considered. If set to None, only one value is returned
+        bin_overlap : float [0 to 1]
+            Percentage to overlap the bin windows
+        h : float
+            Histogram bin width (in the correspondent units, upa or db)
+        nfft : int
+            Length of the fft window in samples. Power of 2.
+        fft_overlap : float [0 to 1]
+            Percentage to overlap the bin windows
+        db : bool
+            If set to True the result will be given in db, otherwise in upa^2
+        min_val : float
+            Minimum value to compute the SPD histogram
+        max_val : float
+            Maximum value to compute the SPD histogram
+        band : tuple or None
+            Band to filter the spectrogram in. A band is represented with a tuple - or a list - as
+            (low_freq, high_freq). If set to None, the broadband up to the Nyquist frequency will be analyzed
+        accumulator : utils.SpdAccumulator or None
+            Accumulator to add the psd to. If None, a new one is created with h, min_val and max_val
+
+        Returns
+        -------
+        utils.SpdAccumulator
+        """
+        if accumulator is None:
+            accumulator = utils.SpdAccumulator(h=h, min_val=min_val, max_val=max_val)
+        psd_evolution = self.psd(binsize=binsize, nfft=nfft, fft_overlap=fft_overlap, db=db, percentiles=[],
+                                 bin_overlap=bin_overlap, band=band)
+        return accumulator.add(psd_evolution)
+
+    def spectrum_sketch(self, scaling='density', binsize=None, bin_overlap=0, nfft=512, fft_overlap=0.5, db=True,
+                        band=None, k=_sketch.SKETCH_K, sketch=None):
+        """
+        Add the spectrum of all the bins of the file to a quantile sketch (see _sketch.QuantileSketch), to compute
+        the percentiles of the spectrum of long periods without keeping all the spectra in memory. The sketches of
+        several files can be merged
+
+        Parameters
+        ----------
+        scaling : string
+            Can be set to 'spectrum' or 'density' depending on the desired output
+        binsize : float, in sec
+            Time window considered. If set to None, only one value is returned
+        bin_overlap : float [0 to 1]
+            Percentage to overlap the bin windows
+        nfft : int
+            Length of the fft window in samples. Power of 2.
+        fft_overlap : float [0 to 1]
+            Percentage to overlap the bin windows
+        db : bool
+            If set to True the result will be given in db, otherwise in upa^2
+        band : tuple or None
+            Band to filter the spectrogram in. A band is represented with a tuple - or a list - as
+            (low_freq, high_freq). If set to None, the broadband up to the Nyquist frequency will be analyzed
+        k : int
+            Size of the sketch (only used if sketch is None)
+        sketch : _sketch.QuantileSketch or None
+            Sketch to add the spectra to. If None, a new one is created
+
+        Returns
+        -------
+        _sketch.QuantileSketch with one series per frequency
+        """
+        spectrum_ds = self._spectrum(scaling=scaling, binsize=binsize, nfft=nfft, fft_overlap=fft_overlap, db=db,
+                                     bin_overlap=bin_overlap, percentiles=[], band=band)
+        return _sketch.sketch_dataarray(spectrum_ds['band_%s' % scaling], 'id', k=k, sketch=sketch)
+
     def plot_spectrum_median(self, scaling='density', db=True, log=True, save_path=None, **kwargs):
         """
         Plot the power spectrogram density of all the file (units^2 / Hz) re 1 V 1 upa
@@ -1071,3 +1513,15 @@ class AcuFile:
 
     def update_freq_cal(self, ds, data_var, **kwargs):
         return utils.update_freq_cal(hydrophone=self.hydrophone, ds=ds, data_var=data_var, **kwargs)
+
+
+def _with_next(iterable):
+    """
+    Yields each element of iterable together with the next one (None for the last element)
+    """
+    iterator = iter(iterable)
+    current = next(iterator, None)
+    while current is not None:
+        following = next(iterator, None)
+        yield current, following
+        current = following
@@ -4,6 +4,8 @@ __credits__ = "Clea Parcerisas"
 __email__ = "clea.parcerisas@vliz.be"
 __status__ = "Development"
 
+import collections
+import concurrent.futures
 import datetime
 import operator
 import os
@@ -18,8 +20,16 @@ import seaborn as sns
 import xarray
 from tqdm import tqdm
 
+from pypam import _checkpoint
+from pypam import _detector
+from pypam import _exposure
+from pypam import _filters
+from pypam import _sketch
+from pypam import _sink
 from pypam import acoustic_file
 from pypam import plots
+from pypam import signal as sig
+from pypam import units as output_units
 from pypam import utils
 
 # Apply the default theme
@@ -59,6 +69,19 @@ class ASA:
         Set to True to subtract the dc noise (root mean squared value)
     timezone: datetime.tzinfo, pytz.tzinfo.BaseTZInfo, dateutil.tz.tz.tzfile, str or None
         Timezone where the data was recorded in
+    n_jobs: int
+        Number of processes used to process the files in parallel. Set to -1 to use all the available cores. If it is
+        bigger than 1, each file is processed in a separate process and the outputs are merged in chronological order.
+        An error in one file is then reported and the file is skipped, without stopping the rest of the survey.
+        Zipped folders are always processed sequentially
+    checkpoint_dir: str, Path or None
+        If it is not None, the output of each file of the evolution methods is saved in this folder as a netCDF file
+        (shard) as soon as it is computed. If the processing is interrupted, running it again will skip the files which
+        already have a shard (same file path, size, modification time and processing parameters). At the end, the
+        shards are opened lazily and merged. Not available for zipped folders
+    dtype: str or numpy dtype
+        Float type used to read and process the signal and to store the outputs of each file. Set to 'float32' to
+        halve the memory used (with less precision)
     """
 
     def __init__(self,
@@ -77,7 +100,10 @@ class ASA:
                  channel=0,
                  calibration=None,
                  dc_subtract=False,
-                 extra_attrs=None):
+                 extra_attrs=None,
+                 n_jobs=1,
+                 checkpoint_dir=None,
+                 dtype='float64'):
 
         self.hydrophone = hydrophone
         self.acu_files = AcousticFolder(folder_path=folder_path, zipped=zipped,
@@ -108,6 +134,16 @@ class ASA:
 
         self.file_dependent_attrs = ['file_path', '_start_frame', 'end_to_end_calibration']
 
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        self.n_jobs = n_jobs
+        self.failed_files = []
+
+        if checkpoint_dir is not None:
+            checkpoint_dir = pathlib.Path(checkpoint_dir)
+        self.checkpoint_dir = checkpoint_dir
+        self.dtype = dtype
+
     def _files(self):
         """
         Iterator that returns AcuFile for each wav file in the folder
@@ -119,6 +155,130 @@ class ASA:
             if sound_file.is_in_period(self.period) and sound_file.file.frames > 0:
                 yield sound_file
 
+    def _apply_to_files(self, f, checkpoint=False, skip=None):
+        """
+        Iterator that applies f to the AcuFile of each wav file in the folder and returns its output.
+        If n_jobs is bigger than 1, the files are processed in a pool of processes, but the outputs are still returned
+        in the same (chronological) order than the files. The files which raise an error are reported, added to
+        failed_files and skipped.
+
+        Parameters
+        ----------
+        f : callable
+            Function to apply to each AcuFile (i.e. an operator.methodcaller)
+        checkpoint : bool
+            Set to True if the output of f is a Dataset which can be stored in checkpoint_dir (if not None). Then the
+            outputs are read (lazily) from the shards
+        skip : set or None
+            Keys (see _shard_key) of the files which do not have to be processed, i.e. because their output was
+            already used in a previous run. Not used for zipped folders
+        """
+        self.failed_files = []
+        checkpoint = checkpoint and (self.checkpoint_dir is not None) and (not self.acu_files.zipped)
+        if self.acu_files.zipped or not skip:
+            skip = None
+        if self.n_jobs == 1 or self.acu_files.zipped:
+            for sound_file in self._files():
+                if skip is not None and self._shard_key(sound_file.file_path, f) in skip:
+                    continue
+                if checkpoint:
+                    path = self._shard_path(sound_file.file_path, f)
+                    if not path.exists():
+                        _checkpoint.save_shard(f(sound_file), path)
+                    yield _checkpoint.load_shard(path)
+                else:
+                    yield f(sound_file)
+        else:
+            # The workers start with the filters already designed in this process, and with this survey (sent only
+            # once per worker). Only 2 * n_jobs files are processed ahead of the one being returned, so the outputs
+            # which are not returned yet do not fill the memory
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker,
+                                                        initargs=(_filters.FILTER_CACHE, self)) as executor:
+                pending = collections.deque()
+                for file_list in tqdm(self.acu_files):
+                    wav_file = file_list[0]
+                    if skip is not None and self._shard_key(wav_file, f) in skip:
+                        continue
+                    path = None
+                    future = None
+                    if checkpoint:
+                        path = self._shard_path(wav_file, f)
+                    if path is None or not path.exists():
+                        future = executor.submit(_apply_to_file, wav_file, f, path)
+                    pending.append((wav_file, path, future))
+                    if len(pending) > 2 * self.n_jobs:
+                        yield from self._pool_output(*pending.popleft())
+                while len(pending) > 0:
+                    yield from self._pool_output(*pending.popleft())
+
+    def _pool_output(self, wav_file, path, future):
+        """
+        Iterator that returns the output of one file processed in the pool of processes (see _apply_to_files), if it
+        did not fail and it is in the period
+
+        Parameters
+        ----------
+        wav_file : str or Path
+            Sound file
+        path : Path or None
+            Shard where the output is stored, if checkpointed
+        future : concurrent.futures.Future or None
+            Processing of the file. None if the shard already existed
+        """
+        output = None
+        if future is not None:
+            try:
+                in_period, output = future.result()
+            except Exception as e:
+                print('There was an error in file %s. Skipping it. Error: %s' % (wav_file, e))
+                self.failed_files.append(wav_file)
+                return
+            if not in_period:
+                return
+        if path is not None:
+            output = _checkpoint.load_shard(path)
+        yield output
+
+    def _shard_params(self, f):
+        """
+        Return the processing parameters which identify the output of f (see _checkpoint.shard_key)
+
+        Parameters
+        ----------
+        f : callable
+            Function applied to each AcuFile (its representation is part of the processing parameters)
+        """
+        params = self._get_metadata_attrs()
+        params.update({'method': repr(f), 'calibration': self.calibration, 'period': self.period,
+                       'dtype': str(self.dtype)})
+        return params
+
+    def _shard_key(self, wav_file, f):
+        """
+        Return the key of the output of f for wav_file (see _checkpoint.shard_key)
+
+        Parameters
+        ----------
+        wav_file : str or Path
+            Sound file
+        f : callable
+            Function applied to each AcuFile
+        """
+        return _checkpoint.shard_key(wav_file, self._shard_params(f))
+
+    def _shard_path(self, wav_file, f):
+        """
+        Return the path of the shard of wav_file in the checkpoint_dir
+
+        Parameters
+        ----------
+        wav_file : str or Path
+            Sound file
+        f : callable
+            Function applied to each AcuFile (its representation is part of the processing parameters)
+        """
+        return _checkpoint.shard_path(self.checkpoint_dir, wav_file, self._shard_params(f))
+
     def _hydro_file(self, wav_file):
         """
         Return the AcuFile object from the wav_file
@@ -133,7 +293,7 @@ class ASA:
         """
         hydro_file = acoustic_file.AcuFile(sfile=wav_file, hydrophone=self.hydrophone, p_ref=self.p_ref,
                                            timezone=self.timezone, channel=self.channel, calibration=self.calibration,
-                                           dc_subtract=self.dc_subtract)
+                                           dc_subtract=self.dc_subtract, dtype=self.dtype)
         return hydro_file
     
     def _get_metadata_attrs(self):
@@ -164,7 +324,37 @@ class ASA:
 
         return metadata_attrs
 
-    def evolution_multiple(self, method_list: list, band_list=None, **kwargs):
+    def _merge_outputs(self, f, store=None, chunks=None):
+        """
+        Apply f to all the files and merge the outputs in one DataSet. If store is given, the output of each file is
+        appended to a zarr store as soon as it is computed instead of keeping all of them in memory
+
+        Parameters
+        ----------
+        f : function
+            Function to apply to each AcuFile
+        store : str, Path or None
+            Path of the zarr store where to write the output. If None, the output is merged in memory
+        chunks : dict, 'ltsa' or None
+            Chunks of the zarr store (see _sink.ZarrSink)
+
+        Returns
+        -------
+        xarray DataSet. If store is given, the DataSet is opened lazily from the store
+        """
+        ds = xarray.Dataset(attrs=self._get_metadata_attrs())
+        if store is None:
+            ds_list = list(self._apply_to_files(f, checkpoint=True))
+            return utils.merge_ds_list(ds, ds_list, self.file_dependent_attrs)
+        sink = _sink.ZarrSink(store, self.file_dependent_attrs, attrs=ds.attrs, chunks=chunks)
+        for output in self._apply_to_files(f, checkpoint=True):
+            sink.append(output)
+        if sink.n_ids == 0:
+            return ds
+        return sink.open()
+
+    def evolution_multiple(self, method_list: list, band_list=None, store=None, chunks=None, multirate=False,
+                           **kwargs):
         """
         Compute the method in each file and output the evolution
         Returns a xarray DataSet with datetime as index and one row for each bin of each file
@@ -177,19 +367,24 @@ class ASA:
             Bands to filter. Can be multiple bands (all of them will be analyzed) or only one band. A band is
             represented with a tuple as (low_freq, high_freq). If set to None, the broadband up to the Nyquist
             frequency will be analyzed
+        store : str, Path or None
+            If given, the output of each file is appended to a zarr store in this path instead of being kept in
+            memory, and the returned DataSet is opened lazily from the store. Requires zarr
+        chunks : dict, 'ltsa' or None
+            Chunk size of each dimension of the zarr store. Only used if store is given. Set to 'ltsa' to
+            optimize the store for plotting long-term spectrograms
+        multirate : bool
+            Set to True to downsample the bands from the decimation pyramid of each bin (see
+            AcuFile._apply_multiple), so all the bands share the same decimations
         **kwargs :
             Any accepted parameter for the method_name
         """
-        ds = xarray.Dataset(attrs=self._get_metadata_attrs())
         f = operator.methodcaller('_apply_multiple', method_list=method_list, binsize=self.binsize,
                                   nfft=self.nfft, fft_overlap=self.fft_overlap, bin_overlap=self.bin_overlap,
-                                  band_list=band_list, **kwargs)
-        for sound_file in self._files():
-            ds_output = f(sound_file)
-            ds = utils.merge_ds(ds, ds_output, self.file_dependent_attrs)
-        return ds
+                                  band_list=band_list, multirate=multirate, **kwargs)
+        return self._merge_outputs(f, store=store, chunks=chunks)
 
-    def evolution(self, method_name, band_list=None, **kwargs):
+    def evolution(self, method_name, band_list=None, multirate=False, **kwargs):
         """
         Evolution of only one param name
 
@@ -201,28 +396,109 @@ class ASA:
             Bands to filter. Can be multiple bands (all of them will be analyzed) or only one band. A band is
             represented with a tuple as (low_freq, high_freq). If set to None, the broadband up to the Nyquist
             frequency will be analyzed
+        multirate : bool
+            Set to True to downsample the bands from the decimation pyramid of each bin (see evolution_multiple)
         **kwargs : any arguments to be passed to the method
         """
-        return self.evolution_multiple(method_list=[method_name], band_list=band_list, **kwargs)
+        return self.evolution_multiple(method_list=[method_name], band_list=band_list, multirate=multirate, **kwargs)
 
-    def evolution_freq_dom(self, method_name, **kwargs):
+    def evolution_freq_dom(self, method_name, store=None, chunks=None, **kwargs):
         """
         Returns the evolution of frequency domain parameters
         Parameters
         ----------
         method_name : str
             Name of the method of the acoustic_file class to compute
+        store : str, Path or None
+            If given, the output of each file is appended to a zarr store in this path instead of being kept in
+            memory, and the returned DataSet is opened lazily from the store. Requires zarr
+        chunks : dict, 'ltsa' or None
+            Chunk size of each dimension of the zarr store. Only used if store is given. Set to 'ltsa' to
+            optimize the store for plotting long-term spectrograms
+        **kwargs :
+            Any accepted parameter for the method_name (i.e. multirate for octaves_levels and
+            third_octaves_levels)
         Returns
         -------
         A xarray DataSet with a row per bin with the method name output
         """
-        ds = xarray.Dataset(attrs=self._get_metadata_attrs())
         f = operator.methodcaller(method_name, binsize=self.binsize, nfft=self.nfft, fft_overlap=self.fft_overlap,
                                   bin_overlap=self.bin_overlap, **kwargs)
+        return self._merge_outputs(f, store=store, chunks=chunks)
+
+    def continuous_spectrum(self, scaling='density', db=True, percentiles=None, max_gap=1.0):
+        """
+        Returns the evolution of the spectrum computing the bins across the file boundaries: consecutive files are
+        treated as one continuous signal, so a bin can span several files (i.e. hourly spectra from 5-minute files).
+        The signal is streamed, so the memory used does not depend on binsize.
+        If there is a gap between two files (or the sampling rate changes), the current bin is finished (if it contains
+        at least one fft window) and the next bin starts at the beginning of the next file.
+        The bins can not overlap and dc_subtract is not applied. Only the broadband spectrum is computed.
+
+        Parameters
+        ----------
+        scaling : string
+            Can be set to 'spectrum' or 'density' depending on the desired output
+        db : bool
+            If set to True the result will be given in db, otherwise in upa^2
+        percentiles : list or None
+            List of all the percentiles that have to be returned. If set to empty list,
+            no percentiles is returned
+        max_gap : float
+            Maximum difference in seconds between the end of a file and the start of the next one to consider them
+            continuous
+
+        Returns
+        -------
+        A xarray DataSet with a row per bin with the band_density (or band_spectrum) and the value_percentiles
+        """
+        if self.bin_overlap != 0:
+            raise ValueError('The continuous spectrum can not be computed with overlapping bins.')
+        if percentiles is None:
+            percentiles = []
+        accumulator = None
+        run_start = None
+        expected_start = None
+        datetimes = []
+        spectra = []
+
+        def add_bins(bins):
+            for bin_start, spectrum in bins:
+                datetimes.append(run_start + datetime.timedelta(seconds=bin_start / accumulator.fs))
+                spectra.append(spectrum)
+
         for sound_file in self._files():
-            ds_output = f(sound_file)
-            ds = utils.merge_ds(ds, ds_output, self.file_dependent_attrs)
-        return ds
+            file_start = sound_file._time_array(binsize=None)[0][0]
+            is_continuous = (accumulator is not None and accumulator.fs == sound_file.fs and
+                             abs((file_start - expected_start).total_seconds()) <= max_gap)
+            if not is_continuous:
+                if accumulator is not None:
+                    add_bins(accumulator.flush())
+                bin_samples = None if self.binsize is None else sound_file.samples(self.binsize)
+                accumulator = sig.WelchAccumulator(fs=sound_file.fs, bin_samples=bin_samples, nfft=self.nfft,
+                                                   overlap=self.fft_overlap, scaling=scaling)
+                run_start = file_start
+            for chunk in sound_file._signal_chunks():
+                add_bins(accumulator.add(chunk))
+            expected_start = run_start + datetime.timedelta(seconds=accumulator.n_samples / accumulator.fs)
+        if accumulator is None:
+            return xarray.Dataset(attrs=self._get_metadata_attrs())
+        add_bins(accumulator.flush())
+
+        spectra = np.array(spectra).reshape((len(spectra), accumulator.freq.size))
+        if db:
+            spectra = utils.to_db(spectra, ref=1.0, square=False)
+        percentiles_val = np.percentile(spectra, percentiles, axis=1).T
+        spectrum_str = 'band_' + scaling
+        coords = {'id': np.arange(len(datetimes)), 'datetime': ('id', pd.to_datetime(datetimes).values)}
+        units_attrs = output_units.get_units_attrs(method_name='spectrum_' + scaling, log=db, p_ref=self.p_ref)
+        spectra_da = xarray.DataArray(spectra, coords=dict(coords, frequency=accumulator.freq),
+                                      dims=['id', 'frequency'], attrs=units_attrs)
+        percentiles_da = xarray.DataArray(percentiles_val, coords=dict(coords, percentiles=percentiles),
+                                          dims=['id', 'percentiles'],
+                                          attrs={'units': '%', 'standard_name': 'percentiles'})
+        return xarray.Dataset({spectrum_str: spectra_da, 'value_percentiles': percentiles_da},
+                              attrs=self._get_metadata_attrs())
 
     def timestamps_array(self):
         """
@@ -230,10 +506,8 @@ class ASA:
         """
         ds = xarray.Dataset(attrs=self._get_metadata_attrs())
         f = operator.methodcaller('timestamp_da', binsize=self.binsize, bin_overlap=self.bin_overlap)
-        for sound_file in self._files():
-            ds_output = f(sound_file)
-            ds = utils.merge_ds(ds, ds_output, self.file_dependent_attrs)
-        return ds
+        ds_list = list(self._apply_to_files(f))
+        return utils.merge_ds_list(ds, ds_list, self.file_dependent_attrs)
 
     def start_end_timestamp(self):
         """
@@ -267,8 +541,8 @@ class ASA:
         """
         f = operator.methodcaller(method_name, binsize=self.binsize, nfft=self.nfft, fft_overlap=self.fft_overlap,
                                   bin_overlap=self.bin_overlap, **kwargs)
-        for sound_file in self._files():
-            f(sound_file)
+        for _ in self._apply_to_files(f):
+            pass
 
     def duration(self):
         """
@@ -296,7 +570,15 @@ class ASA:
 
     def spd(self, db=True, h=0.1, percentiles=None, min_val=None, max_val=None):
         """
-        Return the empirical power density.
+        Return the empirical power density. The histogram of each file is computed separately (in parallel if
+        n_jobs > 1) and they are merged, so only the histograms are kept in memory (see utils.SpdAccumulator).
+        The output is not the same as the one of utils.compute_spd on all the psd of the survey. The histogram
+        edges are min_val + k * h, and if min_val is None they start at 0 instead of at the minimum of the data
+        (which is not known until all the files are processed), so the edges and the number of bins are different.
+        Set min_val (and max_val) to get fixed edges. The percentiles are interpolated from the histogram instead of
+        computed from all the values, so their error is lower than h (i.e. a few tenths of db with h=1). For the
+        exact output, use utils.compute_spd(self.evolution_freq_dom('psd', db=db), h=h, ...), which keeps the psd of
+        all the bins in memory.
 
         Parameters
         ----------
@@ -308,9 +590,9 @@ class ASA:
             All the percentiles that have to be returned. If set to None, no percentiles
             is returned (in 100 per cent)
         min_val : float
-            Minimum value to compute the SPD histogram
+            Minimum value to compute the SPD histogram. If None, the histogram starts at 0
         max_val : float
-            Maximum value to compute the SPD histogram
+            Maximum value to compute the SPD histogram. If None, the histogram goes up to the maximum of the data
 
         Returns
         -------
@@ -319,8 +601,102 @@ class ASA:
         p : np.array
             Matrix with all the probabilities
         """
-        psd_evolution = self.evolution_freq_dom('psd', db=db, percentiles=percentiles)
-        return utils.compute_spd(psd_evolution, h=h, percentiles=percentiles, min_val=min_val, max_val=max_val)
+        f = operator.methodcaller('spd_histogram', binsize=self.binsize, nfft=self.nfft, fft_overlap=self.fft_overlap,
+                                  bin_overlap=self.bin_overlap, db=db, h=h, min_val=min_val, max_val=max_val)
+        accumulator = utils.SpdAccumulator(h=h, min_val=min_val, max_val=max_val)
+        for file_accumulator in self._apply_to_files(f):
+            accumulator.merge(file_accumulator)
+        return accumulator.to_dataset(percentiles=percentiles)
+
+    def strike_exposure(self, threshold, min_separation=1.0, buffer=0.2, max_duration=_detector.MAX_EVENT_DURATION,
+                        trigger='peak', units='upa', decidecade_band=None, piles=None,
+                        resolution=_exposure.RESOLUTION, k=_sketch.SKETCH_K, accumulator=None):
+        """
+        Accumulate the exposure to the impulsive events (i.e. pile driving strikes) of all the survey. The events of
+        each file are detected and analyzed (see AcuFile.impulsive_events), in parallel if n_jobs > 1 and stored in
+        checkpoint_dir if it is set, and their sel and peak are added to an exposure accumulator (see
+        _exposure.ExposureAccumulator). The SELcum over 24 h or over each pile, the number of strikes and the
+        percentiles of the single strike levels are then computed from the accumulator, which can be saved to
+        continue the campaign later or merged with the accumulators of other surveys
+
+        Parameters
+        ----------
+        threshold : float
+            Minimum peak pressure of an event, in units
+        min_separation : float
+            Minimum time between the peaks of two events, in seconds
+        buffer : float
+            Time before the peak where the event starts, in seconds
+        max_duration : float or None
+            Maximum duration of an event, in seconds. If None, the events last until the next one starts
+        trigger : str
+            'peak' to detect the peaks of the signal, or 'envelope' to detect the peaks of its envelope
+        units : str
+            Units of the threshold, 'upa' or 'Pa'
+        decidecade_band : tuple or None
+            (min_freq, max_freq) of the decidecade bands to accumulate the band sel. If None, only broadband
+        piles : dict or None
+            Pile of the strikes of each file, with the names of the files as keys. The files which are not in it
+            are assigned to _exposure.DEFAULT_PILE
+        resolution : str or pd.Timedelta
+            Time resolution of the accumulated energy (only used if accumulator is None)
+        k : int
+            Size of the quantile sketches (only used if accumulator is None)
+        accumulator : _exposure.ExposureAccumulator or None
+            Accumulator to add the strikes to (i.e. loaded from a previous run). If None, a new one is created.
+            The files already added to it with the same parameters (see _checkpoint.shard_key) are skipped, so a
+            campaign can be resumed on the same folder without counting its strikes twice (not for zipped folders)
+
+        Returns
+        -------
+        _exposure.ExposureAccumulator
+        """
+        if piles is None:
+            piles = {}
+        if accumulator is None:
+            accumulator = _exposure.ExposureAccumulator(resolution=resolution, k=k)
+        f = operator.methodcaller('impulsive_events', threshold, min_separation=min_separation, buffer=buffer,
+                                  max_duration=max_duration, trigger=trigger, units=units,
+                                  decidecade_band=decidecade_band)
+        for events in self._apply_to_files(f, checkpoint=True, skip=accumulator.sources):
+            file_path = pathlib.Path(events.attrs['file_path'])
+            source = None if self.acu_files.zipped else self._shard_key(file_path, f)
+            accumulator.add_events(events, pile=piles.get(file_path.name, _exposure.DEFAULT_PILE), source=source)
+        return accumulator
+
+    def spectrum_percentiles(self, percentiles, scaling='density', db=True, band=None, k=_sketch.SKETCH_K):
+        """
+        Percentiles of the spectrum of each frequency over all the survey (i.e. L5, L50 and L95). The spectra of each
+        file are added to a quantile sketch (in parallel if n_jobs > 1) and the sketches are merged, so only the
+        sketches are kept in memory. See _sketch.QuantileSketch for the error of the percentiles (the bound of
+        the rank error is stored in the attribute rank_error)
+
+        Parameters
+        ----------
+        percentiles : list
+            Percentiles to compute (in 100 per cent)
+        scaling : string
+            Can be set to 'spectrum' or 'density' depending on the desired output
+        db : bool
+            If set to True the result will be given in db, otherwise in upa^2
+        band : tuple or None
+            Band to filter the spectrogram in. A band is represented with a tuple - or a list - as
+            (low_freq, high_freq). If set to None, the broadband up to the Nyquist frequency will be analyzed
+        k : int
+            Size of the sketch. The bigger, the more accurate
+
+        Returns
+        -------
+        An xarray DataSet with the value_percentiles of each frequency
+        """
+        f = operator.methodcaller('spectrum_sketch', scaling=scaling, binsize=self.binsize, nfft=self.nfft,
+                                  fft_overlap=self.fft_overlap, bin_overlap=self.bin_overlap, db=db, band=band, k=k)
+        sketch = _sketch.QuantileSketch(k=k)
+        for file_sketch in self._apply_to_files(f):
+            sketch.merge(file_sketch)
+        percentiles_ds = xarray.Dataset({'value_percentiles': _sketch.percentiles_dataarray(sketch, percentiles)})
+        percentiles_ds.attrs = self._get_metadata_attrs()
+        return percentiles_ds
 
     def hybrid_millidecade_bands(self, db=True, method='spectrum', band=None, percentiles=None):
         """
@@ -606,6 +982,54 @@ class AcousticFolder:
         return n_files
 
 
+# Survey of the files processed in a worker process (see _init_worker)
+_WORKER_ASA = None
+
+
+def _init_worker(filter_cache, asa):
+    """
+    Initialize a worker process of ASA with the filter cache of the main process and the survey
+
+    Parameters
+    ----------
+    filter_cache : _filters.FilterCache
+        Cache of the main process
+    asa : ASA
+        Acoustic survey the files belong to
+    """
+    global _WORKER_ASA
+    _filters.FILTER_CACHE.update(filter_cache)
+    _WORKER_ASA = asa
+
+
+def _apply_to_file(wav_file, f, path=None):
+    """
+    Apply f to the AcuFile of wav_file. Used by the worker processes of ASA (see _init_worker)
+
+    Parameters
+    ----------
+    wav_file : str or Path
+        Sound file
+    f : callable
+        Function to apply to the AcuFile
+    path : Path or None
+        If not None, the output is saved in this shard instead of being returned
+
+    Returns
+    -------
+    Tuple (in_period, output). If the file is not in the period of the survey or it is empty, in_period is False and
+    output is None
+    """
+    sound_file = _WORKER_ASA._hydro_file(wav_file)
+    if sound_file.is_in_period(_WORKER_ASA.period) and sound_file.file.frames > 0:
+        output = f(sound_file)
+        if path is not None:
+            _checkpoint.save_shard(output, path)
+            output = None
+        return True, output
+    return False, None
+
+
 def move_file(file_path, new_folder_path):
     """
     Move the file to the new folder
@@ -12,6 +12,7 @@ import pandas as pd
 import xarray
 from tqdm import tqdm
 
+from pypam import _sketch
 from pypam import acoustic_survey
 from pypam import utils
 
@@ -48,9 +49,13 @@ class DataSet:
         In seconds, duration of windows to consider
     nfft : int
         Number of samples of window to use for frequency analysis
+    checkpoint : bool
+        Set to True to save the output of each sound file in output_folder/checkpoints/<deployment> while the
+        deployment is processed. If the processing is interrupted, the files already processed are not computed again
     """
     def __init__(self, summary_path, output_folder, instruments, temporal_features=None, frequency_features=None,
-                 bands_list=None, binsize=60.0, bin_overlap=0.0, nfft=512, fft_overlap=0, dc_subtract=False):
+                 bands_list=None, binsize=60.0, bin_overlap=0.0, nfft=512, fft_overlap=0, dc_subtract=False,
+                 checkpoint=False):
         self.metadata = pd.read_csv(summary_path)
         if 'end_to_end_calibration' not in self.metadata.columns:
             self.metadata['end_to_end_calibration'] = np.nan
@@ -64,6 +69,7 @@ class DataSet:
         self.nfft = nfft
         self.fft_overlap = fft_overlap
         self.dc_subtract = dc_subtract
+        self.checkpoint = checkpoint
 
         if not isinstance(output_folder, pathlib.Path):
             output_folder = pathlib.Path(output_folder)
@@ -111,7 +117,37 @@ class DataSet:
                                                       (idx, deployment_row.deployment_name))
         return idx, deployment_row['deployment_name'], deployment_path
 
-    def join_dataset(self):
+    def join_dataset(self, percentiles=None, time_coord='id', k=_sketch.SKETCH_K):
+        """
+        Join all the deployments in one dataset.
+        If percentiles is given, the deployments are not joined. Instead, the percentiles along time_coord of each
+        variable over all the deployments are returned. They are computed with a quantile sketch (see
+        _sketch.QuantileSketch) reading the deployments in blocks, so all the dataset does not need to fit in memory.
+        The variables without time_coord are skipped
+
+        Parameters
+        ----------
+        percentiles : list or None
+            Percentiles to compute (in 100 per cent). If None, the deployments are joined
+        time_coord : str
+            Name of the time dimension, only used with percentiles
+        k : int
+            Size of the sketch, only used with percentiles
+
+        Returns
+        -------
+        xarray Dataset
+        """
+        if percentiles is not None:
+            sketches = {}
+            for idx, name, deployment_path, in self.deployments():
+                deployment = self[idx]
+                for data_var in deployment.data_vars:
+                    if time_coord in deployment[data_var].dims:
+                        sketches[data_var] = _sketch.sketch_dataarray(deployment[data_var], time_coord, k=k,
+                                                                      sketch=sketches.get(data_var))
+            return xarray.Dataset({data_var: _sketch.percentiles_dataarray(sketch, percentiles)
+                                   for data_var, sketch in sketches.items()})
         ds = xarray.Dataset()
         for idx, name, deployment_path, in self.deployments():
             deployment = self[idx]
@@ -148,12 +184,17 @@ class DataSet:
         hydrophone.Vpp = self.metadata.loc[(idx, 'instrument_Vpp')]
         survey_columns = ['folder_path', 'timezone', 'include_dirs', 'calibration']
         extra_attrs = self.metadata.loc[(idx, self.metadata.columns[9::])].to_dict()
+        checkpoint_dir = None
+        if self.checkpoint:
+            _, deployment_name, deployment_path = self._deployment(idx)
+            checkpoint_dir = self.output_folder.joinpath('checkpoints', deployment_path.stem)
         asa = acoustic_survey.ASA(hydrophone,
                                   dc_subtract=self.dc_subtract,
                                   binsize=self.binsize,
                                   nfft=self.nfft,
                                   fft_overlap=self.fft_overlap,
                                   extra_attrs=extra_attrs,
+                                  checkpoint_dir=checkpoint_dir,
                                   **self.metadata.loc[(idx, survey_columns)].to_dict())
         ds = xarray.Dataset()
         if self.frequency_features not in [[], None]:
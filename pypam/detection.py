@@ -65,8 +65,12 @@ class Detection(sig.Signal):
 
         self.duration = self.end_seconds - self.start_seconds
 
-        wav_sig, fs = sf.read(self.acu_file.file_path, start=self.frame_init, stop=min(self.frame_end,
-                                                                                       self.acu_file.file.frames))
+        stop = min(self.frame_end, self.acu_file.file.frames)
+        if self.acu_file._pcm_reader is None:
+            wav_sig, fs = sf.read(self.acu_file.file_path, start=self.frame_init, stop=stop)
+        else:
+            # Only read the detection from the memory-mapped file
+            wav_sig, fs = self.acu_file._pcm_reader.read(self.frame_init, stop), self.acu_file.fs
 
         self.orig_wav = wav_sig
         self.orig_fs = fs
@@ -33,6 +33,7 @@ except ModuleNotFoundError:
     pvlib = None
 
 import pypam
+from pypam import _sketch
 
 plt.rcParams.update({'text.usetex': True})
 sns.set_theme('paper')
@@ -214,7 +215,7 @@ def plot_multiple_spectrum_median(ds_dict, data_var, percentiles='default', freq
 
 
 def plot_spectrum_median(ds, data_var, percentiles='default', frequency_coord='frequency', time_coord='id',
-                         log=True, save_path=None, ax=None, show=True, **kwargs):
+                         log=True, save_path=None, ax=None, show=True, k=None, **kwargs):
     """
     Plot the median spectrum
 
@@ -238,6 +239,9 @@ def plot_spectrum_median(ds, data_var, percentiles='default', frequency_coord='f
         ax to plot on
     show : bool
         set to True to show the plot
+    k : int or None
+        If given, the median and the percentiles are computed with a quantile sketch of size k (see
+        _sketch.QuantileSketch), reading ds in blocks along time_coord, so ds does not need to fit in memory
 
     Returns
     -------
@@ -249,9 +253,14 @@ def plot_spectrum_median(ds, data_var, percentiles='default', frequency_coord='f
     if percentiles == 'default':
         percentiles = [10, 90]
 
-    pxx = ds[data_var].to_numpy().T
-    p = np.nanpercentile(a=pxx, q=np.array(percentiles), axis=1)
-    ax.plot(ds[frequency_coord].values, ds[data_var].median(dim=time_coord).values, **kwargs)
+    if k is None:
+        pxx = ds[data_var].to_numpy().T
+        p = np.nanpercentile(a=pxx, q=np.array(percentiles), axis=1)
+        median = ds[data_var].median(dim=time_coord).values
+    else:
+        sketch_p = _sketch.sketch_dataarray(ds[data_var], time_coord, k=k).percentiles([50] + list(percentiles))
+        median, p = sketch_p[:, 0], sketch_p[:, 1:].T
+    ax.plot(ds[frequency_coord].values, median, **kwargs)
     if 'color' in kwargs.keys():
         ax.fill_between(x=ds[frequency_coord].values, y1=p[0], y2=p[1], alpha=0.2, color=kwargs['color'])
     else:
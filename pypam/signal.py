@@ -9,11 +9,14 @@ import operator
 import matplotlib.pyplot as plt
 import noisereduce as nr
 import numpy as np
+import scipy.fft
 import scipy.signal as sig
 import seaborn as sns
 import sklearn.linear_model as linear_model
 import sklearn.metrics as metrics
 
+from pypam import _bands
+from pypam import _filters
 from pypam import acoustic_indices
 from pypam import utils
 from pypam import units as output_units
@@ -25,12 +28,19 @@ sns.set_theme()
 
 FILTER_ORDER = 4
 MIN_FREQ = 1
+# Fraction of the nyquist frequency not affected by the anti-aliasing filter of each decimation by 2, and ripple (in
+# db) of the filter in that band (see scipy.signal.decimate)
+DECIMATION_PASSBAND = 0.8
+DECIMATION_RIPPLE = 0.05
+# Maximum number of samples (events x fft length) transformed at once by events_decidecade_sel
+SEL_BATCH_SAMPLES = 2 ** 22
 
 
 class Signal:
-    def __init__(self, signal, fs, channel=0):
+    def __init__(self, signal, fs, channel=0, filter_states=None, lookahead=None):
         """
-        Representation of a signal
+        Representation of a signal. The signal is not copied: the original is kept as a read-only view, and new
+        arrays are only allocated when a band is filtered or downsampled
         Parameters
         ----------
         signal : np.array
@@ -39,21 +49,38 @@ class Signal:
             Sample rate
         channel : int
             Channel to perform the calculations in
+        filter_states : dict or None
+            Used to filter consecutive signals (i.e. the bins of a file) as one continuous signal. The state of the
+            filters and resamplers at the end of the signal is stored in this dict, and they start from the state
+            left by the previous signal. The same dict has to be given to all the consecutive signals, which have to
+            be processed with the same bands. If None, the filters start from zero every time
+        lookahead : np.array or None
+            Only used with filter_states. Beginning of the next signal (i.e. the next bin), which the resamplers
+            need to compute the last samples as in the continuous signal. If None, it is filled with zeros
         """
         # Original signal
         self._fs = fs
+        signal = np.asarray(signal)
         if len(signal.shape) > 1:
             signal = signal[:, channel]
-        self._signal = signal.copy()
+        self._signal = signal.view()
+        self._signal.flags.writeable = False
+        self._filter_states = filter_states
+        self._original_lookahead = lookahead
+        self._lookahead = lookahead
 
         # Init processed signal
         self.fs = fs
-        self.signal = signal.copy()
+        self.signal = self._signal
 
         # Reset params
         self.band_n = -1
         self.bands_list = {}
         self._processed = {}
+        # Signal, fs and lookahead of each band already computed, so going back to a band does not process it again
+        self._band_signals = {}
+        # Decimation pyramids (see decimated) of the signals already decimated, by id of the signal
+        self._pyramids = {}
         self._reset_spectro()
 
         self.set_band()
@@ -95,7 +122,7 @@ class Signal:
         """
         return (band is None) or (band[0] in [0, None] and band[1] in [self.fs/2, None])
 
-    def set_band(self, band=None, downsample=True):
+    def set_band(self, band=None, downsample=True, multirate=False):
         """
         Process the signal to be working on the specified band.
         If the upper limit band is higher than the nyquist frequency (fs/2), the band limit is set to the
@@ -110,31 +137,142 @@ class Signal:
             [low_freq, high_freq] of the desired band
         downsample: bool
             Set to True if signal has to be downsampled for spectral resolution incrementation
+        multirate : bool
+            Only used if downsample is True. Set to True to downsample the band from the decimation pyramid of the
+            original signal (see decimated) instead of from the current signal: the band is taken from the lowest
+            decimation level which still contains it, so all the bands share the same decimations and the low
+            bands are filtered and resampled at a low fs. Not used when the signal is filtered continuously
         """
         if band is None:
             band = [0, self.fs / 2]
         if band != self.band:
             if self._band_is_broadband(band):
-                self.signal = self._signal.copy()
-                self.fs = self._fs
+                self._reset_signal()
             else:
                 if band[1] > self._fs / 2:
                     print('Band upper limit %s is too big, setting to maximum fs: new fs %s' % (band[1], self._fs/2))
                     band[1] = self._fs / 2
-                if band[1] > self.fs / 2:
-                    # Reset to the original data
-                    self.signal = self._signal.copy()
-                    self.fs = self._fs
-                if (not downsample) or (band[1] * 2 == self.fs):
-                    self.filter(band=band)
+                band_key = (band[0], band[1], downsample, multirate)
+                if band_key in self._band_signals:
+                    self.signal, self.fs, self._lookahead = self._band_signals[band_key]
                 else:
-                    self.downsample2band(band)
+                    if band[1] > self.fs / 2:
+                        # Reset to the original data
+                        self._reset_signal()
+                    if downsample and multirate and self._filter_states is None:
+                        self._reset_to_pyramid_level(band)
+                    if (not downsample) or (band[1] * 2 == self.fs):
+                        self.filter(band=band)
+                    else:
+                        self.downsample2band(band)
+                    self._band_signals[band_key] = (self.signal, self.fs, self._lookahead)
 
             self.band_n += 1
             self._processed[self.band_n] = []
             self.bands_list[self.band_n] = band
         self._reset_spectro()
 
+    def _reset_signal(self):
+        """
+        Go back to the original signal and fs
+        """
+        self.signal = self._signal
+        self.fs = self._fs
+        self._lookahead = self._original_lookahead
+
+    def decimated(self, level):
+        """
+        Return the current signal decimated by 2 level times (sampling frequency fs / 2**level), using
+        scipy.signal.decimate. All the levels of the decimation pyramid are computed only once per signal, so they
+        are shared by all the methods and bands which use them (i.e. octave_levels for different fractions)
+
+        Parameters
+        ----------
+        level : int
+            Number of decimations by 2
+        """
+        level = int(level)
+        pyramid = self._pyramids.get(id(self.signal))
+        if pyramid is None or pyramid[0] is not self.signal:
+            pyramid = {0: self.signal}
+            self._pyramids[id(self.signal)] = pyramid
+        computed = max(pyramid.keys())
+        for i in range(computed + 1, level + 1):
+            pyramid[i] = _filters.decimate(pyramid[i - 1], 2)
+        return pyramid[level]
+
+    def _reset_to_pyramid_level(self, band):
+        """
+        Set the signal to the lowest level of the decimation pyramid of the original signal which contains the band
+        in the pass band of all its decimation filters (and with an integer fs). The level is corrected by the mean
+        attenuation of the ripple of the decimation filters (applied twice, forwards and backwards)
+
+        Parameters
+        ----------
+        band : list or tuple
+            [low_freq, high_freq] of the band
+        """
+        self._reset_signal()
+        level = 0
+        while self._fs % 2 ** (level + 1) == 0 and band[1] <= DECIMATION_PASSBAND * self._fs / 2 ** (level + 2):
+            level += 1
+        if level > 0:
+            self.signal = self.decimated(level) * 10 ** (DECIMATION_RIPPLE * level / 20)
+            self.fs = self._fs // 2 ** level
+            self._lookahead = None
+
+    def _sosfilt(self, sosfilt, step):
+        """
+        Filter the signal with the sos filter. If the signal is filtered continuously (filter_states is not None),
+        the filter starts from the state left by the previous signal and its final state is stored for the next one.
+        The lookahead is filtered from the final state, without storing it
+
+        Parameters
+        ----------
+        sosfilt : np.array
+            Filter in sos format
+        step : tuple
+            Name of the processing step, used as key of the state
+        """
+        if self._filter_states is None:
+            return sig.sosfilt(sosfilt, self.signal)
+        key = step + (self.fs,)
+        zi = self._filter_states.get(key)
+        if zi is None:
+            zi = np.zeros((sosfilt.shape[0], 2))
+        filtered, zf = sig.sosfilt(sosfilt, self.signal, zi=zi)
+        self._filter_states[key] = zf
+        if self._lookahead is not None and self._lookahead.size > 0:
+            self._lookahead = sig.sosfilt(sosfilt, self._lookahead, zi=zf)[0]
+        return filtered
+
+    def _resample(self, up, down, step):
+        """
+        Resample the signal by up / down with a polyphase filter. If the signal is resampled continuously
+        (filter_states is not None), the filter uses the end of the previous signal and the lookahead instead of
+        zeros, so the output is the same as resampling the continuous signal
+
+        Parameters
+        ----------
+        up : int
+            Upsampling factor
+        down : int
+            Downsampling factor
+        step : tuple
+            Name of the processing step, used as key of the state
+        """
+        if self._filter_states is None:
+            return _filters.resample_poly(self.signal, up=up, down=down)
+        key = step + (self.fs,)
+        resampler = self._filter_states.get(key)
+        if resampler is None:
+            resampler = _filters.StreamResampler(up, down, dtype=self.signal.dtype)
+            self._filter_states[key] = resampler
+        resampled = resampler.process(self.signal, self._lookahead)
+        # The resampled lookahead is not known (it would need the samples after it)
+        self._lookahead = None
+        return resampled
+
     def reset_original(self):
         """
         Reset the signal to the original band and process
@@ -164,18 +302,13 @@ class Signal:
         """
         Return the butterworth filter for the specified band. If the limits are set to None, 0 or the nyquist
         frequency, only high-pass or low-pass filters are applied. Otherwise, a band-pass filter.
+        The designs are cached (see _filters.FILTER_CACHE), so each filter is only computed once per process.
         Parameters
         ----------
         band: tuple or list
             [low_freq, high_freq], band to be filtered
         """
-        if band[0] is None or band[0] == 0:
-            sosfilt = sig.butter(N=FILTER_ORDER, btype='lowpass', Wn=band[1], analog=False, output=output, fs=self.fs)
-        elif band[1] is None or band[1] == self.fs / 2:
-            sosfilt = sig.butter(N=FILTER_ORDER, btype='highpass', Wn=band[0], analog=False, output=output, fs=self.fs)
-        else:
-            sosfilt = sig.butter(N=FILTER_ORDER, btype='bandpass', Wn=band, analog=False, output=output, fs=self.fs)
-        return sosfilt
+        return _filters.butter(band, self.fs, FILTER_ORDER, output=output)
 
     def downsample(self, new_fs, filt=None):
         """
@@ -191,9 +324,11 @@ class Signal:
         lcm = np.lcm(int(self.fs), int(new_fs))
         ratio_up = int(lcm / self.fs)
         ratio_down = int(lcm / new_fs)
-        self.signal = sig.sosfilt(filt, self.signal)
+        # The filter is part of the key because bands with different filters can be downsampled to the same fs
+        step = ('downsample', new_fs, np.asarray(filt).tobytes())
+        self.signal = self._sosfilt(filt, step + ('filter',))
         self._processed[self.band_n].append('filtered')
-        self.signal = sig.resample_poly(self.signal, up=ratio_up, down=ratio_down)
+        self.signal = self._resample(ratio_up, ratio_down, step + ('resample',))
         self._processed[self.band_n].append('downsample')
         self.fs = new_fs
 
@@ -229,7 +364,7 @@ class Signal:
         if not self._band_is_broadband(band):
             # Filter the signal
             sosfilt = self._create_filter(band)
-            self.signal = sig.sosfilt(sosfilt, self.signal)
+            self.signal = self._sosfilt(sosfilt, ('filter', band[0], band[1]))
             self._processed[self.band_n].append('filter')
 
     def remove_dc(self):
@@ -289,7 +424,24 @@ class Signal:
             time.append(block.time)
         return time, output
 
-    def rms(self, db=True, energy_window = None, **kwargs):
+    def _energy_offset(self):
+        """
+        First sample of the signal in the recording of an energy index (see utils.EnergyIndex)
+        """
+        return 0
+
+    def _energy_window(self, energy_window, energy_index=None):
+        """
+        Return the sample window [start, end] of the signal which contains the energy_window of its energy. If
+        energy_index is given (and the signal is the original one, not a filtered or downsampled band), it is found
+        with a binary search in the index instead of from the cumulative energy of the signal
+        """
+        if energy_index is None or self.signal is not self._signal:
+            return utils.energy_window(self.signal, energy_window)
+        start = self._energy_offset()
+        return energy_index.window(start, start + self.signal.size, energy_window)
+
+    def rms(self, db=True, energy_window = None, energy_index=None, **kwargs):
         """
         Calculation of root mean squared value (rms) of the signal in uPa
 
@@ -300,10 +452,17 @@ class Signal:
         energy_window: float
             If provided, calculate the rms over the given energy window (e.g. RMS_90
             for energy_window= .9).
+        energy_index : utils.EnergyIndex or None
+            Energy index of the recording containing the signal, used to find the energy window and its energy
+            without going through the samples (only for the original signal)
         """
         if energy_window:
-            [start, end] = utils.energy_window(self.signal, energy_window)
-            rms_val = utils.rms(self.signal[start:end])
+            [start, end] = self._energy_window(energy_window, energy_index)
+            if energy_index is None or self.signal is not self._signal:
+                rms_val = utils.rms(self.signal[start:end])
+            else:
+                offset = self._energy_offset()
+                rms_val = np.sqrt(energy_index.energy(offset + start, offset + end) / (end - start))
         else:
             rms_val = utils.rms(self.signal)
         # Convert it to db if applicable
@@ -311,7 +470,7 @@ class Signal:
             rms_val = utils.to_db(rms_val, ref=1.0, square=True)
         return rms_val
 
-    def pulse_width(self, energy_window, **kwargs):
+    def pulse_width(self, energy_window, energy_index=None, **kwargs):
         """
         Returns the pulse width of an impulsive signal
         according to a fractional energy window
@@ -320,6 +479,9 @@ class Signal:
         ----------
         energy_window : float [0,1]
             given energy window to calculate pulse width
+        energy_index : utils.EnergyIndex or None
+            Energy index of the recording containing the signal, used to find the energy window with a binary
+            search (only for the original signal)
         **kwargs : TYPE
             DESCRIPTION.
 
@@ -329,7 +491,7 @@ class Signal:
         energy_window pulse width in seconds
 
         """
-        [start, end] = utils.energy_window(self.signal, energy_window)
+        [start, end] = self._energy_window(energy_window, energy_index)
 
         return (end - start) / self.fs
 
@@ -413,22 +575,12 @@ class Signal:
         sel : numpy array
             Sound Exposure Level of each band
         """
-        f_psd,psd = sig.periodogram(self.signal,fs=self.fs)
-        Ef = psd*len(self.signal)/self.fs
-        centers, highs, lows = utils.decidecade_bands(f_psd[1], max(f_psd),bounded=True)
-        sel = np.zeros((len(centers),))
-        for i,(center,high,low) in enumerate(zip(centers,highs,lows)):
-            indices = np.where((f_psd > low) & (f_psd < high))
-            Ef_band = np.trapz(Ef[indices],x=f_psd[indices])
-            # replace -infs with nans for log10
-            if Ef_band<=0:
-                sel[i] = np.nan
-            else:
-                sel[i] = 10 * np.log10( Ef_band )
-        f = centers
-        return f,sel
+        n = len(self.signal)
+        (f, _, _), sel = events_decidecade_sel(self.signal, self.fs, [0], [n], nfft=n, min_freq=self.fs / n,
+                                               max_freq=(n // 2) * self.fs / n)
+        return f, sel[0]
 
-    def octave_levels(self, db=True, fraction=1, **kwargs):
+    def octave_levels(self, db=True, fraction=1, method='filter', **kwargs):
         """
         Calculation of calibrated octave band levels
 
@@ -437,32 +589,17 @@ class Signal:
         f : numpy array
             Array with the center frequencies of the bands
         db : boolean
-            Set to True to get the result in db
+            Set to True to get the result in db. Otherwise, the mean square value of each band is returned
         fraction : int
             fraction of an octave to compute the bands (i.e. fraction=3 leads to 1/3 octave bands)
+        method : str
+            'filter' to filter the signal with the octave filterbank, or 'fft' to add the power of the fft bins of
+            each band (faster, but not compliant with the filter standards). See octave_bank_levels
         """
-        bands, f = utils.oct_fbands(min_freq=MIN_FREQ, max_freq=self.fs/2, fraction=fraction)
-
-        # construct filterbank
-        filterbank, fsnew, d = utils.octbankdsgn(self.fs, bands, fraction, 2)
-
-        nx = d.max()  # number of downsampling steps
-        # calculate octave band levels
-        spg = np.zeros(len(d))
-        newx = {0: self.signal}
-        for i in np.arange(1, nx + 1):
-            newx[i] = sig.decimate(newx[i - 1], 2)
-
-        # Perform filtering for each frequency band
-        for i in np.arange(len(d)):
-            y = sig.sosfilt(filterbank[i], newx[d[i]])  # Check the filter!
-            # Calculate level time series
-            if db:
-                spg[i] = 10 * np.log10(np.sum(y ** 2) / len(y))
-            else:
-                spg[i] = y
-
-        return f, spg
+        # The decimated signals are shared with other calls
+        f, levels = octave_bank_levels(self.signal[np.newaxis, :], self.fs, fraction=fraction, db=db, method=method,
+                                       decimated=lambda level: self.decimated(level)[np.newaxis, :])
+        return f, levels[0]
 
     def _spectrogram(self, nfft=512, scaling='density', overlap=0.2):
         """
@@ -978,7 +1115,7 @@ class Signal:
         spg = np.zeros(nt, len(d))
         newx = {0: x}
         for i in np.arange(1, nx):
-            newx[i] = sig.decimate(newx[i - 1], 2)
+            newx[i] = _filters.decimate(newx[i - 1], 2)
 
         # Perform filtering for each frequency band
         for j in np.arange(len(d)):
@@ -1157,3 +1294,390 @@ class Blocks:
             return s
         else:
             raise StopIteration
+
+
+def _welch_scale(window, fs, scaling):
+    """
+    Return the factor of each frequency to convert the mean squared magnitude of the rfft to a one-sided spectrum,
+    the same as scipy.signal.welch
+    """
+    nfft = window.size
+    if scaling == 'density':
+        scale = np.full(nfft // 2 + 1, 1.0 / (fs * (window * window).sum()))
+    else:
+        scale = np.full(nfft // 2 + 1, 1.0 / window.sum() ** 2)
+    if nfft % 2:
+        scale[1:] *= 2
+    else:
+        scale[1:-1] *= 2
+    return scale
+
+
+def blocks_spectrum(blocks, fs, scaling='density', nfft=512, db=True, overlap=0, window_name='hann',
+                    percentiles=None):
+    """
+    Compute the spectrum of many blocks (bins) of the same length at once. All the fft segments of all the blocks
+    are framed in one strided array and transformed with a single batched fft, and then averaged per block (Welch).
+    The output is the same as calling Signal.spectrum on each block (broadband).
+
+    Parameters
+    ----------
+    blocks : np.array
+        2D array with one block per row
+    fs : int
+        Sample rate
+    scaling : string
+        Can be set to 'spectrum' or 'density' depending on the desired output
+    nfft : int
+        Length of the fft window in samples. Has to be smaller or equal than the length of the blocks
+    db : bool
+        If set to True the result will be given in db, otherwise in uPa^2
+    overlap : float [0, 1]
+        Percentage (in 1) to overlap
+    window_name : str
+        Name of the window (see scipy.signal.get_window)
+    percentiles : list or None
+        List of all the percentiles that have to be returned for each block
+
+    Returns
+    -------
+    Frequency array, psd values (one row per block), percentiles values (one row per block) or None
+    """
+    # The window has the same type as the blocks so the fft is computed in the same precision
+    window = sig.get_window(window_name, nfft).astype(blocks.dtype)
+    step = nfft - int(nfft * overlap)
+    # View of all the segments of all the blocks (blocks, segments, nfft), without copying the data
+    segments = np.lib.stride_tricks.sliding_window_view(blocks, nfft, axis=-1)[:, ::step]
+    spectra = scipy.fft.rfft(segments * window, n=nfft, axis=-1)
+    scale = _welch_scale(window, fs, scaling).astype(blocks.dtype)
+    psd = (spectra.real ** 2 + spectra.imag ** 2).mean(axis=1) * scale
+    freq = scipy.fft.rfftfreq(nfft, 1 / fs)
+    if db:
+        psd = utils.to_db(psd, ref=1.0, square=False)
+    if percentiles is not None:
+        percentiles_val = np.percentile(psd, percentiles, axis=1).T
+    else:
+        percentiles_val = None
+    return freq, psd, percentiles_val
+
+
+def octave_bank_levels(blocks, fs, fraction=1, db=True, method='filter', decimated=None):
+    """
+    Compute the octave (or fraction of octave) band levels of many blocks (bins) of the same length at once.
+    With method 'filter', the blocks are decimated once per level of the filterbank (see utils.octbankdsgn), and
+    all the bands of the same level are filtered in one compiled loop which only keeps the mean square of each band.
+    The output is the same as Signal.octave_levels applied to each block.
+    With method 'fft', the mean square of each band is the sum of the power of the fft bins of the block between
+    the limits of the band (brick-wall bands). It is much faster but it is not compliant with the octave filter
+    standards. The bands narrower than the frequency resolution of the block are set to nan
+
+    Parameters
+    ----------
+    blocks : np.array
+        2D array with one block per row
+    fs : int
+        Sample rate
+    fraction : int
+        fraction of an octave to compute the bands (i.e. fraction=3 leads to 1/3 octave bands)
+    db : bool
+        If set to True the result will be given in db, otherwise in mean square (upa^2)
+    method : str
+        'filter' or 'fft'
+    decimated : callable or None
+        Function which returns the blocks decimated by 2 level times, to reuse decimations already computed. If
+        None, the decimations are computed with _filters.decimate
+
+    Returns
+    -------
+    Center frequencies of the bands, levels (one row per block)
+    """
+    bands, f = utils.oct_fbands(min_freq=MIN_FREQ, max_freq=fs / 2, fraction=fraction)
+    if method == 'fft':
+        mean_square = _fft_band_mean_square(blocks, fs, utils.oct_center_freqs(bands, fraction), fraction)
+    elif method == 'filter':
+        filterbank, _, d = utils.octbankdsgn(fs, bands, fraction, 2)
+        if decimated is None:
+            pyramid = {0: blocks}
+
+            def decimated(level):
+                for i in range(len(pyramid), int(level) + 1):
+                    pyramid[i] = _filters.decimate(pyramid[i - 1], 2)
+                return pyramid[int(level)]
+        mean_square = np.zeros((blocks.shape[0], len(d)))
+        for level in np.unique(d):
+            level_bands = np.where(d == level)[0]
+            sos_bank = np.stack([filterbank[i] for i in level_bands])
+            # d = 1 means no decimation (the filters are designed for fs / 2 ** (d - 1))
+            mean_square[:, level_bands] = _filters.sosfilt_mean_square(sos_bank, decimated(level - 1))
+    else:
+        raise ValueError('Method %s is not supported, it has to be filter or fft' % method)
+    if db:
+        return f, 10 * np.log10(mean_square)
+    return f, mean_square
+
+
+def _fft_band_mean_square(blocks, fs, fc, fraction):
+    """
+    Return the mean square of each block in each band with center frequency fc, from the power of its fft bins
+    """
+    n = blocks.shape[-1]
+    spectra = scipy.fft.rfft(blocks, axis=-1)
+    power = (spectra.real ** 2 + spectra.imag ** 2) / n ** 2
+    # All the bins except 0 and nyquist appear twice in the full spectrum
+    power[:, 1:(n + 1) // 2] *= 2
+    freq = scipy.fft.rfftfreq(n, 1 / fs)
+    low = np.searchsorted(freq, fc * utils.G ** (-1.0 / (2.0 * fraction)))
+    high = np.searchsorted(freq, fc * utils.G ** (1.0 / (2.0 * fraction)))
+    cumulative = np.concatenate([np.zeros((blocks.shape[0], 1)), np.cumsum(power, axis=-1)], axis=-1)
+    mean_square = cumulative[:, high] - cumulative[:, low]
+    mean_square[:, high == low] = np.nan
+    return mean_square
+
+
+def blocks_broadband_metrics(blocks, fs, bands, method_list, db=True, original=None):
+    """
+    Compute the broadband time-domain metrics (see utils.BROADBAND_METRICS) of many blocks (bins) of the same length
+    at once, in each band. The bands are filtered as Signal.set_band with downsample=False does when it is called
+    with the bands one after the other: each band is filtered from the signal of the previous one, except the
+    broadband, which goes back to the original signal. Then all the metrics are computed in a single pass with
+    utils.broadband_metrics. The output is the same as calling each method of Signal on each block.
+    As in Signal.set_band, the upper limit of the bands above the nyquist frequency is set to fs / 2 (in place)
+
+    Parameters
+    ----------
+    blocks : np.array
+        2D array with one block per row
+    fs : int
+        Sample rate
+    bands : list of lists
+        [low_freq, high_freq] of each band
+    method_list : list of str
+        Metrics to return, from utils.BROADBAND_METRICS
+    db : bool
+        If set to True the result will be given in db (except the kurtosis)
+    original : np.array or None
+        Original blocks, which the broadband bands go back to (as Signal._signal, i.e. before removing the dc). If
+        None, blocks
+
+    Returns
+    -------
+    np.array (n_blocks x n_bands x n_methods)
+    """
+    if original is None:
+        original = blocks
+    columns = [utils.BROADBAND_METRICS.index(method_name) for method_name in method_list]
+    output = np.zeros((blocks.shape[0], len(bands), len(columns)))
+    signal = blocks
+    band_signals = {}
+    current_band = [0, fs / 2]
+    for j, band in enumerate(bands):
+        if band != current_band:
+            if (band is None) or (band[0] in [0, None] and band[1] in [fs / 2, None]):
+                signal = original
+            else:
+                if band[1] > fs / 2:
+                    print('Band upper limit %s is too big, setting to maximum fs: new fs %s' % (band[1], fs / 2))
+                    band[1] = fs / 2
+                band_key = (band[0], band[1])
+                if band_key not in band_signals:
+                    sosfilt = _filters.butter(band, fs, FILTER_ORDER, output='sos')
+                    band_signals[band_key] = sig.sosfilt(sosfilt, signal, axis=-1)
+                signal = band_signals[band_key]
+            current_band = band
+        output[:, j, :] = utils.broadband_metrics(signal, fs)[:, columns]
+    if db:
+        for k, method_name in enumerate(method_list):
+            if method_name == 'sel':
+                output[..., k] = utils.to_db(output[..., k], square=False)
+            elif method_name != 'kurtosis':
+                output[..., k] = utils.to_db(output[..., k], ref=1.0, square=True)
+    return output
+
+
+def events_decidecade_sel(signal, fs, starts, ends, nfft=None, min_freq=None, max_freq=None):
+    """
+    Compute the decidecade band SEL spectra of many events (signal[starts[i]:ends[i]]) at once. The SEL of each
+    band is the integral of the energy spectral density of the event (periodogram with constant detrend) over the
+    fft bins inside the band, with the trapezoidal rule, as Signal.decidecade_sel.
+    The events are zero-padded to a few fft lengths (the next power of 2 of their length, or nfft), and all the
+    events with the same length are transformed with one batched fft and integrated over the bands with one sparse
+    matrix product (see _bands.BandIntegration, cached for each fs and nfft). With nfft equal to the length of the
+    events the output is the same as Signal.decidecade_sel. Zero-padding only adds frequencies in between, so the
+    integral over each band is slightly more accurate.
+    The bands which are not inside the frequency range of the periodogram of an event (without padding), or which
+    contain less than two of its frequencies, are nan, as in Signal.decidecade_sel
+
+    Parameters
+    ----------
+    signal : 1D numpy array
+        Signal containing the events, in upa
+    fs : int
+        Sample rate, in Hz
+    starts : array of int
+        First sample of each event
+    ends : array of int
+        End (excluded) of each event
+    nfft : int or None
+        Length of the fft of all the events (at least the length of the longest). If None, each event is padded
+        to the next power of 2 of its length
+    min_freq : float or None
+        Minimum frequency of the bands. If None, the frequency resolution of the longest event
+    max_freq : float or None
+        Maximum frequency of the bands. If None, the nyquist frequency
+
+    Returns
+    -------
+    (centre, lower and upper frequency of the bands), sel in db (one row per event)
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    lengths = ends - starts
+    if min_freq is None:
+        min_freq = fs / lengths.max()
+    if max_freq is None:
+        max_freq = fs / 2
+    centers, highs, lows = utils.decidecade_bands(min_freq, max_freq, bounded=True)
+    if nfft is None:
+        sizes = 2 ** np.ceil(np.log2(np.maximum(lengths, 1))).astype(int)
+    elif nfft < lengths.max():
+        raise ValueError('nfft %s is shorter than the longest event (%s samples)' % (nfft, lengths.max()))
+    else:
+        sizes = np.full(lengths.size, nfft)
+
+    sel = np.full((lengths.size, centers.size), np.nan)
+    for size in np.unique(sizes):
+        integration = _bands.band_integration(fs / size, size // 2 + 1, [lows, highs], centers)
+        # Energy spectral density of the one-sided periodogram
+        scale = np.full(size // 2 + 1, 2 / fs ** 2)
+        scale[0] = 1 / fs ** 2
+        if size % 2 == 0:
+            scale[-1] = 1 / fs ** 2
+        events = np.where(sizes == size)[0]
+        batch_size = max(1, SEL_BATCH_SAMPLES // size)
+        for batch in np.split(events, np.arange(batch_size, events.size, batch_size)):
+            blocks = np.zeros((batch.size, size))
+            for k, i in enumerate(batch):
+                event = signal[starts[i]:ends[i]]
+                blocks[k, :lengths[i]] = event - np.mean(event)
+            spectra = scipy.fft.rfft(blocks, axis=-1)
+            energy = integration.apply((spectra.real ** 2 + spectra.imag ** 2) * scale)
+            # Bands inside the frequencies of the periodogram of each event (without padding), with at least two of
+            # its frequencies
+            n = lengths[batch, np.newaxis]
+            n_inside = np.ceil(highs * n / fs) - np.floor(lows * n / fs) - 1
+            inside = (lows > fs / n) & (highs < (n // 2) * fs / n) & (n_inside >= 2) & (energy > 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sel[batch] = np.where(inside, 10 * np.log10(energy), np.nan)
+    return (centers, lows, highs), sel
+
+
+class WelchAccumulator:
+    def __init__(self, fs, bin_samples=None, nfft=512, overlap=0, scaling='density', window_name='hann'):
+        """
+        Streaming Welch spectrum. The signal is given in blocks of any size (i.e. files or parts of files) and the
+        spectrum of each bin of bin_samples samples is returned as soon as all its samples have arrived. Only the
+        samples of the last (incomplete) fft segment are kept in memory, so the memory used does not depend on the
+        length of the bins. The spectrum of each bin is the same as the one of Signal.spectrum (broadband, in upa^2)
+
+        Parameters
+        ----------
+        fs : int
+            Sample rate
+        bin_samples : int or None
+            Number of samples of each bin. If None, all the signal is one bin (returned by flush)
+        nfft : int
+            Length of the fft window in samples
+        overlap : float [0, 1]
+            Percentage (in 1) to overlap the fft windows
+        scaling : string
+            Can be set to 'spectrum' or 'density' depending on the desired output
+        window_name : str
+            Name of the window (see scipy.signal.get_window)
+        """
+        self.fs = fs
+        self.bin_samples = bin_samples
+        self.nfft = nfft
+        self.step = nfft - int(nfft * overlap)
+        self.window = sig.get_window(window_name, nfft)
+        self.freq = scipy.fft.rfftfreq(nfft, 1 / fs)
+        self.scale = _welch_scale(self.window, fs, scaling)
+        if bin_samples is not None and bin_samples < nfft:
+            raise ValueError('The bins (%s samples) have to be longer than nfft (%s)' % (bin_samples, nfft))
+
+        self.n_samples = 0
+        self.bin_start = 0
+        self._reset_bin()
+
+    def _reset_bin(self):
+        """
+        Start a new bin
+        """
+        self._tail = np.zeros(0)
+        self._bin_received = 0
+        self._power_sum = np.zeros(self.freq.size)
+        self._n_segments = 0
+
+    def _consume(self, samples):
+        """
+        Add the power of all the complete fft segments of the current bin and keep the rest of samples
+        """
+        x = np.concatenate([self._tail, samples])
+        if x.size >= self.nfft:
+            n_segments = (x.size - self.nfft) // self.step + 1
+            segments = np.lib.stride_tricks.sliding_window_view(x, self.nfft)[::self.step][:n_segments]
+            spectra = scipy.fft.rfft(segments * self.window, n=self.nfft, axis=-1)
+            self._power_sum += (spectra.real ** 2 + spectra.imag ** 2).sum(axis=0)
+            self._n_segments += n_segments
+            x = x[n_segments * self.step:]
+        self._tail = x
+        self._bin_received += samples.size
+        self.n_samples += samples.size
+
+    def _emit(self):
+        """
+        Return the current bin as (first sample, spectrum) and start the next one
+        """
+        output = (self.bin_start, self._power_sum / self._n_segments * self.scale)
+        self.bin_start += self._bin_received
+        self._reset_bin()
+        return output
+
+    def add(self, samples):
+        """
+        Add a block of samples
+
+        Parameters
+        ----------
+        samples : np.array
+            Consecutive samples of the signal (1D)
+
+        Returns
+        -------
+        List of (first sample, spectrum) of the bins completed with this block
+        """
+        finished = []
+        while samples.size > 0:
+            if self.bin_samples is None:
+                n = samples.size
+            else:
+                n = min(samples.size, self.bin_samples - self._bin_received)
+            self._consume(samples[:n])
+            samples = samples[n:]
+            if self._bin_received == self.bin_samples:
+                finished.append(self._emit())
+        return finished
+
+    def flush(self):
+        """
+        Finish the current (incomplete) bin, i.e. at the end of the signal or before a gap.
+        The incomplete bin is only returned if it contains at least one fft segment
+
+        Returns
+        -------
+        List with the (first sample, spectrum) of the incomplete bin, or empty list
+        """
+        if self._n_segments > 0:
+            return [self._emit()]
+        self.bin_start += self._bin_received
+        self._reset_bin()
+        return []
@@ -16,6 +16,7 @@ To merge or re-index output
     select_datetime_range
     select_frequency_range
     merge_ds
+    merge_ds_list
 
 
 To join frequency bands
@@ -26,6 +27,8 @@ To join frequency bands
     get_bands_limits
     get_hybrid_millidecade_limits
     spectra_ds_to_bands
+    hmb_to_decidecade
+    hmb_decidecade_aggregation
 
 
 SPD
@@ -34,6 +37,18 @@ SPD
     :toctree: generated/
 
     compute_spd
+    SpdAccumulator
+
+
+Impulsive events
+----------------
+.. autosummary::
+    :toctree: generated/
+
+    energy_window
+    cumulative_energy
+    energy_windows
+    EnergyIndex
 
 """
 
@@ -50,6 +65,7 @@ import xarray
 import pandas as pd
 import pathlib
 from tqdm import tqdm
+import functools
 from functools import partial
 
 try:
@@ -59,11 +75,21 @@ try:
 except ModuleNotFoundError:
     dask = None
 
+from pypam import _bands
+from pypam import _filters
 from pypam import units as output_units
 
 G = 10.0 ** (3.0 / 10.0)
 f_ref = 1000
 
+# Maximum number of band tables kept in the cache of get_bands_limits
+BANDS_CACHE_MAXSIZE = 64
+
+# Frequency where the hybrid millidecade bands change from linear (1 Hz) to logarithmic
+HMB_CHANGING_FREQUENCY = 434
+# Metrics computed together by broadband_metrics, in the order of its output columns
+BROADBAND_METRICS = ('rms', 'peak', 'dynamic_range', 'sel', 'kurtosis')
+
 
 @nb.njit
 def sxx2spd(sxx: np.ndarray, h: float, bin_edges: np.ndarray):
@@ -155,6 +181,65 @@ def kurtosis(signal):
     mu2 = np.sum(var) / (n-1)
     return mu4/mu2 ** 2
 
+
+@nb.njit
+def broadband_metrics(blocks, fs):
+    """
+    Return the rms, peak, dynamic range, sel and kurtosis of each row of blocks (i.e. the bins of a file) in a single
+    pass over the samples. The central moments of the kurtosis are updated with Welford's online algorithm, so no
+    temporary arrays are needed. The values are the same as the ones of rms, peak, dynamic_range, sel and kurtosis
+    (the kurtosis up to rounding errors)
+
+    Parameters
+    ----------
+    blocks : 2D numpy array
+        Signals in upa, one per row
+    fs : int
+        Sampling frequency
+
+    Returns
+    -------
+    np.array (n_rows x 5) with the metrics in the order of BROADBAND_METRICS. The kurtosis is nan if the signal has
+    less than 2 samples or is constant
+    """
+    n_rows, n = blocks.shape
+    metrics = np.full((n_rows, 5), np.nan)
+    if n == 0:
+        return metrics
+    for i in range(n_rows):
+        sum_squares = 0.0
+        max_value = -np.inf
+        min_value = np.inf
+        mean = 0.0
+        m2 = 0.0
+        m3 = 0.0
+        m4 = 0.0
+        for k in range(n):
+            x = blocks[i, k]
+            sum_squares += x ** 2
+            if x > max_value:
+                max_value = x
+            if x < min_value:
+                min_value = x
+            # Update of the sums of the powers of the deviations from the mean (Terriberry's extension of Welford)
+            count = k + 1
+            delta = x - mean
+            delta_n = delta / count
+            delta_n2 = delta_n * delta_n
+            term = delta * delta_n * k
+            mean += delta_n
+            m4 += term * delta_n2 * (count * count - 3 * count + 3) + 6 * delta_n2 * m2 - 4 * delta_n * m3
+            m3 += term * delta_n * (count - 2) - 3 * delta_n * m2
+            m2 += term
+        metrics[i, 0] = np.sqrt(sum_squares / n)
+        metrics[i, 1] = max(max_value, -min_value)
+        metrics[i, 2] = max_value - min_value
+        metrics[i, 3] = sum_squares / fs
+        if n > 1 and m2 > 0:
+            metrics[i, 4] = (m4 / n) / (m2 / (n - 1)) ** 2
+    return metrics
+
+
 @nb.njit
 def energy_window(signal, percentage):
     """
@@ -182,6 +267,317 @@ def energy_window(signal, percentage):
     window = [iStartPercent, iEndPercent]
     return window
 
+
+def cumulative_energy(signal):
+    """
+    Return the prefix sums of the squared signal, starting with 0, so the energy (sum of squares) of the samples
+    signal[start:end] is cumulative[end] - cumulative[start]. They are computed in float64 and can be shared by all
+    the events of a recording. It is the cumulative energy of an EnergyIndex with block_size 1
+
+    Parameters
+    ----------
+    signal : numpy array
+        Signal in upa
+    """
+    return _block_cumulative(np.asarray(signal), 1)
+
+
+@nb.njit
+def _closest_index(cumulative, start, end, value):
+    """
+    Return the first sample k of [start, end) for which cumulative[k + 1] is the closest to value, as the argmin in
+    energy_window, with a binary search (cumulative is not decreasing)
+    """
+    i = start + np.searchsorted(cumulative[start + 1:end + 1], value)
+    if i == end or (i > start and value - cumulative[i] <= cumulative[i + 1] - value):
+        # The previous sample is closer (or as close): go to the first one with the same cumulative energy
+        i = start + np.searchsorted(cumulative[start + 1:end + 1], cumulative[i])
+    return i
+
+
+@nb.njit
+def energy_windows(cumulative, starts, ends, percentage):
+    """
+    Return the sample windows [start, end] of the events signal[starts[i]:ends[i]] which contain a given
+    percentage of their energy, as energy_window (relative to the start of each event). Each window is found with
+    a binary search in the prefix sums of the squared signal, so the cost does not depend on the event length.
+    EnergyIndex uses it when it stores the energy of every sample (block_size 1)
+
+    Parameters
+    ----------
+    cumulative : numpy array
+        Prefix sums of the squared signal, see cumulative_energy
+    starts : numpy array
+        First sample of each event
+    ends : numpy array
+        End (excluded) of each event
+    percentage : float between [0,1]
+        percentage of total energy contained in output window
+
+    Returns
+    -------
+    np.array (n_events x 2) with the start and end of each window
+    """
+    windows = np.zeros((starts.size, 2), dtype=np.int64)
+    for i in range(starts.size):
+        start = starts[i]
+        end = ends[i]
+        if end <= start:
+            continue
+        total = cumulative[end] - cumulative[start]
+        windows[i, 0] = _closest_index(cumulative, start, end,
+                                       cumulative[start] + (.50 - percentage / 2) * total) - start
+        windows[i, 1] = _closest_index(cumulative, start, end,
+                                       cumulative[start] + (.50 + percentage / 2) * total) - start
+    return windows
+
+
+@nb.njit
+def _block_cumulative(signal, block_size):
+    """
+    Return the energy (sum of squares, in float64) of signal before each multiple of block_size, and of the whole
+    signal as last value
+    """
+    n_blocks = (signal.size + block_size - 1) // block_size
+    cumulative = np.zeros(n_blocks + 1)
+    energy = 0.0
+    for j in range(signal.size):
+        if j % block_size == 0:
+            cumulative[j // block_size] = energy
+        energy += float(signal[j]) ** 2
+    cumulative[n_blocks] = energy
+    return cumulative
+
+
+@nb.njit
+def _energy_at(cumulative, signal, block_size, k):
+    """
+    Energy of signal[:k], from the energy before its block and the samples of the block before k
+    """
+    b = k // block_size
+    if b == cumulative.size - 1:
+        return cumulative[b]
+    energy = cumulative[b]
+    for j in range(b * block_size, k):
+        energy += float(signal[j]) ** 2
+    return energy
+
+
+@nb.njit
+def _first_reaching(cumulative, signal, block_size, start, end, value):
+    """
+    First sample k of [start, end) for which the energy of signal[:k + 1] is at least value (end if there is none).
+    The block is found with a binary search and the sample with a scan of the block
+    """
+    last = np.searchsorted(cumulative, value)
+    if last == cumulative.size:
+        return end
+    k = max(start + 1, (last - 1) * block_size + 1)
+    energy = _energy_at(cumulative, signal, block_size, k)
+    while k <= end:
+        if energy >= value:
+            return k - 1
+        if k < signal.size:
+            energy += float(signal[k]) ** 2
+        k += 1
+    return end
+
+
+@nb.njit
+def _closest_sample(cumulative, signal, block_size, start, end, value):
+    """
+    First sample k of [start, end) for which the energy of signal[:k + 1] is the closest to value, as the argmin in
+    energy_window
+    """
+    i = _first_reaching(cumulative, signal, block_size, start, end, value)
+    if i == end or (i > start and value - _energy_at(cumulative, signal, block_size, i) <=
+                    _energy_at(cumulative, signal, block_size, i + 1) - value):
+        # The previous sample is closer (or as close): go to the first one with the same cumulative energy
+        i = _first_reaching(cumulative, signal, block_size, start, end,
+                            _energy_at(cumulative, signal, block_size, i))
+    return i
+
+
+@nb.njit
+def _energy_windows(cumulative, signal, block_size, starts, ends, percentage):
+    windows = np.zeros((starts.size, 2), dtype=np.int64)
+    for i in range(starts.size):
+        start = starts[i]
+        end = ends[i]
+        if end <= start:
+            continue
+        start_energy = _energy_at(cumulative, signal, block_size, start)
+        total = _energy_at(cumulative, signal, block_size, end) - start_energy
+        windows[i, 0] = _closest_sample(cumulative, signal, block_size, start, end,
+                                        start_energy + (.50 - percentage / 2) * total) - start
+        windows[i, 1] = _closest_sample(cumulative, signal, block_size, start, end,
+                                        start_energy + (.50 + percentage / 2) * total) - start
+    return windows
+
+
+@nb.njit
+def _energies(cumulative, signal, block_size, starts, ends):
+    energy = np.zeros(starts.size)
+    for i in range(starts.size):
+        energy[i] = (_energy_at(cumulative, signal, block_size, ends[i]) -
+                     _energy_at(cumulative, signal, block_size, starts[i]))
+    return energy
+
+
+class EnergyIndex:
+    def __init__(self, signal, block_size=1):
+        """
+        Index of the cumulative energy (sum of the squared pressure) of a whole recording, to answer energy queries
+        of many intervals (i.e. events) without going through their samples: the energy and the SEL of any interval,
+        and the energy windows and pulse widths (see energy_window) with a binary search.
+        With block_size 1 the cumulative energy of every sample is stored (8 bytes per sample), and the windows are
+        the same as the ones of energy_window. With a bigger block_size only the energy before each block is stored,
+        and the samples inside the block are added for each query (block_size times less memory, and queries
+        proportional to block_size). The signal is kept as a reference, not copied
+
+        Parameters
+        ----------
+        signal : 1D numpy array
+            Signal in upa
+        block_size : int
+            Number of samples per stored cumulative energy
+        """
+        self.signal = np.asarray(signal)
+        self.block_size = int(block_size)
+        self.cumulative = _block_cumulative(self.signal, self.block_size)
+
+    def __len__(self):
+        return self.signal.size
+
+    def energy(self, starts, ends):
+        """
+        Return the energy (sum of squares) of signal[starts[i]:ends[i]] for each interval
+
+        Parameters
+        ----------
+        starts : int or array of int
+            First sample of each interval
+        ends : int or array of int
+            End (excluded) of each interval
+        """
+        starts, ends = np.broadcast_arrays(np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64))
+        energy = _energies(self.cumulative, self.signal, self.block_size, starts.ravel(), ends.ravel())
+        return energy.reshape(starts.shape)
+
+    def sel(self, starts, ends, fs):
+        """
+        Return the SEL (linear, as sel) of each interval
+
+        Parameters
+        ----------
+        starts : int or array of int
+            First sample of each interval
+        ends : int or array of int
+            End (excluded) of each interval
+        fs : int
+            Sampling frequency
+        """
+        return self.energy(starts, ends) / fs
+
+    def windows(self, starts, ends, percentage):
+        """
+        Return the sample windows [start, end] of each interval which contain a given percentage of its energy, as
+        energy_window (relative to the start of the interval)
+
+        Parameters
+        ----------
+        starts : array of int
+            First sample of each interval
+        ends : array of int
+            End (excluded) of each interval
+        percentage : float between [0,1]
+            percentage of total energy contained in output window
+
+        Returns
+        -------
+        np.array (n_intervals x 2)
+        """
+        starts = np.atleast_1d(np.asarray(starts, dtype=np.int64))
+        ends = np.atleast_1d(np.asarray(ends, dtype=np.int64))
+        if self.block_size == 1:
+            return energy_windows(self.cumulative, starts, ends, percentage)
+        return _energy_windows(self.cumulative, self.signal, self.block_size, starts, ends, percentage)
+
+    def window(self, start, end, percentage):
+        """
+        Return the sample window [start, end] of signal[start:end] which contains a given percentage of its energy,
+        as energy_window
+        """
+        window = self.windows(start, end, percentage)[0]
+        return [window[0], window[1]]
+
+    def pulse_width(self, starts, ends, percentage, fs):
+        """
+        Return the pulse width (in seconds) of each interval, according to a fractional energy window
+
+        Parameters
+        ----------
+        starts : array of int
+            First sample of each interval
+        ends : array of int
+            End (excluded) of each interval
+        percentage : float between [0,1]
+            percentage of total energy contained in the window
+        fs : int
+            Sampling frequency
+        """
+        windows = self.windows(starts, ends, percentage)
+        return (windows[:, 1] - windows[:, 0]) / fs
+
+
+@nb.njit
+def events_peak_kurtosis(signal, starts, ends):
+    """
+    Return the peak (maximum absolute value) and the kurtosis (as kurtosis) of the events signal[starts[i]:ends[i]],
+    with one pass over the samples of each event (Welford's online algorithm for the moments)
+
+    Parameters
+    ----------
+    signal : numpy array
+        Signal containing all the events
+    starts : numpy array
+        First sample of each event
+    ends : numpy array
+        End (excluded) of each event
+
+    Returns
+    -------
+    peak, kurtosis (numpy arrays, nan for the events with less than 2 samples or constant)
+    """
+    peak = np.full(starts.size, np.nan)
+    kurt = np.full(starts.size, np.nan)
+    for i in range(starts.size):
+        n = ends[i] - starts[i]
+        if n <= 0:
+            continue
+        max_abs = 0.0
+        mean = 0.0
+        m2 = 0.0
+        m3 = 0.0
+        m4 = 0.0
+        for k in range(n):
+            x = signal[starts[i] + k]
+            if abs(x) > max_abs:
+                max_abs = abs(x)
+            count = k + 1
+            delta = x - mean
+            delta_n = delta / count
+            delta_n2 = delta_n * delta_n
+            term = delta * delta_n * k
+            mean += delta_n
+            m4 += term * delta_n2 * (count * count - 3 * count + 3) + 6 * delta_n2 * m2 - 4 * delta_n * m3
+            m3 += term * delta_n * (count - 2) - 3 * delta_n * m2
+            m2 += term
+        peak[i] = max_abs
+        if n > 1 and m2 > 0:
+            kurt[i] = (m4 / n) / (m2 / (n - 1)) ** 2
+    return peak, kurt
+
 @nb.njit
 def set_gain(wave, gain):
     """
@@ -302,6 +698,7 @@ def decidecade_bands(min_freq, max_freq, bounded=False):
     else:
         return center,high,low
 
+@_filters.cached
 def octdsgn(fc, fs, fraction=1, n=2):
     """
     Design of an octave band filter with center frequency fc for sampling frequency fs.
@@ -334,9 +731,27 @@ def octdsgn(fc, fs, fraction=1, n=2):
     return sos
 
 
+def oct_center_freqs(bands, fraction=1):
+    """
+    Return the center frequencies of the octave bands used by octbankdsgn (base 10 octaves)
+
+    Parameters
+    ----------
+    bands : numpy array
+        Band numbers (0 = band with center frequency of 1 kHz)
+    fraction : int
+        1 or 3 to get 1-octave or 1/3-octave bands
+    """
+    uneven = (fraction % 2 != 0)
+    return f_ref * G ** ((2.0 * bands + 1.0) / (2.0 * fraction)) * np.logical_not(uneven) + uneven * f_ref * G ** (
+            bands / fraction)
+
+
+@_filters.cached
 def octbankdsgn(fs, bands, fraction=1, n=2):
     """
-    Construction of an octave band filterbank.
+    Construction of an octave band filterbank. The filterbank is cached (see _filters.FILTER_CACHE), so it is
+    only designed once per process for each set of parameters.
 
     Parameters
     ----------
@@ -361,9 +776,7 @@ def octbankdsgn(fs, bands, fraction=1, n=2):
     fsnew : numpy array
       New sample frequencies.
     """
-    uneven = (fraction % 2 != 0)
-    fc = f_ref * G ** ((2.0 * bands + 1.0) / (2.0 * fraction)) * np.logical_not(uneven) + uneven * f_ref * G ** (
-            bands / fraction)
+    fc = oct_center_freqs(bands, fraction)
 
     # limit for center frequency compared to sample frequency
     fclimit = 1 / 200
@@ -384,87 +797,161 @@ def octbankdsgn(fs, bands, fraction=1, n=2):
     return filterbank, fsnew, d
 
 
-def get_bands_limits(band, nfft, base, bands_per_division, hybrid_mode, fs=None):
+def get_bands_limits(band, nfft, base, bands_per_division, hybrid_mode, fs=None, copy=True):
     """
+    Limits and centre frequencies of the bands. The tables are computed once for each set of parameters (the last
+    BANDS_CACHE_MAXSIZE are kept), so all the calls with the same band, nfft, fs, base and bands_per_division share
+    them.
 
     Parameters
     ----------
-    band
-    nfft
-    base
-    bands_per_division
-    hybrid_mode
-    fs: if not provided, it will be assumed to be double the highest frequency band limit
+    band : list or tuple
+        [min_freq, max_freq] of the bands
+    nfft : int
+        Number of fft points (only used in hybrid mode, the linear bands are the fft bins)
+    base : float
+        Base of the logarithmic bands (10 for decidecade or millidecade bands)
+    bands_per_division : int
+        Number of bands per base division (10 for decidecade, 1000 for millidecade)
+    hybrid_mode : bool
+        Set to True to use the fft bins as bands below the frequency where the logarithmic bands are narrower
+    fs : float
+        If not provided, it will be assumed to be double the highest frequency band limit
+    copy : bool
+        Set to False to get the cached (read-only) arrays instead of a copy
 
     Returns
     -------
+    bands_limits (np.array with n_bands + 1 elements) and bands_c (np.array with n_bands elements)
+    """
+    if fs is None:
+        fs = band[1] * 2
+    bands_limits, bands_c = _bands_table(float(band[0]), float(band[1]), nfft, base, bands_per_division,
+                                         bool(hybrid_mode), fs)
+    if copy:
+        return bands_limits.copy(), bands_c.copy()
+    return bands_limits, bands_c
+
 
+@functools.lru_cache(maxsize=BANDS_CACHE_MAXSIZE)
+def _bands_table(min_freq, max_freq, nfft, base, bands_per_division, hybrid_mode, fs):
+    """
+    Compute the limits and centres of the bands (see get_bands_limits). The number of linear and logarithmic bands
+    is found in closed form, the band frequencies are then computed all at once
     """
     first_bin_centre = 0
     low_side_multiplier = base ** (-1 / (2 * bands_per_division))
     high_side_multiplier = base ** (1 / (2 * bands_per_division))
-
-    if fs is None:
-        fs = band[1] * 2
     fft_bin_width = fs / nfft
 
-    # Start the frequencies list
-    bands_limits = []
-    bands_c = []
+    def center(n):
+        return get_center_freq(base, bands_per_division, n, min_freq)
+
+    if center(1) <= 0:
+        raise ValueError('The first band centre has to be positive (with bands_per_division %s the minimum '
+                         'frequency of the band has to be higher than 0)' % bands_per_division)
 
-    # count the number of bands:
+    bands_limits = [np.zeros(0)]
+    bands_c = [np.zeros(0)]
     band_count = 0
     center_freq = 0
+    # Centre of the last band computed (None if there is none)
+    fc = None
     if hybrid_mode:
-        bin_width = 0
-        while bin_width < fft_bin_width:
-            band_count = band_count + 1
-            center_freq = get_center_freq(base, bands_per_division, band_count, band[0])
-            bin_width = high_side_multiplier * center_freq - low_side_multiplier * center_freq
-
-        # now keep counting until the difference between the log spaced
-        # center frequency and new frequency is greater than .025
-        center_freq = get_center_freq(base, bands_per_division, band_count, band[0])
+        # first band wider than the fft bins
+        band_count = _first_band(lambda n: (high_side_multiplier * center(n) - low_side_multiplier * center(n)
+                                            >= fft_bin_width),
+                                 1, center, fft_bin_width / (high_side_multiplier - low_side_multiplier))
+
+        # now keep counting until the difference between the log spaced centre frequency and the linear one stops
+        # decreasing
+        center_freq = center(band_count)
         linear_bin_count = round(center_freq / fft_bin_width - first_bin_centre)
-        dc = abs(linear_bin_count * fft_bin_width - center_freq) + 0.1
-        while abs(linear_bin_count * fft_bin_width - center_freq) < dc:
-            # Compute next one
-            dc = abs(linear_bin_count * fft_bin_width - center_freq)
-            band_count = band_count + 1
-            linear_bin_count = linear_bin_count + 1
-            center_freq = get_center_freq(base, bands_per_division, band_count, band[0])
-
-        linear_bin_count = linear_bin_count - 1
-        band_count = band_count - 1
-
-        if (fft_bin_width * linear_bin_count) > band[1]:
+        n_steps = _decreasing_steps(lambda k: abs((linear_bin_count + k) * fft_bin_width - center(band_count + k)),
+                                    lambda k: np.abs((linear_bin_count + k) * fft_bin_width -
+                                                     center(band_count + k)))
+        center_freq = center(band_count + n_steps)
+        linear_bin_count = linear_bin_count + n_steps - 1
+        band_count = band_count + n_steps - 1
+
+        if (fft_bin_width * linear_bin_count) > max_freq:
             linear_bin_count = fs / 2 / fft_bin_width + 1
 
-        for i in np.arange(linear_bin_count):
-            # Add the frequencies
-            fc = first_bin_centre + i * fft_bin_width
-            if fc >= band[0]:
-                bands_c.append(fc)
-                bands_limits.append(fc - fft_bin_width / 2)
+        i = np.arange(linear_bin_count)
+        if i.size > 0:
+            linear_c = first_bin_centre + i * fft_bin_width
+            fc = linear_c[-1]
+            linear_c = linear_c[linear_c >= min_freq]
+            bands_c.append(linear_c)
+            bands_limits.append(linear_c - fft_bin_width / 2)
 
-    # count the log space frequencies
+    # log spaced frequencies, up to the first band which reaches the maximum frequency
     ls_freq = center_freq * high_side_multiplier
-    while ls_freq < band[1]:
-        fc = get_center_freq(base, bands_per_division, band_count, band[0])
+    if ls_freq < max_freq:
+        last_band = _first_band(lambda n: center(n) * high_side_multiplier >= max_freq,
+                                band_count, center, max_freq / high_side_multiplier)
+        log_c = center(np.arange(band_count, last_band + 1))
+        fc = center(last_band)
+        log_c[-1] = fc
         ls_freq = fc * high_side_multiplier
-        if fc >= band[0]:
-            bands_c.append(fc)
-            bands_limits.append(fc * low_side_multiplier)
-        band_count += 1
+        log_c = log_c[log_c >= min_freq]
+        bands_c.append(log_c)
+        bands_limits.append(log_c * low_side_multiplier)
+
+    bands_c = np.concatenate(bands_c).astype(float)
     # Add the upper limit (bands_limits's length will be +1 compared to bands_c)
-    if ls_freq > band[1]:
-        ls_freq = band[1]
-        if fc > band[1]:
-            bands_c[-1] = band[1]
-    bands_limits.append(ls_freq)
+    if ls_freq > max_freq:
+        ls_freq = max_freq
+        if fc is not None and fc > max_freq:
+            bands_c[-1] = max_freq
+    bands_limits.append([ls_freq])
+    bands_limits = np.concatenate(bands_limits).astype(float)
+    bands_limits.flags.writeable = False
+    bands_c.flags.writeable = False
     return bands_limits, bands_c
 
 
+def _first_band(condition, start, center, target):
+    """
+    First band number n >= start for which condition(n) is True. condition has to be monotonic, equivalent to
+    center(n) >= target. The band is estimated from the geometric progression of the centres, and then checked
+    with condition itself, so the result is the same as counting one band at a time
+    """
+    n = start
+    if target > 0:
+        ratio = center(2) / center(1)
+        n = max(start, int(np.ceil(1 + np.log(target / center(1)) / np.log(ratio))))
+    while n > start and condition(n - 1):
+        n -= 1
+    while not condition(n):
+        n += 1
+    return n
+
+
+def _decreasing_steps(difference, differences):
+    """
+    Number of steps k (starting at 0) while difference(k) is strictly decreasing, so difference(k) is the first one
+    which is not lower than difference(k - 1). The candidate is found with the vectorized differences, and then
+    checked with the scalar difference
+    """
+    k = 1
+    size = 64
+    while True:
+        steps = np.arange(k - 1, k + size)
+        d = differences(steps)
+        stops = np.where(d[1:] >= d[:-1])[0]
+        if stops.size > 0:
+            k = k + stops[0]
+            break
+        k = k + size
+        size = size * 2
+    while k > 1 and difference(k - 1) >= difference(k - 2):
+        k -= 1
+    while difference(k) < difference(k - 1):
+        k += 1
+    return k
+
+
 def get_center_freq(base, bands_per_division, n, first_out_band_centre_freq):
     if (bands_per_division == 10) or ((bands_per_division % 2) == 1):
         center_freq = first_out_band_centre_freq * base ** ((n - 1) / bands_per_division)
@@ -514,8 +1001,9 @@ def get_decidecade_limits(band, nfft, fs=None):
 def spectra_ds_to_bands(psd, bands_limits, bands_c, fft_bin_width, freq_coord='frequency', db=True):
     """
     Group the psd according to the limits band_limits given. If a limit is not aligned with the limits in the psd
-    frequency axis then that psd frequency bin is divided in proportion to each of the adjacent bands. For more details
-    see publication Ocean Sound Analysis Software for Making Ambient Noise Trends Accessible (MANTA)
+    frequency axis then that psd frequency bin is divided in proportion to each of the adjacent bands. The grouping is
+    done with one sparse matrix product (see _bands.BandAggregation), cached for each frequency axis and bands.
+    For more details see publication Ocean Sound Analysis Software for Making Ambient Noise Trends Accessible (MANTA)
     (https://doi.org/10.3389/fmars.2021.703650)
 
     Parameters
@@ -539,39 +1027,9 @@ def spectra_ds_to_bands(psd, bands_limits, bands_c, fft_bin_width, freq_coord='f
     xarray DataArray with frequency_bins instead of frequency as a dimension.
 
     """
-    fft_freq_indices = (np.floor((np.array(bands_limits) + (fft_bin_width / 2)) / fft_bin_width)).astype(int)
-    original_first_fft_index = int(psd[freq_coord].values[0] / fft_bin_width)
-    fft_freq_indices -= original_first_fft_index
-
-    if fft_freq_indices[-1] > (len(psd[freq_coord]) - 1):
-        fft_freq_indices[-1] = len(psd[freq_coord]) - 1
-    limits_df = pd.DataFrame(data={'lower_indexes': fft_freq_indices[:-1], 'upper_indexes': fft_freq_indices[1:],
-                                   'lower_freq': bands_limits[:-1], 'upper_freq': bands_limits[1:]})
-    limits_df['lower_factor'] = limits_df['lower_indexes'] * fft_bin_width + fft_bin_width / 2 - limits_df[
-        'lower_freq'] + psd[freq_coord].values[0]
-    limits_df['upper_factor'] = limits_df['upper_freq'] - (
-            limits_df['upper_indexes'] * fft_bin_width - fft_bin_width / 2) - psd[freq_coord].values[0]
-
-    psd_limits_lower = psd.isel(**{freq_coord: limits_df['lower_indexes'].values}) * [
-        limits_df['lower_factor']] / fft_bin_width
-    psd_limits_upper = psd.isel(**{freq_coord: limits_df['upper_indexes'].values}) * [
-        limits_df['upper_factor']] / fft_bin_width
-    # Bin the bands and add the borders
-    psd_without_borders = psd.drop_isel(**{freq_coord: fft_freq_indices})
-    new_coord_name = freq_coord + '_bins'
-    if len(psd_without_borders[freq_coord]) == 0:
-        psd_bands = xarray.zeros_like(psd)
-        psd_bands = psd_bands.assign_coords({new_coord_name: (freq_coord, bands_c)})
-        psd_bands = psd_bands.swap_dims({freq_coord: new_coord_name}).drop_vars(freq_coord)
-    else:
-        psd_bands = psd_without_borders.groupby_bins(freq_coord, bins=bands_limits, labels=bands_c, right=False).sum()
-        psd_bands = psd_bands.fillna(0)
-    psd_bands = psd_bands + psd_limits_lower.values + psd_limits_upper.values
-    psd_bands = psd_bands.assign_coords({'lower_frequency': (new_coord_name, limits_df['lower_freq'])})
-    psd_bands = psd_bands.assign_coords({'upper_frequency': (new_coord_name, limits_df['upper_freq'])})
-
-    bandwidths = psd_bands.upper_frequency - psd_bands.lower_frequency
-    psd_bands = psd_bands / bandwidths
+    # The weights of each fft bin in each band are only computed once per frequency axis and bands
+    aggregation = _bands.band_aggregation(psd[freq_coord].values, bands_limits, bands_c, fft_bin_width)
+    psd_bands = aggregation.apply_da(psd, freq_coord=freq_coord)
 
     if db:
         psd_bands = 10 * np.log10(psd_bands)
@@ -626,18 +1084,11 @@ def merge_ds(ds, new_ds, attrs_to_vars):
     -------
     ds : merged dataset
     """
-    new_coords = {}
-    for attr in attrs_to_vars:
-        if attr in new_ds.attrs.keys():
-            new_coords[attr] = ('id', [new_ds.attrs[attr]] * new_ds.dims['id'])
     if len(ds.dims) != 0:
         start_value = ds['id'][-1].values + 1
     else:
         start_value = 0
-    new_ids = np.arange(start_value, start_value + new_ds.dims['id'])
-    new_ds = new_ds.reset_index('id')
-    new_coords['id'] = new_ids
-    new_ds = new_ds.assign_coords(new_coords)
+    new_ds = _prepare_ds_to_merge(new_ds, start_value, attrs_to_vars)
     if len(ds.dims) == 0:
         ds = ds.merge(new_ds)
     else:
@@ -646,6 +1097,70 @@ def merge_ds(ds, new_ds, attrs_to_vars):
     return ds
 
 
+def merge_ds_list(ds, ds_list, attrs_to_vars):
+    """
+    Merges all the datasets in ds_list (in order) into the ds. The output is the same as calling merge_ds for each of
+    them, but all the datasets are concatenated at once, so the cost does not grow quadratically with the number of
+    datasets.
+
+    Parameters
+    ----------
+    ds: xarray Dataset
+        Already existing dataset
+    ds_list : list of xarray Dataset
+        New datasets to merge
+    attrs_to_vars: list or None
+        List of all the attributes to convert to coordinates (not dimensions)
+
+    Returns
+    -------
+    ds : merged dataset
+    """
+    if len(ds_list) == 0:
+        return ds
+    if len(ds.dims) != 0:
+        start_value = ds['id'][-1].values + 1
+    else:
+        start_value = 0
+    to_merge = []
+    for new_ds in ds_list:
+        new_ds = _prepare_ds_to_merge(new_ds, start_value, attrs_to_vars)
+        start_value += new_ds.dims['id']
+        to_merge.append(new_ds)
+    if len(ds.dims) == 0:
+        ds = ds.merge(to_merge[0])
+        ds.attrs.update(to_merge[0].attrs)
+        to_merge = to_merge[1:]
+    if len(to_merge) > 0:
+        ds = xarray.concat([ds] + to_merge, 'id', combine_attrs="drop_conflicts")
+        for new_ds in to_merge:
+            ds.attrs.update(new_ds.attrs)
+    return ds
+
+
+def _prepare_ds_to_merge(new_ds, start_value, attrs_to_vars):
+    """
+    Convert the attributes in attrs_to_vars to coordinates depending on id and re-number the ids from start_value
+
+    Parameters
+    ----------
+    new_ds : xarray Dataset
+        Dataset to prepare
+    start_value : int
+        First id of the new_ds
+    attrs_to_vars: list or None
+        List of all the attributes to convert to coordinates (not dimensions)
+    """
+    new_coords = {}
+    for attr in attrs_to_vars:
+        if attr in new_ds.attrs.keys():
+            new_coords[attr] = ('id', [new_ds.attrs[attr]] * new_ds.dims['id'])
+    new_ids = np.arange(start_value, start_value + new_ds.dims['id'])
+    new_ds = new_ds.reset_index('id')
+    new_coords['id'] = new_ids
+    return new_ds.assign_coords(new_coords)
+
+
 def compute_spd(psd_evolution, data_var='band_density', h=1.0, percentiles=None, max_val=None, min_val=None):
     pxx = psd_evolution[data_var].to_numpy().T
     freq_axis = psd_evolution[data_var].dims[1]
@@ -677,6 +1192,211 @@ def compute_spd(psd_evolution, data_var='band_density', h=1.0, percentiles=None,
     return spd_ds
 
 
+class SpdAccumulator:
+    def __init__(self, h=1.0, min_val=None, max_val=None):
+        """
+        Streaming spectral probability density. The psd are added in groups of bins (i.e. the psd of each file) and
+        only a histogram of integer counts per frequency is kept, so the memory used does not depend on the number
+        of bins added. Accumulators of different files (i.e. computed in parallel) can be merged.
+        The histogram bins are [min_val + k * h, min_val + (k + 1) * h), as in compute_spd. If min_val is None they
+        start at 0, and if max_val is None the histogram grows with the values added. Values lower than the first
+        bin (or than 0) are not part of the histogram, as in compute_spd.
+
+        Parameters
+        ----------
+        h : float
+            Histogram bin width (in the correspondent units, upa or db)
+        min_val : float or None
+            Minimum value to compute the SPD histogram
+        max_val : float or None
+            Maximum value to compute the SPD histogram
+        """
+        self.h = h
+        self.min_val = min_val
+        self.max_val = max_val
+        self.first_edge = 0 if min_val is None else max(0, min_val)
+        # Same bin edges as np.arange(first_edge, max_val, h)
+        self._delta = (self.first_edge + h) - self.first_edge
+        if max_val is None:
+            self.n_bins = 0
+        else:
+            self.n_bins = max(np.arange(start=self.first_edge, stop=max_val, step=h).size - 1, 0)
+        self.freq = None
+        self.freq_axis = None
+        self.attrs = {}
+        # Number of bins added, and per frequency: counts per histogram bin, number of values below the histogram
+        # and number of values which are not nan
+        self.n_values = 0
+        self.counts = None
+        self.below = None
+        self.not_nan = None
+
+    def _edge(self, k):
+        return self.first_edge + k * self._delta
+
+    def _bin_edges(self, n_bins):
+        return self._edge(np.arange(n_bins + 1))
+
+    def _start(self, freq, freq_axis, attrs):
+        """
+        Set the frequencies of the histogram
+        """
+        self.freq = freq
+        self.freq_axis = freq_axis
+        self.attrs = dict(attrs)
+        self.counts = np.zeros((self.freq.size, self.n_bins), dtype=np.int64)
+        self.below = np.zeros(self.freq.size, dtype=np.int64)
+        self.not_nan = np.zeros(self.freq.size, dtype=np.int64)
+
+    def _grow(self, n_bins):
+        """
+        Add empty histogram bins at the end, up to n_bins
+        """
+        if n_bins > self.n_bins:
+            self.counts = np.pad(self.counts, ((0, 0), (0, n_bins - self.n_bins)))
+            self.n_bins = n_bins
+
+    def add(self, psd_evolution, data_var='band_density'):
+        """
+        Add the psd of some bins to the histogram
+
+        Parameters
+        ----------
+        psd_evolution : xarray Dataset
+            Output of a psd method, with the dimensions (id, frequency)
+        data_var : str
+            Name of the variable with the psd
+        """
+        psd = psd_evolution[data_var]
+        freq_axis = psd.dims[1]
+        if self.freq is None:
+            self._start(psd[freq_axis].values, freq_axis, psd.attrs)
+        elif not np.array_equal(psd[freq_axis].values, self.freq):
+            raise ValueError('All the psd added to the SPD need the same frequencies')
+        pxx = psd.to_numpy()
+
+        # Histogram bin of each value, checked with the bin edges so they are the same as with np.histogram
+        k = np.floor((pxx - self.first_edge) / self._delta)
+        valid = np.isfinite(k) & (pxx >= self.first_edge)
+        k = np.where(valid, k, 0).astype(np.int64)
+        k[valid & (pxx < self._edge(k))] -= 1
+        k[valid & (pxx >= self._edge(k + 1))] += 1
+        if self.max_val is None:
+            if valid.any():
+                self._grow(k[valid].max() + 1)
+        else:
+            # The last bin includes its upper edge
+            last = valid & (k == self.n_bins) & (pxx == self._edge(self.n_bins))
+            k[last] = self.n_bins - 1
+            valid = valid & (k < self.n_bins)
+        freq_index = np.broadcast_to(np.arange(self.freq.size), pxx.shape)
+        self.counts += np.bincount((freq_index * self.n_bins + k)[valid],
+                                   minlength=self.counts.size).reshape(self.counts.shape)
+        self.below += (pxx < self.first_edge).sum(axis=0)
+        self.not_nan += (~np.isnan(pxx)).sum(axis=0)
+        self.n_values += pxx.shape[0]
+        return self
+
+    def merge(self, other):
+        """
+        Add the histogram of other (i.e. computed in another process) to this one
+
+        Parameters
+        ----------
+        other : SpdAccumulator
+            Accumulator with the same h, min_val and max_val
+        """
+        if (other.h, other.min_val, other.max_val) != (self.h, self.min_val, self.max_val):
+            raise ValueError('Only SPD accumulators with the same histogram bins can be merged')
+        if other.freq is None:
+            return self
+        if self.freq is None:
+            self._start(other.freq, other.freq_axis, other.attrs)
+        elif not np.array_equal(other.freq, self.freq):
+            raise ValueError('All the psd added to the SPD need the same frequencies')
+        self._grow(other.n_bins)
+        self.counts[:, :other.n_bins] += other.counts
+        self.below += other.below
+        self.not_nan += other.not_nan
+        self.n_values += other.n_values
+        return self
+
+    def percentiles(self, percentiles):
+        """
+        Percentiles of the values of each frequency. Each value is placed inside its histogram bin (spread uniformly
+        among the values of the same bin) and the percentiles are interpolated as np.nanpercentile does, so the
+        error is lower than h. The values out of the histogram are taken as its limits
+
+        Parameters
+        ----------
+        percentiles : list
+            Percentiles to compute (in 100 per cent)
+
+        Returns
+        -------
+        np.array with shape (n_freq, n_percentiles)
+        """
+        bin_edges = self._bin_edges(self.n_bins)
+        p = np.full((self.freq.size, len(percentiles)), np.nan)
+        for i in range(self.freq.size):
+            if self.not_nan[i] == 0:
+                continue
+            # Rank (in the sorted values) where each bin starts
+            starts = self.below[i] + np.concatenate([[0], np.cumsum(self.counts[i])])
+            rank = np.array(percentiles) / 100 * (self.not_nan[i] - 1)
+            low_rank = np.floor(rank)
+            high_rank = np.minimum(low_rank + 1, self.not_nan[i] - 1)
+            low_value, high_value = [self._rank_value(r, starts, self.counts[i], bin_edges)
+                                     for r in [low_rank, high_rank]]
+            p[i] = low_value + (rank - low_rank) * (high_value - low_value)
+        return p
+
+    def _rank_value(self, rank, starts, counts, bin_edges):
+        """
+        Estimated value of the ranks (in the sorted values of one frequency)
+        """
+        b = np.searchsorted(starts, rank, side='right') - 1
+        inside = (b >= 0) & (b < counts.size)
+        value = np.where(b < 0, bin_edges[0], bin_edges[-1]).astype(float)
+        if counts.size > 0:
+            b = np.clip(b, 0, counts.size - 1)
+            position = (rank - starts[b] + 0.5) / np.maximum(counts[b], 1)
+            value[inside] = (bin_edges[b] + position * self.h)[inside]
+        return value
+
+    def to_dataset(self, percentiles=None):
+        """
+        Return the spd as compute_spd
+
+        Parameters
+        ----------
+        percentiles : list or None
+            Percentiles to compute (in 100 per cent), see SpdAccumulator.percentiles
+        """
+        if percentiles is None:
+            percentiles = []
+        bin_edges = self._bin_edges(self.n_bins)
+        spd = self.counts / (max(self.n_values, 1) * self.h)
+        if self.max_val is None:
+            # Remove the empty bins at the start
+            filled = np.where(self.counts.any(axis=0))[0]
+            first_bin = filled[0] if filled.size > 0 and self.min_val is None else 0
+            spd = spd[:, first_bin:]
+            bin_edges = bin_edges[first_bin:]
+        percentiles_names = ['L%s' % str(100 - level_p) for level_p in percentiles]
+        spd_arr = xarray.DataArray(data=spd,
+                                   coords={self.freq_axis: self.freq, 'spl': bin_edges[:-1]},
+                                   dims=[self.freq_axis, 'spl'])
+        p_arr = xarray.DataArray(data=self.percentiles(percentiles),
+                                 coords={self.freq_axis: self.freq, 'percentiles': percentiles_names},
+                                 dims=[self.freq_axis, 'percentiles'])
+        spd_ds = xarray.Dataset(data_vars={'spd': spd_arr, 'value_percentiles': p_arr})
+        units_attrs = output_units.get_units_attrs(method_name='spd', log=False)
+        spd_ds['spd'].attrs.update(units_attrs)
+        spd_ds['spl'].attrs.update(self.attrs)
+        return spd_ds
+
+
 def _swap_dimensions_if_not_dim(ds, datetime_coord):
     """
     Swap the coordinates between ds and datetime_coord
@@ -976,10 +1696,27 @@ def update_freq_cal(hydrophone, ds, data_var, **kwargs):
 
 
 def hmb_to_decidecade(ds, data_var, freq_coord, fs=None):
-    # Convert back to upa for the sum operations
-    ds_data_var = np.power(10, ds[data_var].copy() / 10.0 - np.log10(1))
-    fft_bin_width = 1.0
-    changing_frequency = 434
+    """
+    Convert the hybrid millidecade bands (HMB) of ds to decidecade bands (base 10 third octave bands). The
+    conversion weights are computed once for each HMB frequency axis (see hmb_decidecade_aggregation). If ds is
+    backed by dask (i.e. opened with chunks), the output is computed lazily, so big datasets can be converted
+    without loading them in memory
+
+    Parameters
+    ----------
+    ds : xarray Dataset
+        Dataset with the HMB in db
+    data_var : str
+        Name of the variable with the HMB
+    freq_coord : str
+        Name of the frequency coordinate
+    fs : float
+        Sampling frequency. If None, it is read from the attributes of ds, or taken as double the highest frequency
+
+    Returns
+    -------
+    xarray Dataset with data_var in decidecade bands (in db)
+    """
     if fs is None:
         if 'fs' not in ds.attrs.keys():
             max_freq = ds[freq_coord].values.max()
@@ -989,55 +1726,61 @@ def hmb_to_decidecade(ds, data_var, freq_coord, fs=None):
         max_freq = fs/2
 
     ds[freq_coord] = ds[freq_coord].values.astype(float).round(decimals=2)
+    hmb = ds[data_var]
     # Add the frequency limits if they are not in the ds cordinates
-    if 'upper_frequency' not in ds_data_var.coords:
+    if 'upper_frequency' not in hmb.coords:
         hmb_limits, hmb_c = get_hybrid_millidecade_limits(band=[0, max_freq],
-                                                   nfft=max_freq*2, fs=max_freq*2)
+                                                          nfft=max_freq*2, fs=max_freq*2)
         hmb_limits = np.around(hmb_limits, decimals=2).tolist()
         hmb_c = np.around(hmb_c, decimals=2).tolist()
-        rounded_freq = ds_data_var[freq_coord].values.astype(float).round(decimals=2)
+        rounded_freq = hmb[freq_coord].values
         hmb_limits = hmb_limits[hmb_c.index(rounded_freq.min()):hmb_c.index(rounded_freq.max()) + 2]
-        ds_data_var = ds_data_var.assign_coords(upper_frequency=(freq_coord, hmb_limits[1:]),
-                                                lower_frequency=(freq_coord, hmb_limits[:-1]))
+        hmb = hmb.assign_coords(upper_frequency=(freq_coord, hmb_limits[1:]),
+                                lower_frequency=(freq_coord, hmb_limits[:-1]))
 
-    bands_limits, bands_c = get_decidecade_limits(band=[10, max_freq],
-                                                  nfft=max_freq*2,
-                                                  fs=max_freq*2)
-    bands_limits = np.array(bands_limits).round(decimals=2)
-    bands_c = np.array(bands_c).round(decimals=2)
-    maximum_band = np.where(np.array(bands_limits) > ds_data_var.upper_frequency.values.max())[0][0]
-    bands_limits = bands_limits[:maximum_band+1]
-    bands_c = bands_c[:maximum_band]
-
-    changing_band = np.where(np.array(bands_limits) < changing_frequency)[0][-1]
-    # We need to split the dataset in two, the part which is below the changing frequency and the part which is above
-    low_psd = ds_data_var.where(ds_data_var.upper_frequency <= bands_limits[changing_band], drop=True)
-    low_decidecade = spectra_ds_to_bands(low_psd, bands_limits[:changing_band+1],
-                                         bands_c[:changing_band],
-                                         fft_bin_width,
-                                         freq_coord=freq_coord, db=False)
-
-    # Compute the decidecades on the non-linear part
-    high_psd = ds_data_var.where(ds_data_var.upper_frequency >= bands_limits[changing_band], drop=True)
-    high_pwd = high_psd * (high_psd.upper_frequency - high_psd.lower_frequency)
-    high_decidecade = high_pwd.groupby_bins(freq_coord, bins=bands_limits[changing_band:],
-                                            labels=bands_c[changing_band:],
-                                            right=True).sum()
-    high_decidecade = high_decidecade.assign_coords({'lower_frequency':
-                                                     (freq_coord + '_bins', bands_limits[changing_band:-1])})
-    high_decidecade = high_decidecade.assign_coords({'upper_frequency':
-                                                     (freq_coord + '_bins', bands_limits[changing_band+1:])})
-    bandwidths = high_decidecade.upper_frequency - high_decidecade.lower_frequency
-    high_decidecade = high_decidecade / bandwidths
-
-    # Merge the low and the high decidecade psd
-    decidecade_psd = xarray.merge([{data_var: low_decidecade}, {data_var: high_decidecade}])
+    aggregation = hmb_decidecade_aggregation(hmb[freq_coord].values, hmb.lower_frequency.values,
+                                             hmb.upper_frequency.values, max_freq)
+    # Convert back to upa for the sum operations
+    decidecade_psd = aggregation.apply_da(np.power(10, hmb / 10.0), freq_coord=freq_coord)
 
     # change the name of the frequency coord
     decidecade_psd = decidecade_psd.rename({freq_coord + '_bins': freq_coord})
+    decidecade_psd.attrs = {}
 
     # Convert back to db
-    decidecade_psd = 10 * np.log10(decidecade_psd)
+    return xarray.Dataset({data_var: 10 * np.log10(decidecade_psd)})
+
 
-    return decidecade_psd
+def hmb_decidecade_aggregation(hmb_c, hmb_lower, hmb_upper, max_freq):
+    """
+    Weights to convert the hybrid millidecade bands (HMB) with the specified frequencies to decidecade bands. The
+    conversion is only computed once for each HMB frequency axis, and it can be applied to any array (or chunk of
+    an array) of linear HMB with apply(values, axis), or to a DataArray (also dask-backed) with apply_da. The
+    decidecade bands start at 10 Hz and end at the first band limit above the highest HMB
+
+    Parameters
+    ----------
+    hmb_c : np.array
+        Centre frequencies of the HMB
+    hmb_lower : np.array
+        Lower limits of the HMB
+    hmb_upper : np.array
+        Upper limits of the HMB
+    max_freq : float
+        Nyquist frequency of the HMB
+
+    Returns
+    -------
+    _bands.HmbAggregation
+    """
+    bands_limits, bands_c = get_decidecade_limits(band=[10, max_freq],
+                                                  nfft=max_freq*2,
+                                                  fs=max_freq*2)
+    bands_limits = bands_limits.round(decimals=2)
+    bands_c = bands_c.round(decimals=2)
+    # The bands end at the first limit above the HMB (or at the last one)
+    above = np.where(bands_limits > np.max(hmb_upper))[0]
+    maximum_band = above[0] if above.size > 0 else bands_limits.size - 1
+    return _bands.hmb_aggregation(hmb_c, hmb_lower, hmb_upper, bands_limits[:maximum_band + 1],
+                                  bands_c[:maximum_band], changing_frequency=HMB_CHANGING_FREQUENCY)
 
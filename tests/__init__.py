@@ -21,3 +21,24 @@ def skip_unless_with_plots():
         reason = 'PYPAM_TEST_NO_PLOTS is set'
         return pytest.mark.skip(reason)(test_item)
     return decorator
+
+
+def write_survey(folder, n_files=3, seconds=10, fs=8000, seed=0):
+    """
+    Write n_files consecutive AMAR wav files of noise and impulses in folder, and return their paths.
+    """
+    import datetime
+    import numpy as np
+    import soundfile as sf
+
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2021, 6, 10, 3, 36, 55)
+    paths = []
+    for i in range(n_files):
+        date = start + datetime.timedelta(seconds=i * seconds)
+        path = folder.joinpath('AMAR.%s.wav' % date.strftime('%Y%m%dT%H%M%SZ'))
+        wav = 0.01 * rng.standard_normal(fs * seconds)
+        wav[fs * np.arange(1, seconds)] = 0.5
+        sf.write(path, wav, fs, subtype='PCM_16')
+        paths.append(path)
+    return paths
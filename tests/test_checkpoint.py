@@ -0,0 +1,81 @@
+import pathlib
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pyhydrophone as pyhy
+import pytest
+import xarray
+
+from pypam import _checkpoint
+from pypam.acoustic_file import AcuFile
+from pypam.acoustic_survey import ASA
+from tests import write_survey
+
+amar = pyhy.amar.AmarG3('AMAR', 'G3', 1, -166.6, 0, 2)
+
+
+def test_shard_roundtrip(tmp_path):
+    wav_file = tmp_path.joinpath('file.wav')
+    wav_file.write_bytes(b'0' * 10)
+    ds = xarray.Dataset({'rms': (('id', 'band'), np.random.random((3, 2)))},
+                        coords={'id': np.arange(3), 'datetime': ('id', pd.date_range('2021-06-10', periods=3)),
+                                'band': [0, 1]},
+                        attrs={'dc_subtract': True, 'fs': 8000, 'file_path': str(wav_file)})
+    path = _checkpoint.shard_path(tmp_path.joinpath('checkpoints'), wav_file, {'method': 'rms', 'binsize': 60})
+    assert path == _checkpoint.shard_path(tmp_path.joinpath('checkpoints'), wav_file, {'method': 'rms', 'binsize': 60})
+    assert path != _checkpoint.shard_path(tmp_path.joinpath('checkpoints'), wav_file, {'method': 'rms', 'binsize': 30})
+
+    _checkpoint.save_shard(ds, path)
+    assert path.exists()
+    xarray.testing.assert_identical(ds, _checkpoint.load_shard(path).load())
+
+    # Changing the file changes the shard
+    wav_file.write_bytes(b'1' * 20)
+    assert path != _checkpoint.shard_path(tmp_path.joinpath('checkpoints'), wav_file, {'method': 'rms', 'binsize': 60})
+
+
+def _interrupting(after=None):
+    """
+    Wrapper of AcuFile._apply_multiple which records the files processed and stops the survey after the given number
+    of files (never if None)
+    """
+    original = AcuFile._apply_multiple
+    calls = []
+
+    def apply_multiple(acu_file, *args, **kwargs):
+        calls.append(acu_file.file_path)
+        if after is not None and len(calls) > after:
+            raise KeyboardInterrupt
+        return original(acu_file, *args, **kwargs)
+    return apply_multiple, calls
+
+
+def test_survey_checkpoint_resume(tmp_path):
+    folder = tmp_path.joinpath('data')
+    folder.mkdir()
+    write_survey(folder, n_files=4)
+    checkpoint_dir = tmp_path.joinpath('checkpoints')
+    uninterrupted = ASA(amar, folder, binsize=2.0, nfft=512).evolution_multiple(['rms', 'peak'])
+
+    asa = ASA(amar, folder, binsize=2.0, nfft=512, checkpoint_dir=checkpoint_dir)
+    apply_multiple, calls = _interrupting(after=2)
+    with mock.patch.object(AcuFile, '_apply_multiple', apply_multiple):
+        with pytest.raises(KeyboardInterrupt):
+            asa.evolution_multiple(['rms', 'peak'])
+    assert len(list(checkpoint_dir.glob('*.nc'))) == 2
+
+    # The resumed run only processes the files without a shard
+    apply_multiple, calls = _interrupting()
+    with mock.patch.object(AcuFile, '_apply_multiple', apply_multiple):
+        resumed = asa.evolution_multiple(['rms', 'peak'])
+    assert [pathlib.Path(path).name for path in calls] == [path.name for path in sorted(folder.glob('*.wav'))[2:]]
+    xarray.testing.assert_allclose(resumed.load(), uninterrupted)
+
+    # The shards are not reused when a processing parameter changes
+    asa.binsize = 1.0
+    apply_multiple, calls = _interrupting()
+    with mock.patch.object(AcuFile, '_apply_multiple', apply_multiple):
+        asa.evolution_multiple(['rms', 'peak'])
+    assert len(calls) == 4
+    assert len(list(checkpoint_dir.glob('*.nc'))) == 8
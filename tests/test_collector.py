@@ -0,0 +1,32 @@
+import numpy as np
+import pandas as pd
+
+from pypam._collector import BinCollector
+
+
+def test_collector_grows():
+    times = pd.date_range('2021-06-10 03:36:55', periods=5, freq='10s')
+    collector = BinCollector(n_bins=2)
+    collector.add_variable('rms', shape=(2,))
+    for i, time_bin in enumerate(times):
+        row = collector.new_bin(i, time_bin, i * 10, (i + 1) * 10)
+        collector.set('rms', (row, 0), i)
+        if i != 3:
+            collector.set('rms', (row, 1), 2 * i)
+    da = collector.to_dataarray('rms', dims=['band'], coords={'band': [0, 1]})
+    assert da.dims == ('id', 'band')
+    assert (da.datetime.values == times.values).all()
+    assert (da.sel(band=0).values == np.arange(5)).all()
+    assert np.isnan(da.sel(id=3, band=1))
+    assert (da.end_sample.values - da.start_sample.values == 10).all()
+
+
+def test_collector_declares_from_first_value():
+    collector = BinCollector(n_bins=3, dtype=np.float32)
+    for i in range(3):
+        row = collector.new_bin(i, pd.Timestamp('2021-06-10') + pd.Timedelta(seconds=i), i, i + 1)
+        collector.set('spectrogram', row, np.full((4, 2), i, dtype=np.float64))
+    da = collector.to_dataarray('spectrogram', dims=['frequency', 'time'])
+    assert da.shape == (3, 4, 2)
+    assert da.dtype == np.float32
+    assert (da.isel(id=2) == 2).all()
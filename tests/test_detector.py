@@ -0,0 +1,65 @@
+import numpy as np
+import scipy.signal
+
+from pypam._detector import StrikeDetector
+
+
+def _strikes(fs=4000, n_events=60):
+    rng = np.random.default_rng(0)
+    signal = rng.standard_normal(fs * 2 * n_events)
+    locations = np.cumsum(rng.integers(int(1.1 * fs), 2 * fs, n_events))
+    for location in locations[locations < signal.size - 300]:
+        signal[location:location + 300] += rng.uniform(20, 60) * np.exp(-np.arange(300) / 40) * \
+            np.sin(np.arange(300) * 0.7)
+    return signal
+
+
+def _chained_peaks(fs=1000):
+    # Increasing peaks closer than the minimum separation: each one removes the previous one, so the first and the
+    # last of each chain are kept
+    signal = np.zeros(5 * fs)
+    for position, height in [(1000, 10), (1090, 11), (1180, 12), (3000, 10), (3090, 11), (3180, 12)]:
+        signal[position] = height
+    return signal
+
+
+def test_detector_chunks():
+    for fs, signal, threshold, min_separation, chunksizes in [
+            (4000, _strikes(4000), 8, 1.0, [1000, 7777, None]),
+            (1000, _chained_peaks(1000), 5, 0.1, [50, 500, None])]:
+        peaks, _ = scipy.signal.find_peaks(signal, height=threshold, distance=int(min_separation * fs))
+        expected_starts = np.maximum(peaks - int(0.2 * fs), 0)
+        for chunksize in chunksizes:
+            chunksize = signal.size if chunksize is None else chunksize
+            detector = StrikeDetector(fs, threshold, min_separation=min_separation, buffer=0.2, max_duration=None)
+            starts, ends = [], []
+            for i in range(0, signal.size, chunksize):
+                s, e, kept, offset = detector.process(signal[i:i + chunksize])
+                # The samples of the events are kept
+                assert np.all(s >= offset) and np.all(e <= offset + kept.size)
+                starts.append(s)
+                ends.append(e)
+            s, e, kept, offset = detector.finish()
+            starts = np.concatenate(starts + [s])
+            ends = np.concatenate(ends + [e])
+            assert np.array_equal(starts, expected_starts)
+            assert np.array_equal(ends, np.append(expected_starts[1:], signal.size))
+
+
+def test_detector_max_duration():
+    fs = 4000
+    signal = _strikes(fs)
+    detector = StrikeDetector(fs, 8, min_separation=1.0, buffer=0.2, max_duration=0.5, trigger='envelope')
+    starts, ends = [], []
+    for i in range(0, signal.size, 1000):
+        s, e, _, _ = detector.process(signal[i:i + 1000])
+        starts.append(s)
+        ends.append(e)
+        # Only the samples of the last event and the context are kept
+        assert detector._signal.size <= 3 * fs + 1000
+    s, e, _, _ = detector.finish()
+    starts = np.concatenate(starts + [s])
+    ends = np.concatenate(ends + [e])
+    assert starts.size > 0
+    assert np.all(ends - starts <= 0.5 * fs)
+    assert np.all(np.diff(starts) >= fs)
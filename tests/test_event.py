@@ -0,0 +1,56 @@
+import numpy as np
+
+from pypam import utils
+from pypam._event import Event, analyze_events, decidecade_sel_events
+
+
+def _strikes(fs=8000, n_events=20):
+    rng = np.random.default_rng(0)
+    signal = rng.standard_normal(fs * n_events) * 10
+    locations = np.arange(n_events) * fs + rng.integers(0, fs // 2, n_events)
+    for location in locations:
+        signal[location:location + 400] += 3000 * np.exp(-np.arange(400) / 60) * np.sin(np.arange(400) * 0.3)
+    return signal, locations - 200
+
+
+def test_analyze_events_as_event_analyze():
+    fs = 8000
+    signal, locations = _strikes(fs)
+    starts, ends = locations[:-1], locations[1:]
+    for impulsive in [True, False]:
+        results = analyze_events(signal, fs, starts, ends, impulsive=impulsive)
+        expected = [Event(signal, fs, start=start, end=end).analyze(impulsive=impulsive)
+                    for start, end in zip(starts, ends)]
+        assert list(results.keys()) == list(expected[0].keys())
+        for key, values in results.items():
+            assert values.shape == (len(starts),)
+            assert np.allclose(values, [e[key] for e in expected], rtol=1e-9, atol=0)
+
+
+def test_event_energy_index():
+    fs = 8000
+    signal, locations = _strikes(fs, n_events=5)
+    index = utils.EnergyIndex(signal, block_size=100)
+    for start, end in zip(locations[:-1], locations[1:]):
+        for impulsive in [True, False]:
+            expected = Event(signal, fs, start=start, end=end).analyze(impulsive=impulsive)
+            results = Event(signal, fs, start=start, end=end, energy_index=index).analyze(impulsive=impulsive)
+            for key in expected:
+                assert np.isclose(results[key], expected[key], rtol=1e-9, atol=0)
+
+
+def test_decidecade_sel_events():
+    fs = 8000
+    signal, locations = _strikes(fs, n_events=6)
+    # Events of the same length, transformed without padding: the same as Event.decidecade_sel
+    starts = locations[:-1]
+    ends = starts + fs // 2
+    sel = decidecade_sel_events(signal, fs, starts, ends, nfft=fs // 2)
+    assert sel.dims == ('id', 'frequency')
+    assert np.array_equal(sel.start_sample, starts)
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        f, expected = Event(signal, fs, start=start, end=end).decidecade_sel()
+        assert np.allclose(sel.sel(frequency=f).values[i], expected, rtol=1e-10, equal_nan=True)
+    # Events of different lengths, zero-padded to powers of 2
+    sel = decidecade_sel_events(signal, fs, locations[:-1], locations[1:])
+    assert np.isfinite(sel.sel(frequency=1000).values).all()
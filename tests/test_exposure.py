@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+import pyhydrophone as pyhy
+import pytest
+import soundfile as sf
+import xarray
+
+from pypam import _exposure
+from pypam.acoustic_survey import ASA
+
+
+def _strikes(n=3000, n_bands=3):
+    rng = np.random.default_rng(0)
+    datetimes = pd.Timestamp('2024-05-01') + pd.to_timedelta(np.sort(rng.uniform(0, 3 * 86400, n)), unit='s')
+    sel = rng.normal(170, 5, n)
+    band_sel = rng.normal(150, 5, (n, n_bands))
+    piles = np.where(np.arange(n) < n // 3, 'A', 'B')
+    return datetimes.values, sel, sel + 20, band_sel, piles
+
+
+def _accumulator(datetimes, sel, peak, band_sel, piles, frequency, block_size=500):
+    accumulator = _exposure.ExposureAccumulator(resolution='1min')
+    for i in range(0, sel.size, block_size):
+        block = slice(i, i + block_size)
+        for pile in np.unique(piles[block]):
+            mask = piles[block] == pile
+            accumulator.add(datetimes[block][mask], sel[block][mask], peak[block][mask], pile=pile,
+                            band_sel=band_sel[block][mask], frequency=frequency)
+    return accumulator
+
+
+def test_exposure_selcum():
+    datetimes, sel, peak, band_sel, piles = _strikes()
+    accumulator = _accumulator(datetimes, sel, peak, band_sel, piles, np.array([100.0, 125.0, 160.0]))
+    energy = 10 ** (sel / 10)
+
+    days = pd.DatetimeIndex(datetimes).floor('D')
+    daily = accumulator.selcum('24h')
+    assert np.array_equal(daily.datetime.values, np.unique(days.values))
+    assert np.allclose(daily.selcum, [10 * np.log10(energy[days == day].sum()) for day in daily.datetime.values])
+    assert np.array_equal(daily.strikes, [(days == day).sum() for day in daily.datetime.values])
+    assert np.allclose(daily.peak, [peak[days == day].max() for day in daily.datetime.values])
+    assert np.allclose(daily.band_selcum[0], 10 * np.log10((10 ** (band_sel[days == days[0]] / 10)).sum(axis=0)))
+
+    # Rolling windows end at the end of each minute with strikes
+    bin_ends = pd.DatetimeIndex(datetimes).floor('1min').values + np.timedelta64(1, 'm')
+    rolling = accumulator.selcum('6h', rolling=True)
+    for end, selcum in zip(rolling.datetime.values[::50], rolling.selcum.values[::50]):
+        inside = (bin_ends > end - np.timedelta64(6, 'h')) & (bin_ends <= end)
+        assert np.isclose(selcum, 10 * np.log10(energy[inside].sum()))
+
+    totals = accumulator.pile_totals()
+    assert list(totals.pile.values) == ['A', 'B']
+    assert np.array_equal(totals.strikes, [(piles == 'A').sum(), (piles == 'B').sum()])
+    assert np.allclose(totals.selcum, [10 * np.log10(energy[piles == pile].sum()) for pile in ['A', 'B']])
+
+    p = accumulator.percentiles([5, 50, 95])
+    assert np.allclose(p.sel_percentiles, np.percentile(sel, [5, 50, 95]), atol=0.5)
+
+
+def test_exposure_merge_and_state(tmp_path):
+    datetimes, sel, peak, band_sel, piles = _strikes()
+    frequency = np.array([100.0, 125.0, 160.0])
+    accumulator = _accumulator(datetimes, sel, peak, band_sel, piles, frequency)
+
+    # Partial accumulators of different files (i.e. workers)
+    half = sel.size // 2
+    merged = _exposure.ExposureAccumulator(resolution='1min')
+    for part in [slice(half, None), slice(0, half)]:
+        merged.merge(_accumulator(datetimes[part], sel[part], peak[part], band_sel[part], piles[part], frequency))
+    assert merged.n_rows == accumulator.n_rows
+    xarray.testing.assert_allclose(merged.selcum('24h'), accumulator.selcum('24h'))
+    xarray.testing.assert_allclose(merged.pile_totals().drop_vars('pile'),
+                                   accumulator.pile_totals().sortby('pile', ascending=False).drop_vars('pile'))
+
+    path = tmp_path.joinpath('exposure.nc')
+    accumulator.save(path)
+    loaded = _exposure.ExposureAccumulator.load(path)
+    xarray.testing.assert_allclose(loaded.selcum('3h', rolling=True), accumulator.selcum('3h', rolling=True))
+    xarray.testing.assert_allclose(loaded.percentiles([5, 50, 95], per_pile=True),
+                                   accumulator.percentiles([5, 50, 95], per_pile=True))
+    # The loaded accumulator keeps accumulating
+    loaded.add(datetimes[:10], sel[:10], peak[:10], pile='A', band_sel=band_sel[:10], frequency=frequency)
+    assert loaded.pile_totals().strikes.sel(pile='A') == (piles == 'A').sum() + 10
+
+
+def test_exposure_resume(tmp_path):
+    datetimes, sel, peak, band_sel, piles = _strikes()
+    frequency = np.array([100.0, 125.0, 160.0])
+    accumulator = _exposure.ExposureAccumulator(resolution='1min')
+    half = sel.size // 2
+    accumulator.add(datetimes[:half], sel[:half], peak[:half], band_sel=band_sel[:half], frequency=frequency,
+                    source='file_0')
+    path = tmp_path.joinpath('exposure.nc')
+    accumulator.save(path)
+    loaded = _exposure.ExposureAccumulator.load(path)
+    assert loaded.sources == {'file_0'}
+
+    # The strikes of a source which was already added are not counted again
+    for resumed in [accumulator, loaded]:
+        for part, source in [(slice(None, half), 'file_0'), (slice(half, None), 'file_1')]:
+            resumed.add(datetimes[part], sel[part], peak[part], band_sel=band_sel[part], frequency=frequency,
+                        source=source)
+        assert resumed.pile_totals().strikes.item() == sel.size
+    xarray.testing.assert_allclose(loaded.selcum('24h'), accumulator.selcum('24h'))
+
+    # Merging an accumulator of the same sources does not change anything, sharing only some of them is an error
+    loaded.merge(accumulator)
+    assert loaded.pile_totals().strikes.item() == sel.size
+    other = _exposure.ExposureAccumulator(resolution='1min')
+    other.add(datetimes[:1], sel[:1], peak[:1], band_sel=band_sel[:1], frequency=frequency, source='file_1')
+    other.add(datetimes[1:2], sel[1:2], peak[1:2], band_sel=band_sel[1:2], frequency=frequency, source='file_2')
+    with pytest.raises(ValueError):
+        loaded.merge(other)
+
+
+def test_survey_strike_exposure_resume(tmp_path):
+    rng = np.random.default_rng(0)
+    for name in ['AMAR.20210610T033655Z.wav', 'AMAR.20210610T033705Z.wav']:
+        wav = 0.001 * rng.standard_normal(8000 * 10)
+        wav[8000 * np.arange(1, 9)] = 0.5
+        sf.write(tmp_path.joinpath(name), wav, 8000, subtype='PCM_16')
+    asa = ASA(pyhy.amar.AmarG3('AMAR', 'G3', 1, -166.6, 0, 2), tmp_path, binsize=10.0, nfft=512)
+    threshold = asa._hydro_file(tmp_path.joinpath('AMAR.20210610T033655Z.wav')).wav2upa(np.array([0.2]))[0]
+    kwargs = {'min_separation': 0.5, 'buffer': 0.05, 'max_duration': 0.2}
+    accumulator = asa.strike_exposure(threshold, **kwargs)
+    assert accumulator.pile_totals().strikes.item() == 16
+    assert len(accumulator.sources) == 2
+
+    # Resuming the campaign with the saved accumulator does not add the same files again
+    path = tmp_path.joinpath('exposure.nc')
+    accumulator.save(path)
+    resumed = asa.strike_exposure(threshold, accumulator=_exposure.ExposureAccumulator.load(path), **kwargs)
+    xarray.testing.assert_allclose(resumed.pile_totals(), accumulator.pile_totals())
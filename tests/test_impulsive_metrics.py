@@ -6,7 +6,7 @@ import pyhydrophone as pyhy
 import pypam
 import xarray as xr
 
-from pypam._event import Event
+from pypam._event import Event, analyze_events
 import matplotlib.pyplot as plt
 
 from tests import skip_unless_with_plots
@@ -159,6 +159,52 @@ def test_verify_results():
     assert tau_diff[1] < tol_pulse_width
 
 
+def test_analyze_events():
+    """compare the batch analysis of all the events with the benchmark"""
+    event_separation_s = 1.0
+    buffer_s = 0.2
+    locations = simplePeaks(acu_file, 25, event_separation_s, buffer_s)
+    signal, fs = acu_file.signal(units="upa"), acu_file.fs
+
+    df = pd.DataFrame(
+        analyze_events(signal, fs, locations[:-1], locations[1:], impulsive=True)
+    )
+    df_bm = load_benchmark_data()
+
+    for key in ["peak", "rms90", "sel"]:
+        max_diff = np.max(np.abs(df[key].values - df_bm[key].values[0:39]))
+        median_diff = np.abs(
+            np.median(df[key].values) - np.median(df_bm[key].values[0:39])
+        )
+        assert max_diff < 0.5
+        assert median_diff < 0.1
+    tau_median_diff = np.abs(
+        np.median(df["tau"].values) - np.median(df_bm["tau"].values[0:39])
+    )
+    assert tau_median_diff < 0.01
+
+
+def test_impulsive_events():
+    """compare the streaming detection and analysis of the file with the events of simplePeaks"""
+    event_separation_s = 1.0
+    buffer_s = 0.2
+    locations = simplePeaks(acu_file, 25, event_separation_s, buffer_s)
+
+    ds = acu_file.impulsive_events(
+        25,
+        min_separation=event_separation_s,
+        buffer=buffer_s,
+        max_duration=None,
+        units="Pa",
+    )
+    assert np.array_equal(ds.start_sample.values, locations)
+    df = pd.read_csv(
+        os.path.join(pile_driving_dir, "pileDriving_results_pypam.csv")
+    )
+    for key in ["peak", "rms90", "sel", "tau"]:
+        assert np.allclose(ds[key].values[:-1], df[key].values)
+
+
 def test_kurtosis_over_file():
     """test acu_file implementation of kurtosis (i.e. _apply_multiple)"""
     # calculate 0.1 s kurtosis
@@ -0,0 +1,22 @@
+import pyhydrophone as pyhy
+import xarray
+
+from pypam.acoustic_survey import ASA
+from tests import write_survey
+
+amar = pyhy.amar.AmarG3('AMAR', 'G3', 1, -166.6, 0, 2)
+band_list = [[0, 4000], [100, 1000]]
+
+
+def test_pool_as_serial(tmp_path):
+    write_survey(tmp_path, n_files=6)
+    serial = ASA(amar, tmp_path, binsize=2.0, nfft=512).evolution_multiple(['rms', 'peak'], band_list=band_list)
+    asa = ASA(amar, tmp_path, binsize=2.0, nfft=512, n_jobs=2)
+    xarray.testing.assert_identical(asa.evolution_multiple(['rms', 'peak'], band_list=band_list), serial)
+
+    # A file which can not be read is skipped, and the rest of the survey is processed
+    bad_file = tmp_path.joinpath('AMAR.20210610T033800Z.wav')
+    bad_file.write_bytes(b'not a wav file')
+    output = asa.evolution_multiple(['rms', 'peak'], band_list=band_list)
+    assert asa.failed_files == [bad_file]
+    xarray.testing.assert_identical(output, serial)
@@ -0,0 +1,43 @@
+import numpy as np
+import pyhydrophone as pyhy
+import pytest
+import soundfile as sf
+
+from pypam import _pcm
+from pypam.acoustic_file import AcuFile
+
+
+@pytest.mark.parametrize('subtype', ['PCM_16', 'PCM_24', 'PCM_32', 'FLOAT', 'DOUBLE'])
+@pytest.mark.parametrize('channels', [1, 2])
+def test_pcm_reader_matches_soundfile(tmp_path, subtype, channels):
+    path = tmp_path.joinpath('test.wav')
+    data = np.random.default_rng(0).uniform(-0.9, 0.9, (1000, channels))
+    sf.write(path, data, 8000, subtype=subtype)
+    reader = _pcm.open_pcm(path)
+    assert reader.frames == 1000 and reader.samplerate == 8000
+    assert np.array_equal(reader.read(), sf.read(path)[0])
+    assert np.array_equal(reader.read(10, 20), sf.read(path, start=10, stop=20)[0])
+    view = _pcm.PCMView(reader, gain=2.0)
+    assert len(view) == 1000
+    assert np.array_equal(view[100:200], sf.read(path)[0][100:200] * 2.0)
+
+
+def test_pcm_reader_unsupported(tmp_path):
+    path = tmp_path.joinpath('test.wav')
+    sf.write(path, np.zeros(100), 8000, subtype='ULAW')
+    assert _pcm.open_pcm(path) is None
+
+
+def test_acu_file_signal_array(tmp_path):
+    path = tmp_path.joinpath('AMAR.20210610T033655Z.wav')
+    sf.write(path, np.random.default_rng(0).uniform(-0.9, 0.9, 8000), 8000, subtype='PCM_16')
+    acu_file = AcuFile(path, pyhy.amar.AmarG3('AMAR', 'G3', 1, -166.6, 0, 2), 1.0)
+    upa = acu_file.signal('upa')
+    assert isinstance(upa, np.ndarray)
+    assert upa.max() == np.sort(upa)[-1]
+    assert np.allclose((upa * 2) / 2, upa)
+    assert np.allclose(acu_file.signal('Pa'), upa / 1e6)
+    assert np.allclose(acu_file.upa2db(), 10 * np.log10(upa ** 2))
+    # The view only reads the selected samples, with the same values
+    assert isinstance(acu_file.signal_view('upa'), _pcm.PCMView)
+    assert np.array_equal(acu_file.signal_view('upa')[100:200], upa[100:200])
@@ -1,7 +1,18 @@
+import pathlib
+import pickle
+import tempfile
 import unittest
+from unittest import mock
 import pypam.signal as sig
 import numpy as np
-from tests import skip_unless_with_plots, with_plots
+import pyhydrophone as pyhy
+import scipy.signal
+import soundfile as sf
+from pypam.acoustic_file import AcuFile
+from pypam.acoustic_survey import ASA
+from pypam import _filters
+from pypam import utils
+from tests import skip_unless_with_plots, with_plots, write_survey
 import matplotlib.pyplot as plt
 
 
@@ -22,6 +33,36 @@ for test_freq in test_freqs:
 nfft = fs
 
 
+def _dc_acu_file(folder):
+    """
+    AcuFile of 4 seconds of noise and a tone with a dc offset, at 8 kHz
+    """
+    path = pathlib.Path(folder).joinpath('AMAR.20210610T033655Z.wav')
+    if not path.exists():
+        rng = np.random.default_rng(0)
+        wav = 0.2 + 0.05 * rng.standard_normal(8000 * 4) + 0.1 * np.sin(2 * np.pi * 440 * np.arange(8000 * 4) / 8000)
+        sf.write(path, wav, 8000, subtype='PCM_16')
+    return AcuFile(path, pyhy.amar.AmarG3('AMAR', 'G3', 1, -166.6, 0, 2), 1.0, dc_subtract=True)
+
+
+def _octave_levels_loop(blocks, fs, fraction, level_offset=1):
+    """
+    Octave levels of each block filtering each band separately, as Signal.octave_levels did before the octave bank.
+    The filters of level d are designed for fs / 2 ** (d - 1), so the signal has to be decimated d - 1 times
+    (level_offset 1). With level_offset 0 the signal is decimated d times, as it was before
+    """
+    bands, f = utils.oct_fbands(min_freq=sig.MIN_FREQ, max_freq=fs / 2, fraction=fraction)
+    filterbank, _, d = utils.octbankdsgn(fs, bands, fraction, 2)
+    decimated = {0: blocks}
+    for i in range(1, int(d.max()) + 1):
+        decimated[i] = scipy.signal.decimate(decimated[i - 1], 2)
+    levels = np.zeros((blocks.shape[0], len(d)))
+    for i in range(len(d)):
+        y = scipy.signal.sosfilt(filterbank[i], decimated[d[i] - level_offset])
+        levels[:, i] = 10 * np.log10(np.mean(y ** 2, axis=-1))
+    return levels
+
+
 class TestSignal(unittest.TestCase):
     def setUp(self) -> None:
         self.data = data
@@ -55,4 +96,241 @@ class TestSignal(unittest.TestCase):
         zcr_avg = s.zcr_avg()
         assert np.logical_and(zcr_avg >= 0, zcr_avg <= 1)
 
+    def test_blocks_spectrum(self):
+        blocks = self.data.reshape((seconds_signal, fs))
+        fbands, spectra, percentiles = sig.blocks_spectrum(blocks, fs=fs, scaling='density', nfft=4096, db=True,
+                                                           overlap=0.5, percentiles=[10, 50])
+        for i, block in enumerate(blocks):
+            s = sig.Signal(block, fs=fs)
+            s.set_band(None)
+            fbands_i, spectra_i, percentiles_i = s.spectrum(scaling='density', nfft=4096, db=True, overlap=0.5,
+                                                            percentiles=[10, 50])
+            assert np.allclose(fbands, fbands_i)
+            assert np.allclose(spectra[i], spectra_i)
+            assert np.allclose(percentiles[i], percentiles_i)
+
+    def test_blocks_spectrum_dc_subtract(self):
+        with tempfile.TemporaryDirectory() as folder:
+            acu_file = _dc_acu_file(folder)
+            blocks = acu_file.signal('upa').reshape((4, acu_file.fs))
+            for band in [None, [0, acu_file.fs / 2]]:
+                psd = acu_file.psd(binsize=1.0, nfft=512, band=band)['band_density'].values
+                for i, block in enumerate(blocks):
+                    # Same as the per-bin path: the dc is removed, but set_band goes back to the signal with dc for
+                    # the broadband bands other than [0, fs/2]
+                    s = sig.Signal(block, fs=acu_file.fs)
+                    s.remove_dc()
+                    s.set_band([None, acu_file.fs / 2] if band is None else band)
+                    _, psd_i, _ = s.spectrum(scaling='density', nfft=512, db=True, overlap=0.5)
+                    assert np.allclose(psd[i], psd_i)
+
+    def test_welch_accumulator(self):
+        accumulator = sig.WelchAccumulator(fs=fs, bin_samples=fs, nfft=4096, overlap=0.5)
+        bins = []
+        start = 0
+        for block_size in [1000, fs * 3 + 17, 5, fs * 2 + 5000]:
+            bins += accumulator.add(self.data[start:start + block_size])
+            start += block_size
+        assert len(bins) == start // fs
+        _, spectra, _ = sig.blocks_spectrum(self.data[:len(bins) * fs].reshape((len(bins), fs)), fs=fs, nfft=4096,
+                                            db=False, overlap=0.5)
+        for i, (bin_start, spectrum) in enumerate(bins):
+            assert bin_start == i * fs
+            assert np.allclose(spectrum, spectra[i])
+        # The incomplete bin is returned when flushing
+        assert len(accumulator.flush()) == 1
+
+    def test_blocks_spectrum_float32(self):
+        blocks = self.data.reshape((seconds_signal, fs))
+        _, spectra64, _ = sig.blocks_spectrum(blocks, fs=fs, nfft=4096, db=True, overlap=0.5)
+        _, spectra32, _ = sig.blocks_spectrum(blocks.astype(np.float32), fs=fs, nfft=4096, db=True, overlap=0.5)
+        assert np.abs(spectra64 - spectra32).max() < 0.01
+
+    def test_band_switching_does_not_copy(self):
+        s = sig.Signal(self.data, fs=fs)
+        assert np.shares_memory(s.signal, self.data)
+        assert not s.signal.flags.writeable
+        s.set_band([1000, 10000])
+        band_signal = s.signal
+        s.reset_original()
+        assert np.shares_memory(s.signal, self.data)
+        s.set_band([1000, 10000])
+        assert s.signal is band_signal
+
+    def test_filter_cache(self):
+        cache = _filters.FILTER_CACHE
+        cache.clear()
+        s = sig.Signal(self.data[:fs], fs=fs)
+        s.set_band([1000, 10000])
+        s2 = sig.Signal(self.data[fs:2 * fs], fs=fs)
+        s2.set_band([1000, 10000])
+        assert cache.misses == 2 and cache.hits == 2
+        s.reset_original()
+        sos = s._create_filter([1000, 10000])
+        assert np.array_equal(sos, scipy.signal.butter(4, [1000, 10000], btype='bandpass', output='sos', fs=fs))
+        # The cached filter can not be modified from outside
+        sos[:] = 0
+        assert np.any(s._create_filter([1000, 10000]) != 0)
+        # The decimation matches scipy
+        assert np.array_equal(_filters.decimate(self.data[:fs], 2), scipy.signal.decimate(self.data[:fs], 2))
+        assert np.array_equal(_filters.resample_poly(self.data[:fs], 1, 3),
+                              scipy.signal.resample_poly(self.data[:fs], 1, 3))
+        # The cache is picklable and keeps the designs
+        copy = pickle.loads(pickle.dumps(cache))
+        assert len(copy) == len(cache) and copy.info()['hits'] == cache.hits
+        # The least recently used designs are removed
+        small_cache = _filters.FilterCache(maxsize=2)
+        for i in range(3):
+            small_cache.get(i, lambda: np.zeros(i))
+        assert len(small_cache) == 2 and 0 not in small_cache
+
+    def test_continuous_filtering(self):
+        # Filtering the bins with the states of the previous bin is the same as filtering the whole signal
+        binsize = fs // 10
+        signal = self.data[:fs * 2]
+        for band, downsample in [([100, 1000], False), ([100, 1000], True)]:
+            whole = sig.Signal(signal, fs=fs)
+            whole.set_band(list(band), downsample=downsample)
+            states = {}
+            bins = []
+            for start in range(0, signal.size, binsize):
+                s = sig.Signal(signal[start:start + binsize], fs=fs, filter_states=states,
+                               lookahead=signal[start + binsize:start + 2 * binsize])
+                s.set_band(list(band), downsample=downsample)
+                bins.append(s.signal)
+            assert np.allclose(np.concatenate(bins), whole.signal)
+
+    def test_decimation_pyramid(self):
+        s = sig.Signal(self.data[:fs * 2], fs=fs)
+        # Each level is computed once and shared
+        assert s.decimated(3) is s.decimated(3)
+        assert np.array_equal(s.decimated(2), scipy.signal.decimate(scipy.signal.decimate(s.signal, 2), 2))
+        # The bands taken from the pyramid are close to the ones downsampled from the original signal
+        noise = np.random.default_rng(0).standard_normal(fs * 10)
+        for band in [[100, 1000], [20, 200]]:
+            multirate = sig.Signal(noise, fs=fs)
+            multirate.set_band(list(band), multirate=True)
+            direct = sig.Signal(noise, fs=fs)
+            direct.set_band(list(band))
+            assert multirate.fs == direct.fs
+            assert abs(multirate.rms() - direct.rms()) < 0.3
+
+    def test_multirate_acu_file(self):
+        with tempfile.TemporaryDirectory() as folder:
+            acu_file = _dc_acu_file(folder)
+            blocks = acu_file.signal('upa').reshape((4, acu_file.fs))
+            band_list = [[100, 2000], [20, 500]]
+            ds = acu_file._apply_multiple(['rms'], binsize=1.0, band_list=[list(band) for band in band_list],
+                                          multirate=True)
+            filtered = acu_file._apply_multiple(['rms'], binsize=1.0, band_list=[list(band) for band in band_list])
+            oct3 = acu_file.third_octaves_levels(binsize=1.0, band=[100, 2000], multirate=True)['oct3'].values
+            for i, block in enumerate(blocks):
+                s = sig.Signal(block, fs=acu_file.fs)
+                s.remove_dc()
+                for j, band in enumerate(zip(ds.low_freq.values, ds.high_freq.values)):
+                    s.set_band(list(band), multirate=True)
+                    assert np.isclose(ds['rms'].values[i, j], s.rms())
+                s = sig.Signal(block, fs=acu_file.fs)
+                s.remove_dc()
+                s.set_band([100, 2000], multirate=True)
+                _, levels = s.octave_levels(fraction=3)
+                assert np.allclose(oct3[i], levels, equal_nan=True)
+            # The bands taken from the pyramid are close to the filtered ones
+            assert np.allclose(ds['rms'], filtered['rms'], atol=0.5)
+
+    def test_octave_bank_levels(self):
+        noise = np.random.default_rng(0).standard_normal((3, fs))
+        for fraction in [1, 3]:
+            reference = _octave_levels_loop(noise, fs, fraction)
+            fbands, levels = sig.octave_bank_levels(noise, fs, fraction=fraction)
+            assert np.allclose(levels, reference, rtol=0, atol=1e-9)
+            _, levels_signal = sig.Signal(noise[1], fs=fs).octave_levels(fraction=fraction)
+            assert np.allclose(levels_signal, reference[1], rtol=0, atol=1e-9)
+            # The fft bands are close to the filter bands where there are enough fft bins per band
+            _, levels_fft = sig.octave_bank_levels(noise, fs, fraction=fraction, method='fft')
+            resolved = fbands > 200
+            assert np.abs(levels_fft[:, resolved] - levels[:, resolved]).max() < 1
+
+    def test_octave_levels_tone(self):
+        # A pure tone has its level (mean square of 0.5, -3 db) in the band labelled with its frequency
+        tone = np.sin(2 * np.pi * 1000 * np.arange(fs * 2) / fs)
+        for fraction in [1, 3]:
+            f, levels = sig.Signal(tone, fs=fs).octave_levels(fraction=fraction)
+            assert f[np.argmax(levels)] == 1000
+            assert abs(levels.max() - 10 * np.log10(0.5)) < 0.1
+            fbands, levels_bank = sig.octave_bank_levels(np.stack([tone, tone]), fs, fraction=fraction)
+            assert np.array_equal(fbands, f)
+            assert np.allclose(levels_bank, _octave_levels_loop(tone[np.newaxis, :], fs, fraction), rtol=0,
+                               atol=1e-9)
+            _, levels_fft = sig.octave_bank_levels(tone[np.newaxis, :], fs, fraction=fraction, method='fft')
+            assert fbands[np.nanargmax(levels_fft[0])] == 1000
+            # The previous indexing filtered each band with the signal decimated once more, so the tone was
+            # reported one octave up
+            shifted = _octave_levels_loop(tone[np.newaxis, :], fs, fraction, level_offset=0)
+            assert f[np.argmax(shifted[0])] == 2000
+
+    def test_blocks_broadband_metrics(self):
+        noise = np.random.default_rng(0).standard_normal((3, fs // 10)) * 100
+        bands = [[0, fs / 2], [100, 2000], [50, 500], [0, fs / 2]]
+        methods = ['rms', 'peak', 'sel', 'kurtosis', 'dynamic_range']
+        output = sig.blocks_broadband_metrics(noise, fs, [list(band) for band in bands], methods)
+        for i, block in enumerate(noise):
+            s = sig.Signal(block, fs=fs)
+            for j, band in enumerate(bands):
+                # Each band is filtered from the signal of the previous one, as in _apply_multiple
+                s.set_band(list(band), downsample=False)
+                reference = [getattr(s, method_name)() for method_name in methods]
+                assert np.allclose(output[i, j], reference, rtol=1e-12, atol=0)
+
+        # Through AcuFile, with the dc removed as in the per-bin path (the broadband bands other than [0, fs/2] go
+        # back to the signal with dc)
+        with tempfile.TemporaryDirectory() as folder:
+            acu_file = _dc_acu_file(folder)
+            blocks = acu_file.signal('upa').reshape((4, acu_file.fs))
+            band_list = [[0, 4000], [100, 2000], [None, 4000], [0, 1000]]
+            ds = acu_file._apply_multiple(methods, binsize=1.0, band_list=[list(band) for band in band_list])
+            bands = list(zip(ds.low_freq.values, ds.high_freq.values))
+            for i, block in enumerate(blocks):
+                s = sig.Signal(block, fs=acu_file.fs)
+                s.remove_dc()
+                for j, band in enumerate(bands):
+                    s.set_band(list(band), downsample=False)
+                    reference = [getattr(s, method_name)() for method_name in methods]
+                    assert np.allclose([ds[method_name].values[i, j] for method_name in methods], reference,
+                                       rtol=1e-10, atol=0)
+
+    def test_survey_broadband_metrics(self):
+        # ASA passes the fft parameters to all the methods, the broadband metrics still use the fused path
+        methods = ['rms', 'peak', 'sel']
+        with tempfile.TemporaryDirectory() as folder:
+            write_survey(pathlib.Path(folder), n_files=2, seconds=4)
+            asa = ASA(pyhy.amar.AmarG3('AMAR', 'G3', 1, -166.6, 0, 2), folder, binsize=1.0, nfft=512)
+            with mock.patch.object(sig, 'blocks_broadband_metrics', wraps=sig.blocks_broadband_metrics) as fused:
+                ds = asa.evolution_multiple(methods)
+            assert fused.call_count == 2
+            # Same as the per-bin path
+            per_bin = asa.evolution_multiple(methods, continuous=True)
+            for method_name in methods:
+                assert np.allclose(ds[method_name], per_bin[method_name], rtol=1e-10, atol=0)
 
+    def test_events_decidecade_sel(self):
+        rng = np.random.default_rng(0)
+        signal = rng.standard_normal(fs * 4)
+        starts = np.array([0, fs, 2 * fs + 100])
+        ends = starts + np.array([fs // 2, fs // 2 + 333, fs // 3])
+        (f, _, _), sel = sig.events_decidecade_sel(signal, fs, starts, ends)
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            # Reference: periodogram of the event and trapezoidal integral of each band
+            f_psd, psd = scipy.signal.periodogram(signal[start:end], fs=fs)
+            ef = psd * (end - start) / fs
+            centers, highs, lows = utils.decidecade_bands(f_psd[1], max(f_psd), bounded=True)
+            reference = np.array([np.trapz(ef[(f_psd > low) & (f_psd < high)],
+                                           x=f_psd[(f_psd > low) & (f_psd < high)])
+                                  for high, low in zip(highs, lows)])
+            reference[reference <= 0] = np.nan
+            f_event, sel_event = sig.Signal(signal[start:end], fs=fs).decidecade_sel()
+            assert np.allclose(f_event, centers)
+            assert np.allclose(sel_event, 10 * np.log10(reference), rtol=1e-10, equal_nan=True)
+            # Zero-padded events are close in the bands with many frequencies
+            resolved = np.isin(f, centers[centers > 1000])
+            assert np.allclose(sel[i, resolved], sel_event[centers > 1000], atol=0.5)
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import xarray
+
+from pypam import utils
+
+zarr = pytest.importorskip('zarr')
+from pypam import _sink  # noqa: E402
+
+
+def test_zarr_sink_matches_merge(tmp_path):
+    ds_list = []
+    for i in range(3):
+        ds = xarray.Dataset(
+            {'psd': (('id', 'frequency'), np.random.random((4, 5)))},
+            coords={'id': np.arange(4), 'frequency': np.arange(5)},
+            attrs={'file_path': 'file_%s.wav' % ('x' * i), 'fs': 8000},
+        )
+        ds_list.append(ds)
+    ds_merged = utils.merge_ds_list(
+        xarray.Dataset(attrs={'binsize': 60}), ds_list, ['file_path']
+    )
+    sink = _sink.ZarrSink(
+        tmp_path / 'out.zarr', ['file_path'], attrs={'binsize': 60}, chunks='ltsa'
+    )
+    for ds in ds_list:
+        sink.append(ds)
+    ds_stored = sink.open()
+    xarray.testing.assert_equal(ds_merged, ds_stored.load())
+    assert ds_merged.attrs == ds_stored.attrs
+    assert ds_stored['psd'].encoding['chunks'][1] == 5
+
+
+def test_zarr_sink_overwrite(tmp_path):
+    ds = xarray.Dataset(
+        {'psd': (('id', 'frequency'), np.random.random((4, 5)))},
+        coords={'id': np.arange(4), 'frequency': np.arange(5)},
+        attrs={'file_path': 'file.wav'},
+    )
+    folder = tmp_path / 'results'
+    folder.mkdir()
+    folder.joinpath('notes.txt').write_text('keep')
+    with pytest.raises(FileExistsError):
+        _sink.ZarrSink(folder, ['file_path'])
+    assert folder.joinpath('notes.txt').exists()
+
+    # An existing zarr store is overwritten
+    store = tmp_path / 'out.zarr'
+    for _ in range(2):
+        sink = _sink.ZarrSink(store, ['file_path'])
+        sink.append(ds)
+    assert sink.open().dims['id'] == 4
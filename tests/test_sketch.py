@@ -0,0 +1,39 @@
+import numpy as np
+import xarray
+
+from pypam import _sketch
+
+
+def test_sketch_exact_with_few_values():
+    values = np.random.default_rng(0).normal(80, 10, (150, 4))
+    values[::7, 1] = np.nan
+    sketch = _sketch.QuantileSketch(k=200).add(values)
+    assert sketch.rank_error() == 0
+    assert np.allclose(sketch.percentiles([5, 50, 95]), np.nanpercentile(values, [5, 50, 95], axis=0).T)
+
+
+def test_sketch_merge_rank_error():
+    rng = np.random.default_rng(1)
+    values = rng.gamma(2, 10, (50000, 3))
+    sketch = _sketch.QuantileSketch(k=100, seed=0)
+    for i, block in enumerate(np.array_split(values, 20)):
+        sketch.merge(_sketch.QuantileSketch(k=100, seed=i).add(block))
+    assert sketch.n == 50000
+    # Memory does not grow with the number of values
+    assert sum(items.shape[1] for items in sketch.levels) < 3 * 100 + 2 * len(sketch.levels)
+    percentiles = [5, 50, 95]
+    estimated = sketch.percentiles(percentiles)
+    sorted_values = np.sort(values, axis=0)
+    for i in range(3):
+        ranks = np.searchsorted(sorted_values[:, i], estimated[i]) / values.shape[0]
+        assert np.all(np.abs(ranks - np.array(percentiles) / 100) < sketch.rank_error())
+
+
+def test_sketch_dataarray():
+    values = np.random.default_rng(2).normal(60, 5, (30, 2500))
+    da = xarray.DataArray(values, dims=['frequency', 'id'],
+                          coords={'frequency': np.arange(30) * 10.0, 'id': np.arange(2500)})
+    sketch = _sketch.sketch_dataarray(da, 'id', k=500, block_size=300)
+    p = _sketch.percentiles_dataarray(sketch, [10, 90])
+    assert p.dims == ('frequency', 'percentiles')
+    assert np.allclose(p.sel(percentiles=10), np.percentile(values, 10, axis=1), atol=0.5)
@@ -1,11 +1,13 @@
 import pytest
 import os
+import re
 import numpy as np
 import pandas as pd
 import xarray
 import matplotlib.pyplot as plt
 import scipy
 from tests import with_plots
+from pypam import _bands
 from pypam import utils
 
 plt.rcParams.update(plt.rcParamsDefault)
@@ -216,3 +218,204 @@ def test_third_octave_band_limits():
     )
     center = np.round(center, decimals=3)
     assert np.allclose(center, expected)
+
+
+def test_merge_ds_list():
+    ds_list = []
+    for i in range(3):
+        ds = xarray.Dataset(
+            {"rms": ("id", np.random.random(4))},
+            coords={"id": np.arange(4)},
+            attrs={"file_path": "file_%s.wav" % i, "fs": 8000},
+        )
+        ds_list.append(ds)
+    ds_sequential = xarray.Dataset(attrs={"binsize": 60})
+    for ds in ds_list:
+        ds_sequential = utils.merge_ds(ds_sequential, ds, ["file_path"])
+    ds_once = utils.merge_ds_list(
+        xarray.Dataset(attrs={"binsize": 60}), ds_list, ["file_path"]
+    )
+    xarray.testing.assert_identical(ds_sequential, ds_once)
+    assert (ds_once["id"].values == np.arange(12)).all()
+
+
+def test_spectra_ds_to_bands_power():
+    fs, nfft = 48000, 8192
+    fft_bin_width = fs / nfft
+    freq = np.arange(nfft // 2 + 1) * fft_bin_width
+    psd = xarray.DataArray(
+        np.random.random((5, freq.size)),
+        coords={"id": np.arange(5), "frequency": freq},
+        dims=["id", "frequency"],
+    )
+    bands_limits, bands_c = utils.get_hybrid_millidecade_limits(
+        band=[0, fs / 2], nfft=nfft
+    )
+    milli_psd = utils.spectra_ds_to_bands(
+        psd, bands_limits, bands_c, fft_bin_width=fft_bin_width, db=False
+    )
+    assert milli_psd.dims == ("id", "frequency_bins")
+    # The power of all the fft bins is distributed among the bands (the bands end in the middle of the last bin)
+    psd[:, -1] = 0
+    milli_psd = utils.spectra_ds_to_bands(
+        psd, bands_limits, bands_c, fft_bin_width=fft_bin_width, db=False
+    )
+    bandwidths = milli_psd.upper_frequency - milli_psd.lower_frequency
+    band_power = (milli_psd * bandwidths).sum("frequency_bins")
+    assert np.allclose(band_power, psd.sum("frequency"))
+    # The aggregation is only built once
+    assert _bands.band_aggregation(
+        freq, bands_limits, bands_c, fft_bin_width
+    ) is _bands.band_aggregation(freq, bands_limits, bands_c, fft_bin_width)
+
+
+def _snapshot_coord(coord):
+    # Values of the coordinate coord of the first id in the millidecade bands snapshot
+    with open(f"{test_dir}/__snapshots__/test_millidecade_bands.ambr") as f:
+        snapshot = f.read()
+    section = snapshot.split("'%s': dict({" % coord)[1].split("}),")[0]
+    values = re.findall(r"tuple\(\s+0,\s+([-\d.e]+),\s+\): ([-\d.e]+),", section)
+    return np.array([[float(c), float(v)] for c, v in values])
+
+
+def test_get_bands_limits_snapshot():
+    bands_limits, bands_c = utils.get_hybrid_millidecade_limits(
+        band=[0, 4000], nfft=8000, fs=8000
+    )
+    lower = _snapshot_coord("lower_frequency")
+    upper = _snapshot_coord("upper_frequency")
+    assert np.array_equal(lower[:, 0], np.round(bands_c, 6))
+    assert np.array_equal(lower[:, 1], np.round(bands_limits[:-1], 6))
+    assert np.array_equal(upper[:, 1], np.round(bands_limits[1:], 6))
+
+    # The tables are only computed once, and the returned copies can be modified
+    bands_limits[:] = 0
+    cached_limits, cached_c = utils.get_bands_limits(
+        [0, 4000], 8000, 10, 1000, True, fs=8000, copy=False
+    )
+    assert not cached_limits.flags.writeable
+    assert np.array_equal(np.round(cached_limits[1:], 6), upper[:, 1])
+    assert cached_limits is utils.get_bands_limits(
+        [0, 4000], 8000, 10, 1000, True, fs=8000, copy=False
+    )[0]
+
+
+def test_hmb_to_decidecade_chunked():
+    pytest.importorskip("dask")
+    fs = 48000
+    bands_limits, bands_c = utils.get_hybrid_millidecade_limits(
+        band=[0, fs / 2], nfft=fs
+    )
+    hmb = xarray.DataArray(
+        np.full((6, bands_c.size), 60.0),
+        coords={
+            "id": np.arange(6),
+            "frequency_bins": bands_c,
+            "lower_frequency": ("frequency_bins", bands_limits[:-1]),
+            "upper_frequency": ("frequency_bins", bands_limits[1:]),
+        },
+        dims=["id", "frequency_bins"],
+    ).sel(frequency_bins=slice(None, 20000))
+    ds = xarray.Dataset({"millidecade_bands": hmb})
+    decidecade = utils.hmb_to_decidecade(
+        ds.copy(deep=True), "millidecade_bands", "frequency_bins", fs=fs
+    )
+    # A flat spectrum stays flat (the last band is not complete)
+    assert np.allclose(decidecade["millidecade_bands"][:, :-1], 60.0, atol=0.1)
+
+    chunked = utils.hmb_to_decidecade(
+        ds.chunk({"id": 2}), "millidecade_bands", "frequency_bins", fs=fs
+    )
+    assert chunked["millidecade_bands"].chunks is not None
+    xarray.testing.assert_allclose(chunked.compute(), decidecade)
+
+
+def test_spd_accumulator():
+    rng = np.random.default_rng(0)
+    psd = rng.normal(80, 10, (300, 20))
+    ds = xarray.Dataset(
+        {"band_density": (("id", "frequency"), psd)},
+        coords={"id": np.arange(300), "frequency": np.arange(20) * 100.0},
+    )
+    spd = utils.compute_spd(
+        ds, h=0.5, percentiles=[10, 50, 90], min_val=40, max_val=120
+    )
+
+    # Histograms of parts of the bins (i.e. files processed in parallel) merged
+    accumulator = utils.SpdAccumulator(h=0.5, min_val=40, max_val=120)
+    for part in np.array_split(np.arange(300), 4):
+        accumulator.merge(
+            utils.SpdAccumulator(h=0.5, min_val=40, max_val=120).add(
+                ds.isel(id=part)
+            )
+        )
+    accumulated_spd = accumulator.to_dataset(percentiles=[10, 50, 90])
+    assert accumulator.counts.dtype == np.int64
+    assert np.array_equal(accumulated_spd["spd"].values, spd["spd"].values)
+    assert np.allclose(
+        accumulated_spd["value_percentiles"], spd["value_percentiles"], atol=0.5
+    )
+
+    # Without limits the histogram grows with the values
+    accumulator = utils.SpdAccumulator(h=0.5)
+    accumulator.add(ds.isel(id=slice(0, 150))).add(ds.isel(id=slice(150, None)))
+    growing_spd = accumulator.to_dataset()
+    assert growing_spd["spl"].min() <= psd.min()
+    assert growing_spd["spl"].max() + 0.5 > psd.max()
+    assert np.allclose(growing_spd["spd"].sum("spl") * 0.5, 1)
+
+
+def test_broadband_metrics():
+    blocks = np.random.default_rng(0).standard_normal((4, 2000)) * 50 + 3
+    metrics = utils.broadband_metrics(blocks, 8000)
+    for i, block in enumerate(blocks):
+        assert metrics[i, 0] == utils.rms(block)
+        assert metrics[i, 1] == utils.peak(block)
+        assert metrics[i, 2] == utils.dynamic_range(block)
+        assert metrics[i, 3] == utils.sel(block, 8000)
+        assert np.isclose(metrics[i, 4], utils.kurtosis(block), rtol=1e-12)
+    # The kurtosis of a constant signal is not defined
+    assert np.isnan(utils.broadband_metrics(np.ones((1, 10)), 8000)[0, 4])
+
+
+def test_energy_index():
+    rng = np.random.default_rng(0)
+    signal = rng.standard_normal(20000) * np.exp(-np.arange(20000) / 5000)
+    signal[3000:4000] = 0
+    for block_size in [1, 64]:
+        index = utils.EnergyIndex(signal, block_size=block_size)
+        assert np.isclose(index.energy(100, 15000), np.sum(signal[100:15000] ** 2))
+        assert np.isclose(index.sel(0, 20000, 1000), utils.sel(signal, 1000))
+        for _ in range(50):
+            start = rng.integers(0, 15000)
+            end = start + rng.integers(1, 5000)
+            percentage = rng.uniform(0.1, 0.99)
+            assert index.window(start, end, percentage) == utils.energy_window(signal[start:end], percentage)
+
+
+def test_band_integration():
+    fs, n = 8000, 1000
+    freq = np.arange(n // 2 + 1) * fs / n
+    centers, highs, lows = utils.decidecade_bands(freq[1], freq.max(), bounded=True)
+    integration = _bands.band_integration(fs / n, freq.size, [lows, highs], centers)
+    # The tables are shared
+    assert integration is _bands.band_integration(fs / n, freq.size, [lows, highs], centers)
+    energy = np.random.default_rng(0).random((3, freq.size))
+    integrals = integration.apply(energy)
+    for j, (low, high) in enumerate(zip(lows, highs)):
+        inside = (freq > low) & (freq < high)
+        assert np.allclose(integrals[:, j], np.trapz(energy[:, inside], x=freq[inside], axis=-1))
+
+
+def test_cumulative_energy_windows():
+    rng = np.random.default_rng(1)
+    signal = rng.standard_normal(5000)
+    signal[1000:1500] = 0
+    cumulative = utils.cumulative_energy(signal)
+    assert np.allclose(cumulative[1:], np.cumsum(signal ** 2)) and cumulative[0] == 0
+    starts = rng.integers(0, 4000, 30)
+    ends = starts + rng.integers(1, 1000, 30)
+    windows = utils.energy_windows(cumulative, starts, ends, 0.9)
+    assert np.array_equal(windows, utils.EnergyIndex(signal, block_size=16).windows(starts, ends, 0.9))
+    for window, start, end in zip(windows, starts, ends):
+        assert list(window) == utils.energy_window(signal[start:end], 0.9)